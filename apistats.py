@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+'''Records the latency, retries, and throttling of each AWS API call.
+
+APIStats hooks into botocore's event system, so every call made through
+an instrumented boto3 Session is recorded -- including the retries that
+botocore makes on its own and that are otherwise invisible -- without
+changing the code that makes the calls:
+
+    stats = APIStats()
+    session = boto3.Session(profile_name=profile_name)
+    stats.instrument(session)
+    ...
+    stats.print_summary()
+
+For each operation (e.g., 'iot.CreateThing') it keeps the latency of
+every call, from the start of the first attempt to the end of the last,
+the number of retries, the number of attempts rejected as throttled,
+and the number of calls that failed.
+
+'''
+
+from __future__ import print_function
+
+import atexit
+import json
+import sys
+import threading
+import time
+
+
+# Error codes with which AWS services throttle requests.
+THROTTLING_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+])
+
+# Upper bounds, in milliseconds, of the buckets of the latency histogram.
+HISTOGRAM_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Key under which a call's start time and attempts are kept in botocore's
+# per-request context.
+_CONTEXT_KEY = 'apistats'
+
+
+def _error_code(response):
+    '''Returns the error code in a botocore (http_response, parsed)
+    response, or None.
+
+    '''
+
+    if not response:
+        return None
+    return response[1].get('Error', {}).get('Code')
+
+
+def percentile(samples, pct):
+    '''Returns the pct'th percentile of a sorted list of samples.'''
+    index = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+class OperationStats(object):
+
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+
+
+    def histogram(self):
+        '''Returns a list of (upper bound in ms, count) pairs; the last
+        bound is None, for calls slower than every bucket.
+
+        '''
+
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for ms in self.latencies:
+            index = 0
+            while (index < len(HISTOGRAM_BUCKETS) and
+                   ms > HISTOGRAM_BUCKETS[index]):
+                index += 1
+            counts[index] += 1
+        return zip(HISTOGRAM_BUCKETS + (None,), counts)
+
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return dict(
+            operation=self.name,
+            calls=len(latencies),
+            total_ms=round(sum(latencies), 3),
+            p50_ms=round(percentile(latencies, 50), 3),
+            p90_ms=round(percentile(latencies, 90), 3),
+            p99_ms=round(percentile(latencies, 99), 3),
+            max_ms=round(latencies[-1], 3),
+            retries=self.retries,
+            throttled=self.throttled,
+            errors=self.errors,
+            histogram=self.histogram())
+
+
+class APIStats(object):
+
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+
+    def instrument(self, session):
+        '''Record the calls made by every client of the boto3 Session
+        session, whether created before or after this call.
+
+        '''
+
+        events = session.events
+        events.register('before-call', self._before_call)
+        events.register('needs-retry', self._needs_retry)
+        events.register('after-call', self._after_call)
+        return session
+
+
+    def _operation(self, event_name):
+        # Event names look like 'after-call.iot.CreateThing'.
+        name = event_name.split('.', 1)[1]
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = OperationStats(name)
+        return stats
+
+
+    def _before_call(self, context, **kwargs):
+        context[_CONTEXT_KEY] = dict(start=time.time(), attempts=1)
+
+
+    def _needs_retry(self, event_name, attempts, request_dict,
+                     response=None, **kwargs):
+        # Called after every attempt, whether or not it is retried.
+        call = request_dict.get('context', {}).get(_CONTEXT_KEY)
+        if call is not None:
+            call['attempts'] = attempts
+        if _error_code(response) in THROTTLING_CODES:
+            with self.lock:
+                self._operation(event_name).throttled += 1
+
+
+    def _after_call(self, event_name, context, http_response, parsed,
+                    **kwargs):
+        call = context.get(_CONTEXT_KEY)
+        if call is None:
+            return
+        elapsed = (time.time() - call['start']) * 1000
+        with self.lock:
+            stats = self._operation(event_name)
+            stats.latencies.append(elapsed)
+            stats.retries += call['attempts'] - 1
+            if http_response.status_code >= 300:
+                stats.errors += 1
+
+
+    def summary(self):
+        '''Returns a list of the summary of each operation, those that
+        took the most time in all first.
+
+        '''
+
+        with self.lock:
+            summaries = [s.summary() for s in self.operations.values()
+                         if s.latencies]
+        return sorted(summaries, key=lambda s: -s['total_ms'])
+
+
+    def print_summary(self, stream=None):
+        stream = stream or sys.stderr
+        summaries = self.summary()
+        print('%-40s %5s %9s %8s %8s %8s %7s %6s %6s' % (
+            'operation', 'calls', 'total ms', 'p50', 'p90', 'p99',
+            'retries', 'thrtl', 'errors'), file=stream)
+        for s in summaries:
+            print('%-40s %5d %9.1f %8.1f %8.1f %8.1f %7d %6d %6d' % (
+                s['operation'], s['calls'], s['total_ms'], s['p50_ms'],
+                s['p90_ms'], s['p99_ms'], s['retries'], s['throttled'],
+                s['errors']), file=stream)
+
+
+    def write(self, path):
+        '''Write the summary, including latency histograms, to path as
+        JSON.
+
+        '''
+
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+    def report(self, path=None):
+        '''Print the summary, and, if path is given, write it there.'''
+        self.print_summary()
+        if path:
+            self.write(path)
+
+
+def collect(path=None):
+    '''Returns a new APIStats whose summary is printed, and, if path is
+    given, written there, when the program exits.  Used to implement
+    the --stats and --stats-file options.
+
+    '''
+
+    stats = APIStats()
+    atexit.register(stats.report, path)
+    return stats
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+'''Runs a sequence of riprock commands in one process.
+
+Every run of riprock pays for starting the interpreter, importing boto3,
+creating a boto3 Session and its clients, checking for the root CA, and,
+for commands that publish, discovering the AWS IoT endpoint.  A script
+that provisions a fleet by running riprock once per Button pays for all
+of that once per command.  A Batch runs many commands instead, all with
+the same AWS clients, so each costs little more than its API calls.
+
+Commands are read from a file, one per line, in either of two forms:
+
+    create-button G030JF055364XVRB
+    ["create-button", "G030JF055364XVRB"]
+
+The first is split into words as a shell would; the second is a JSON
+array of the words.  A line may also be a JSON object whose "args" is
+that array; its other keys (e.g., "id") are copied into the command's
+result.  Blank lines, and lines starting with '#', are skipped.
+
+Each command's result is written as a line of JSON, as soon as the
+command finishes:
+
+    {"line": 3, "command": "create-button G030JF055364XVRB", "ok": true,
+     "status": 0, "seconds": 0.412, "result": {...}}
+
+'result' is what riprock would have printed as the command's response,
+'output' anything else the command printed, and, if it failed, 'error'
+describes why.  With more than one job, commands run concurrently, and
+finish, and are reported, in no particular order; 'line' tells which is
+which.  What a command prints from threads of its own, rather than from
+the thread running it, goes to stderr, so as not to garble the results.
+
+'''
+
+from __future__ import print_function
+
+import cStringIO
+import json
+import shlex
+import sys
+import threading
+import time
+
+from concurrent import futures
+
+
+class Command(object):
+    '''A command read from a batch file.'''
+
+    def __init__(self, line, argv, extra=None):
+        self.line = line
+        self.argv = argv
+        self.extra = extra or {}
+
+
+    @property
+    def text(self):
+        return ' '.join(self.argv)
+
+
+def parse_line(text):
+    '''Returns (argv, extra) for a line of a batch file, or None if it
+    holds no command.  Raises ValueError if it cannot be parsed.
+
+    '''
+
+    text = text.strip()
+    if not text or text.startswith('#'):
+        return None
+    if text[0] in '[{':
+        value = json.loads(text)
+        extra = {}
+        if isinstance(value, dict):
+            extra = dict(value)
+            value = extra.pop('args', None)
+        if (not isinstance(value, list) or
+            not all(isinstance(word, basestring) for word in value)):
+            msg = 'Expected a JSON array of strings'
+            raise ValueError, msg
+        return [word.encode('utf-8') if isinstance(word, unicode) else word
+                for word in value], extra
+    return shlex.split(text, comments=True), {}
+
+
+def read_commands(stream):
+    '''Yields the Commands read from stream.  A line that cannot be
+    parsed is yielded as a Command whose argv is None, and whose extra
+    holds the error, so that it is reported as failed.
+
+    '''
+
+    for number, text in enumerate(stream, 1):
+        try:
+            parsed = parse_line(text)
+        except ValueError as exc:
+            yield Command(number, None, dict(
+                error='%s: %s' % (type(exc).__name__, exc),
+                command=text.strip()))
+            continue
+        if parsed and parsed[0]:
+            yield Command(number, *parsed)
+
+
+class _ThreadOutput(object):
+    '''Stands in for sys.stdout while a Batch runs, sending what each
+    command prints to a buffer of its own.
+
+    '''
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+
+    def write(self, text):
+        (getattr(self.local, 'buffer', None) or self.default).write(text)
+
+
+    def flush(self):
+        (getattr(self.local, 'buffer', None) or self.default).flush()
+
+
+class Batch(object):
+
+
+    def __init__(self, run, jobs=1, stream=None):
+        '''
+        Args:
+            run (function) - run(argv) runs the command argv, returning
+                (response, status) as riprock's run_command() does, or
+                raising an exception if it fails.
+
+            jobs (int) - most commands run at once.
+
+            stream (file) - where the results are written; by default
+                sys.stdout.
+
+        '''
+        self.run_command = run
+        self.jobs = jobs
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.output = None
+        self.counts = dict(commands=0, failed=0)
+
+
+    def _run(self, command):
+        result = dict(command.extra)
+        result.update(line=command.line)
+        result.setdefault('command', command.text if command.argv else '')
+        if command.argv is None:
+            result.update(ok=False, status=1, seconds=0.0)
+            return result
+
+        buffer = cStringIO.StringIO()
+        self.output.capture(buffer)
+        start = time.time()
+        try:
+            response, status = self.run_command(command.argv)
+        except Exception as exc:
+            response, status = None, 1
+            result['error'] = '%s: %s' % (type(exc).__name__, exc)
+        finally:
+            self.output.capture(None)
+        result.update(ok=status == 0, status=status,
+                      seconds=round(time.time() - start, 3))
+        if response is not None:
+            result['result'] = response
+        if buffer.getvalue():
+            result['output'] = buffer.getvalue()
+        return result
+
+
+    def _report(self, result):
+        with self.lock:
+            self.counts['commands'] += 1
+            if not result['ok']:
+                self.counts['failed'] += 1
+            self.stream.write(json.dumps(result, sort_keys=True,
+                                         default=str) + '\n')
+            self.stream.flush()
+
+
+    def run(self, commands):
+        '''Run commands (an iterable of Commands), writing the result of
+        each.  Returns the number that failed.
+
+        '''
+
+        stdout = sys.stdout
+        self.output = _ThreadOutput(sys.stderr)
+        sys.stdout = self.output
+        try:
+            if self.jobs <= 1:
+                for command in commands:
+                    self._report(self._run(command))
+            else:
+                executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+                try:
+                    pending = [executor.submit(self._run, command)
+                               for command in commands]
+                    for future in futures.as_completed(pending):
+                        self._report(future.result())
+                finally:
+                    executor.shutdown()
+        finally:
+            sys.stdout = stdout
+        return self.counts['failed']
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+'''Provisions Buttons in bulk, with AWS IoT bulk thing registration.
+
+Provisioning a Button one call at a time takes four API calls (create the
+Thing, create its certificate, attach the Policy, attach the Thing), so
+onboarding tens of thousands of Buttons runs into AWS IoT's rate limits.
+Bulk registration does them all in one task:
+
+    1. A key pair and certificate signing request (CSR) are generated
+       locally for each Button, with openssl; the private key never
+       leaves certs_dir.
+    2. A line of JSON per Button (its Thing name, serial number, and
+       CSR) is uploaded to S3, and a registration task is started with a
+       provisioning template that creates the Thing, a certificate from
+       the CSR, and attaches the Policy and the Thing to it.
+    3. As AWS IoT registers the Buttons, it writes reports of the
+       results; these are fetched as they appear, and each Button's
+       certificate and its ARN are saved in certs_dir, where riprock's
+       other commands expect them.
+
+Onboarding takes a handful of API calls, however many Buttons there
+are.  Buttons that already have a certificate in certs_dir are skipped,
+so a manifest can be run again after some of its Buttons failed.
+
+Bulk registration needs boto3/botocore recent enough to support
+StartThingRegistrationTask, an S3 bucket for the input file, and an IAM
+role that AWS IoT can assume to read it and register Things (e.g., with
+the AWSIoTThingsRegistration managed policy).
+
+fakeiot.py is a local stand-in for the IoT and S3 APIs used here.
+
+'''
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+from concurrent import futures
+
+from common import makedirs
+
+
+# Statuses of a registration task that has stopped.
+FINISHED_STATUSES = ('Completed', 'Failed', 'Cancelled')
+
+# Seconds between checks on a running registration task.
+POLL_INTERVAL = 5
+
+# Size of the RSA keys generated for Buttons.
+KEY_BITS = 2048
+
+# Prefix of the S3 keys under which input files are uploaded.
+INPUT_PREFIX = 'riprock/bulk/'
+
+
+def registration_template(thing_type_name, policy_name):
+    '''Returns the provisioning template that registers a Button as
+    AWSIoTButton.create_thing(), create_keys_and_certificate(),
+    attach_principal_policy(), and attach_thing_principal() would.
+
+    '''
+
+    return {
+        'Parameters': {
+            'ThingName': {'Type': 'String'},
+            'SerialNumber': {'Type': 'String'},
+            'CSR': {'Type': 'String'},
+        },
+        'Resources': {
+            'thing': {
+                'Type': 'AWS::IoT::Thing',
+                'Properties': {
+                    'ThingName': {'Ref': 'ThingName'},
+                    'ThingTypeName': thing_type_name,
+                    'AttributePayload': {
+                        'serialNumber': {'Ref': 'SerialNumber'},
+                    },
+                },
+            },
+            'certificate': {
+                'Type': 'AWS::IoT::Certificate',
+                'Properties': {
+                    'CertificateSigningRequest': {'Ref': 'CSR'},
+                    'Status': 'ACTIVE',
+                },
+            },
+            'policy': {
+                'Type': 'AWS::IoT::Policy',
+                'Properties': {
+                    'PolicyName': policy_name,
+                },
+            },
+        },
+    }
+
+
+def thing_name_from_arn(arn):
+    # ARNs look like 'arn:aws:iot:us-west-2:123456789012:thing/iotbutton_..'
+    return arn.rsplit('/', 1)[1]
+
+
+class BulkProvisioning(object):
+
+
+    def __init__(self, iotb, bucket, role_arn, s3=None, concurrency=None,
+                 stream=None):
+        '''
+        Args:
+            iotb (AWSIoTButton) - supplies the AWS IoT client, certs_dir,
+                and the names of the Thing Type and security Policy.
+
+            bucket (string) - S3 bucket to which the input file is
+                uploaded.
+
+            role_arn (string) - ARN of the IAM role AWS IoT assumes to
+                read the input file and register the Buttons.
+
+            s3 - S3 client; by default, one from iotb's session.
+
+            concurrency (int) - most keys generated at once; by default,
+                the number of CPUs.
+
+        '''
+        self.iotb = iotb
+        self.iot = iotb.client
+        self.s3 = s3 or iotb.session.client('s3')
+        self.bucket = bucket
+        self.role_arn = role_arn
+        self.concurrency = concurrency or multiprocessing.cpu_count()
+        self.stream = stream or sys.stdout
+        self.provisioned = []
+        self.failed = []
+
+
+    def _log(self, msg):
+        print(msg, file=self.stream)
+        self.stream.flush()
+
+
+    def unprovisioned(self, serial_nums):
+        '''Returns those of serial_nums without a certificate in
+        certs_dir.
+
+        '''
+
+        return [s for s in serial_nums
+                if not os.path.exists(
+                    self.iotb.for_serial_num(s).certificate_arn_pathname)]
+
+
+    def request(self, serial_num):
+        '''Generate, or reuse, the Button's key pair, and returns its
+        line of the input file.
+
+        '''
+
+        button = self.iotb.for_serial_num(serial_num)
+        if not os.path.exists(button.private_key):
+            subprocess.check_call(
+                ['openssl', 'genrsa', '-out', button.private_key,
+                 str(KEY_BITS)],
+                stderr=open(os.devnull, 'w'))
+            subprocess.check_call(
+                ['openssl', 'rsa', '-in', button.private_key, '-pubout',
+                 '-out', button.public_key],
+                stderr=open(os.devnull, 'w'))
+        csr = subprocess.check_output(
+            ['openssl', 'req', '-new', '-key', button.private_key,
+             '-subj', '/CN=%s' % button.thing_name])
+        return dict(ThingName=button.thing_name, SerialNumber=serial_num,
+                    CSR=csr)
+
+
+    def start(self, serial_nums):
+        '''Upload the input file and start the registration task.
+        Returns the task's ID.
+
+        '''
+
+        if not hasattr(self.iot, 'start_thing_registration_task'):
+            msg = ('Bulk registration requires a version of boto3 and '
+                   'botocore that supports StartThingRegistrationTask')
+            raise RuntimeError(msg)
+
+        start = time.time()
+        makedirs(self.iotb.certs_dir, exists_ok=True)
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            lines = list(executor.map(self.request, serial_nums))
+        finally:
+            executor.shutdown()
+        self._log('Generated %d keys and CSRs in %.1fs' % (
+            len(lines), time.time() - start))
+
+        key = '%s%s-%d.json' % (INPUT_PREFIX, time.strftime('%Y%m%d%H%M%S'),
+                                os.getpid())
+        body = ''.join(json.dumps(line, sort_keys=True) + '\n'
+                       for line in lines)
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+        template = registration_template(self.iotb.thing_type_name,
+                                         self.iotb.policy_name)
+        resp = self.iot.start_thing_registration_task(
+            templateBody=json.dumps(template),
+            inputFileBucket=self.bucket,
+            inputFileKey=key,
+            roleArn=self.role_arn)
+        self._log('Started registration task %s for s3://%s/%s' % (
+            resp['taskId'], self.bucket, key))
+        return resp['taskId']
+
+
+    def _report_links(self, task_id, report_type):
+        links = []
+        kwargs = dict(taskId=task_id, reportType=report_type)
+        while True:
+            resp = self.iot.list_thing_registration_task_reports(**kwargs)
+            links.extend(resp.get('resourceLinks', []))
+            if not resp.get('nextToken'):
+                return links
+            kwargs['nextToken'] = resp['nextToken']
+
+
+    def _save_result(self, record):
+        response = record['response']
+        if isinstance(response, basestring):
+            response = json.loads(response)
+        arns = response['ResourceArns']
+        thing_name = thing_name_from_arn(arns['thing'])
+        serial_num = thing_name[len('iotbutton_'):]
+        button = self.iotb.for_serial_num(serial_num)
+        with open(button.certificate, 'wb') as f:
+            f.write(response['CertificatePem'])
+        with open(button.certificate_arn_pathname, 'wb') as f:
+            f.write(arns['certificate'])
+        self.provisioned.append(serial_num)
+
+
+    def collect(self, task_id):
+        '''Save the results of the registration task as they are
+        reported, until it has stopped.  Returns its final description.
+
+        '''
+
+        seen = set()
+        while True:
+            # Check the status first, so reports written before the task
+            # stopped are all fetched below.
+            task = self.iot.describe_thing_registration_task(taskId=task_id)
+            for report_type in ('RESULTS', 'ERRORS'):
+                for link in self._report_links(task_id, report_type):
+                    if link in seen:
+                        continue
+                    seen.add(link)
+                    for line in urllib2.urlopen(link):
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        if report_type == 'RESULTS':
+                            self._save_result(record)
+                        else:
+                            self.failed.append(record)
+                            self._log('line %s failed: %s' % (
+                                record.get('lineNumber'),
+                                record.get('errorMessage')))
+            self._log('%s: %d provisioned, %d failed' % (
+                task['status'], len(self.provisioned), len(self.failed)))
+            if task['status'] in FINISHED_STATUSES:
+                return task
+            time.sleep(POLL_INTERVAL)
+
+
+    def run(self, serial_nums, task_id=None):
+        '''Provision the Buttons serial_nums not already provisioned, or,
+        if task_id is given, collect the results of that earlier task.
+        Returns the number of Buttons that failed.
+
+        '''
+
+        pending = self.unprovisioned(serial_nums)
+        if task_id is None:
+            self._log('%d of %d Buttons already provisioned' % (
+                len(serial_nums) - len(pending), len(serial_nums)))
+            if not pending:
+                return 0
+            task_id = self.start(pending)
+        task = self.collect(task_id)
+        if task['status'] != 'Completed':
+            self._log('Task %s: %s' % (task['status'],
+                                       task.get('message', '')))
+        return len(self.unprovisioned(pending))
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -5,6 +5,9 @@
 import errno
 import logging
 import os
+import sys
+import threading
+import time
 
 from exceptions import RuntimeError
 
@@ -14,6 +17,10 @@ import dotmap
 
 logger = logging.getLogger(__name__)
 
+# Directory holding the Lambda handler's source.
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'lambda')
+
 
 def docopt_plus(doc_string, version_message):
     '''docopt.docopt() returns a dict object.  This converts it to a DotMap
@@ -29,6 +36,47 @@ def docopt_plus(doc_string, version_message):
     return args
 
 
+class DocoptParser(object):
+    '''Parses command lines as docopt_plus() does, but analyzes the usage
+    message only once, rather than on every call.  Analyzing the usage
+    is nearly all of the time docopt takes: about 0.1s for riprock's.
+    Unlike docopt_plus(), it ignores --help and --version, and raises
+    ValueError, rather than exiting, for a line that does not match the
+    usage.  Relies on the internals of docopt 0.6.2.
+
+    '''
+
+    def __init__(self, doc_string):
+        self.usage = docopt.printable_usage(doc_string)
+        self.options = docopt.parse_defaults(doc_string)
+        pattern = docopt.parse_pattern(docopt.formal_usage(self.usage),
+                                       self.options)
+        pattern_options = set(pattern.flat(docopt.Option))
+        for any_options in pattern.flat(docopt.AnyOptions):
+            any_options.children = list(set(docopt.parse_defaults(
+                doc_string)) - pattern_options)
+        self.pattern = pattern.fix()
+
+
+    def parse(self, argv):
+        '''Returns the DotMap of the arguments in argv (a list).'''
+        try:
+            argv = docopt.parse_argv(
+                docopt.TokenStream(argv, docopt.DocoptExit),
+                list(self.options), False)
+        except docopt.DocoptExit as exc:
+            # Its message is followed by the whole usage.
+            raise ValueError, str(exc).split('\n', 1)[0]
+        matched, left, collected = self.pattern.match(argv)
+        if not matched or left:
+            msg = 'Does not match the usage'
+            raise ValueError, msg
+        args = dict((a.name, a.value)
+                    for a in self.pattern.flat() + collected)
+        return dotmap.DotMap({k.replace('-', ''): v
+                              for k, v in args.items()})
+
+
 def makedirs(path, exists_ok=False):
     # Behave similarly to Python 3.2+ os.makedirs()
     try:
@@ -40,6 +88,54 @@ def makedirs(path, exists_ok=False):
     return path
 
 
+def read_manifest(path):
+    '''Returns the serial numbers listed in the manifest file path, one
+    per line.  Blank lines, and anything following a '#', are ignored.
+
+    '''
+
+    serial_nums = []
+    with open(path) as f:
+        for line in f:
+            serial_num = line.split('#', 1)[0].strip()
+            if serial_num and serial_num not in serial_nums:
+                serial_nums.append(serial_num)
+    return serial_nums
+
+
+def import_notifier():
+    '''Returns the Lambda handler's module, lambda/notifier.py, for
+    running it locally.
+
+    '''
+
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    import notifier
+    return notifier
+
+
+class RateLimiter(object):
+    '''Spaces calls to wait(), from any number of threads, so that at
+    most rate of them return per second.
+
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next)
+            self.next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
 
 #;;; Local Variables:
 #;;; mode: python
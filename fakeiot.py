@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Usage:
+    fakeiot provision-bulk [options]
+    fakeiot inventory [options]
+
+Local stand-ins for the AWS IoT and S3 APIs used by bulk.py, so bulk
+provisioning can be tried, and timed, without an AWS account.
+
+    provision-bulk - Provision a number of made-up Buttons in bulk, into
+                     a temporary certs directory, against LocalIoT, and
+                     report how long it took and what it left there.
+
+    inventory      - Register a number of made-up Buttons with LocalIoT,
+                     then time full and incremental refreshes of an
+                     inventory of them (see inventory.py), after changes
+                     to the fleet, and queries of it.
+
+LocalS3 keeps objects in memory.  LocalIoT runs registration tasks in a
+background thread, registering a line of the input file at a time at a
+given rate: it checks the line against the template's parameters,
+refuses Things that already exist, and issues a made-up certificate for
+the line's CSR.  Results are written in report files of a given number
+of lines, as AWS IoT does, and are served as file:// links.
+
+Options:
+    --buttons=N       number of Buttons to provision [default: 50]
+    --rate=N          lines registered per second [default: 200]
+    --report-lines=N  lines per report file [default: 20]
+    --keep            keep the certs directory
+
+'''
+
+from __future__ import print_function
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# Account and region of the ARNs LocalIoT makes up.
+ACCOUNT = '123456789012'
+REGION = 'us-west-2'
+
+
+class LocalS3(object):
+
+
+    def __init__(self):
+        self.objects = {}
+
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+
+    def get_object(self, Bucket, Key):
+        return {'Body': self.objects[(Bucket, Key)]}
+
+
+class LocalIoT(object):
+
+
+    def __init__(self, s3, report_dir, rate=200, report_lines=20):
+        self.s3 = s3
+        self.report_dir = report_dir
+        self.rate = rate
+        self.report_lines = report_lines
+        self.things = {}
+        self.certificates = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+
+    def start_thing_registration_task(self, templateBody, inputFileBucket,
+                                      inputFileKey, roleArn):
+        self.calls += 1
+        task_id = uuid.uuid4().hex
+        task = dict(taskId=task_id, status='InProgress', successCount=0,
+                    failureCount=0, reports={'RESULTS': [], 'ERRORS': []})
+        body = self.s3.get_object(Bucket=inputFileBucket,
+                                  Key=inputFileKey)['Body']
+        self.tasks[task_id] = task
+        thread = threading.Thread(target=self._register,
+                                  args=(task, json.loads(templateBody),
+                                        body.splitlines()))
+        thread.daemon = True
+        thread.start()
+        return {'taskId': task_id}
+
+
+    def _register_line(self, template, params):
+        missing = set(template['Parameters']) - set(params)
+        if missing:
+            raise ValueError('Missing parameters: %s' %
+                             ', '.join(sorted(missing)))
+        thing_name = params['ThingName']
+        resources = template['Resources'].values()
+        thing_type = [r['Properties'].get('ThingTypeName')
+                      for r in resources if r['Type'] == 'AWS::IoT::Thing'][0]
+        policies = [r['Properties']['PolicyName']
+                    for r in resources if r['Type'] == 'AWS::IoT::Policy']
+        with self.lock:
+            if thing_name in self.things:
+                raise ValueError('Thing %s already exists' % thing_name)
+            cert_id = hashlib.sha256(params['CSR']).hexdigest()
+            cert_arn = 'arn:aws:iot:%s:%s:cert/%s' % (REGION, ACCOUNT,
+                                                      cert_id)
+            thing_arn = 'arn:aws:iot:%s:%s:thing/%s' % (REGION, ACCOUNT,
+                                                        thing_name)
+            self.things[thing_name] = dict(
+                thingName=thing_name, thingTypeName=thing_type, version=1,
+                attributes={'serialNumber': params['SerialNumber']},
+                principals=[cert_arn])
+            self.certificates[cert_id] = dict(
+                certificateId=cert_id, certificateArn=cert_arn,
+                status='ACTIVE', creationDate=datetime.datetime.now(UTC),
+                things=[thing_name], policies=policies)
+        pem = ('-----BEGIN CERTIFICATE-----\n%s\n'
+               '-----END CERTIFICATE-----\n' %
+               base64.b64encode(cert_id.decode('hex')))
+        return {'ResourceArns': {'certificate': cert_arn,
+                                 'thing': thing_arn},
+                'CertificatePem': pem}
+
+
+    def _flush(self, task, report_type, records):
+        if not records:
+            return
+        path = os.path.join(self.report_dir, '%s-%s-%d.json' % (
+            task['taskId'], report_type, len(task['reports'][report_type])))
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        task['reports'][report_type].append('file://' + path)
+        del records[:]
+
+
+    def _register(self, task, template, lines):
+        pending = {'RESULTS': [], 'ERRORS': []}
+        offset = 0
+        for number, line in enumerate(lines):
+            time.sleep(1.0 / self.rate)
+            record = dict(lineNumber=number, offset=offset)
+            offset += len(line) + 1
+            try:
+                record['response'] = json.dumps(
+                    self._register_line(template, json.loads(line)))
+                task['successCount'] += 1
+                pending['RESULTS'].append(record)
+            except ValueError as exc:
+                record['errorMessage'] = str(exc)
+                task['failureCount'] += 1
+                pending['ERRORS'].append(record)
+            for report_type, records in pending.items():
+                if len(records) >= self.report_lines:
+                    self._flush(task, report_type, records)
+        for report_type, records in pending.items():
+            self._flush(task, report_type, records)
+        task['status'] = 'Completed'
+
+
+    def describe_thing_registration_task(self, taskId):
+        self.calls += 1
+        task = self.tasks[taskId]
+        return {k: v for k, v in task.items() if k != 'reports'}
+
+
+    def list_thing_registration_task_reports(self, taskId, reportType,
+                                             nextToken=None):
+        self.calls += 1
+        return {'resourceLinks': list(self.tasks[taskId]['reports']
+                                      [reportType]),
+                'reportType': reportType}
+
+
+    def _page(self, items, token, size):
+        '''Returns a page of items, and the token for the next page.'''
+        start = int(token or 0)
+        end = start + size
+        return items[start:end], str(end) if end < len(items) else None
+
+
+    def list_things(self, maxResults=50, nextToken=None, thingTypeName=None,
+                    attributeName=None, attributeValue=None):
+        self.calls += 1
+        with self.lock:
+            things = [dict((k, t[k]) for k in ('thingName', 'thingTypeName',
+                                              'version', 'attributes'))
+                      for _, t in sorted(self.things.items())
+                      if thingTypeName in (None, t['thingTypeName'])]
+        things, token = self._page(things, nextToken, maxResults)
+        return {'things': things, 'nextToken': token}
+
+
+    def list_certificates(self, pageSize=25, marker=None,
+                          ascendingOrder=False):
+        self.calls += 1
+        with self.lock:
+            certs = [dict((k, c[k]) for k in ('certificateId',
+                                              'certificateArn', 'status',
+                                              'creationDate'))
+                     for _, c in sorted(self.certificates.items())]
+        certs, marker = self._page(certs, marker, pageSize)
+        return {'certificates': certs, 'nextMarker': marker}
+
+
+    def _certificate(self, arn):
+        return self.certificates[arn.rsplit('/', 1)[1]]
+
+
+    def list_thing_principals(self, thingName):
+        self.calls += 1
+        with self.lock:
+            return {'principals': list(self.things[thingName]['principals'])}
+
+
+    def list_principal_things(self, principal, maxResults=25,
+                              nextToken=None):
+        self.calls += 1
+        with self.lock:
+            things = list(self._certificate(principal)['things'])
+        things, token = self._page(things, nextToken, maxResults)
+        return {'things': things, 'nextToken': token}
+
+
+    def list_principal_policies(self, principal, pageSize=25, marker=None,
+                                ascendingOrder=False):
+        self.calls += 1
+        with self.lock:
+            policies = [{'policyName': name, 'policyArn':
+                         'arn:aws:iot:%s:%s:policy/%s' % (REGION, ACCOUNT,
+                                                          name)}
+                        for name in self._certificate(principal)['policies']]
+        policies, marker = self._page(policies, marker, pageSize)
+        return {'policies': policies, 'nextMarker': marker}
+
+
+    def update_certificate(self, certificateId, newStatus):
+        self.calls += 1
+        with self.lock:
+            self.certificates[certificateId]['status'] = newStatus
+
+
+    def detach_thing_principal(self, thingName, principal):
+        self.calls += 1
+        with self.lock:
+            self.things[thingName]['principals'].remove(principal)
+            self._certificate(principal)['things'].remove(thingName)
+
+
+class _UTC(datetime.tzinfo):
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+UTC = _UTC()
+
+
+def provision_bulk(args):
+
+    import bulk
+    certs_dir = tempfile.mkdtemp(prefix='riprock-bulk-certs-')
+    report_dir = tempfile.mkdtemp(prefix='riprock-bulk-reports-')
+    s3 = LocalS3()
+    iotb = _local_button(certs_dir, LocalIoT(s3, report_dir,
+                                             float(args.rate),
+                                             int(args.reportlines)))
+
+    serial_nums = ['G030JF%010d' % i for i in range(int(args.buttons))]
+    bulk.POLL_INTERVAL = 0.1
+    provisioning = bulk.BulkProvisioning(iotb, 'bucket', 'arn:role', s3=s3)
+    start = time.time()
+    try:
+        failed = provisioning.run(serial_nums)
+        # Provisioning again skips every Button.
+        provisioning.run(serial_nums)
+        complete = [s for s in serial_nums if all(
+            os.path.exists(p)
+            for p in iotb.for_serial_num(s).certificate_files)]
+        print('%d Buttons provisioned in %.2fs with %d IoT API calls; '
+              '%d failed, %d have a complete set of files in %s' % (
+                  len(serial_nums), time.time() - start, iotb.client.calls,
+                  failed, len(complete), certs_dir))
+    finally:
+        shutil.rmtree(report_dir)
+        if not args.keep:
+            shutil.rmtree(certs_dir)
+
+
+
+def _local_button(certs_dir, iot):
+    from iotbutton import AWSIoTButton
+
+    # AWSIoTButton downloads the root CA unless it is there already, and
+    # creates (unused) clients, which need a region.
+    open(os.path.join(certs_dir, 'aws-iot-rootCA.pem'), 'w').close()
+    os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+    iotb = AWSIoTButton(certs_dir, 'aws-iot-rootCA.pem', None)
+    iotb.client = iot
+    return iotb
+
+
+def inventory(args):
+
+    import bulk
+    from inventory import Inventory
+
+    directory = tempfile.mkdtemp(prefix='riprock-inventory-')
+    iot = LocalIoT(LocalS3(), directory)
+    iotb = _local_button(directory, iot)
+    template = bulk.registration_template(iotb.thing_type_name,
+                                          iotb.policy_name)
+
+    def register(serial_nums):
+        for serial_num in serial_nums:
+            iot._register_line(template, dict(
+                ThingName='iotbutton_%s' % serial_num,
+                SerialNumber=serial_num, CSR='CSR for %s' % serial_num))
+
+    def timed(label, f, *a, **kw):
+        start = time.time()
+        result = f(*a, **kw)
+        print('%-36s %8.1fms' % (label, (time.time() - start) * 1000))
+        return result
+
+    count = int(args.buttons)
+    register('G030JF%010d' % i for i in range(count))
+    fleet = Inventory(iotb, os.path.join(directory, 'inventory.db'),
+                      rate=100000)
+    try:
+        counts = timed('refresh, empty inventory', fleet.refresh)
+        print('    %d IoT API calls' % counts['calls'])
+        counts = timed('refresh, no changes', fleet.refresh)
+        print('    %d IoT API calls' % counts['calls'])
+
+        # Add Buttons, deactivate a certificate, and detach another.
+        register('G030JF%010d' % i for i in range(count, count + 10))
+        certs = sorted(iot.certificates.values(),
+                       key=lambda c: c['certificateId'])
+        iot.update_certificate(certs[0]['certificateId'], 'INACTIVE')
+        iot.detach_thing_principal(certs[1]['things'][0],
+                                   certs[1]['certificateArn'])
+        counts = timed('refresh, 10 new Buttons', fleet.refresh)
+        print('    %d IoT API calls, %d new things' % (
+            counts['calls'], counts['new_things']))
+        counts = timed('refresh, full', fleet.refresh, full=True)
+        print('    %d IoT API calls' % counts['calls'])
+
+        buttons = timed('list all', fleet.buttons)
+        print('    %d Buttons' % len(buttons))
+        buttons = timed('list INACTIVE', fleet.buttons, status='INACTIVE')
+        print('    %s' % [b['serial'] for b in buttons])
+        buttons = timed('list G030JF00000000*', fleet.buttons,
+                        pattern='G030JF00000000*')
+        print('    %d Buttons' % len(buttons))
+        orphans = timed('orphans', fleet.orphans, directory)
+        for kind, items in sorted(orphans.items()):
+            print('    %s: %s' % (kind, items))
+    finally:
+        shutil.rmtree(directory)
+
+
+
+if __name__ == '__main__':
+
+    from common import docopt_plus
+
+    args = docopt_plus(__doc__, 'v 1.0')
+    if args.provisionbulk:
+        provision_bulk(args)
+    elif args.inventory:
+        inventory(args)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
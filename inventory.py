@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+'''Keeps a local inventory of the fleet: the Buttons' Things, the
+account's certificates, and which certificates are attached to which
+Things and Policies.
+
+The inventory is a SQLite database, so listing, filtering, and finding
+orphans take milliseconds rather than a paginated walk of the account.
+It is brought up to date by refresh(), which does as little as it can:
+
+    * Things of the Button Thing Type (listed with list_things, filtered
+      by thingTypeName) and certificates are listed a page of up to 250
+      at a time, which is cheap.
+    * What each certificate is attached to takes two calls per
+      certificate (list_principal_things, list_principal_policies), so
+      these are made only for certificates that are new, or whose
+      attachments were last fetched longer ago than max_age.  Things
+      that are new, or whose version has changed, also have their
+      principals fetched (list_thing_principals), so a certificate
+      attached to a new Button is seen at once.
+
+Attaching or detaching an existing certificate changes neither it nor
+its Thing's version, so such a change is seen within max_age, or at once
+with a full refresh.
+
+'''
+
+from __future__ import print_function
+
+import calendar
+import glob
+import json
+import os
+import sqlite3
+import time
+
+from concurrent import futures
+
+from common import RateLimiter
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS things (
+    name TEXT PRIMARY KEY,
+    serial TEXT,
+    type TEXT,
+    version INTEGER,
+    attributes TEXT
+);
+CREATE INDEX IF NOT EXISTS things_serial ON things (serial);
+CREATE TABLE IF NOT EXISTS certificates (
+    id TEXT PRIMARY KEY,
+    arn TEXT UNIQUE,
+    status TEXT,
+    created REAL,
+    refreshed REAL
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    kind TEXT,
+    principal TEXT,
+    target TEXT,
+    PRIMARY KEY (kind, principal, target)
+);
+CREATE INDEX IF NOT EXISTS attachments_target
+    ON attachments (kind, target, principal);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# Most items AWS IoT returns in a page of list_things and
+# list_certificates.
+PAGE_SIZE = 250
+
+
+class Inventory(object):
+
+
+    def __init__(self, iotb, path, concurrency=8, rate=10, max_age=86400):
+        '''
+        Args:
+            iotb (AWSIoTButton) - supplies the AWS IoT client and the
+                name of the Button Thing Type.
+
+            path (string) - pathname of the SQLite database.
+
+            concurrency (int) - most AWS API calls made at once.
+
+            rate (float) - most AWS API calls made per second.
+
+            max_age (float) - seconds after which a certificate's
+                attachments are fetched again.
+
+        '''
+        self.iotb = iotb
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.max_age = max_age
+        self.calls = 0
+
+
+    def _call(self, operation, **kwargs):
+        self.limiter.wait()
+        self.calls += 1
+        return getattr(self.iotb.client, operation)(**kwargs)
+
+
+    def _pages(self, operation, result_key, token_in, token_out, **kwargs):
+        '''Yields the items of every page of the list operation.'''
+        while True:
+            resp = self._call(operation, **kwargs)
+            for item in resp.get(result_key, []):
+                yield item
+            if not resp.get(token_out):
+                return
+            kwargs[token_in] = resp[token_out]
+
+
+    def _thing_principals(self, name):
+        return ('thing', name,
+                self._call('list_thing_principals',
+                           thingName=name).get('principals', []))
+
+
+    def _certificate_attachments(self, arn):
+        things = list(self._pages('list_principal_things', 'things',
+                                  'nextToken', 'nextToken', principal=arn))
+        policies = [p['policyName'] for p in
+                    self._pages('list_principal_policies', 'policies',
+                                'marker', 'nextMarker', principal=arn)]
+        return ('certificate', arn, (things, policies))
+
+
+    def refresh(self, full=False):
+        '''Bring the inventory up to date; if full, fetch the
+        attachments of every certificate.  Returns a dict of counts of
+        what was found and changed.
+
+        '''
+
+        start = time.time()
+        self.calls = 0
+        db = self.db
+        counts = dict.fromkeys(('things', 'new_things', 'changed_things',
+                                'removed_things', 'certificates',
+                                'new_certificates', 'removed_certificates',
+                                'fetched'), 0)
+
+        things = list(self._pages('list_things', 'things', 'nextToken',
+                                  'nextToken', maxResults=PAGE_SIZE,
+                                  thingTypeName=self.iotb.thing_type_name))
+        certificates = list(self._pages('list_certificates', 'certificates',
+                                        'marker', 'nextMarker',
+                                        pageSize=PAGE_SIZE))
+        counts['things'] = len(things)
+        counts['certificates'] = len(certificates)
+
+        fetch = []
+        known = {row['name']: row['version']
+                 for row in db.execute('SELECT name, version FROM things')}
+        for thing in things:
+            name = thing['thingName']
+            version = known.pop(name, None)
+            if version == thing.get('version'):
+                continue
+            counts['new_things' if version is None
+                   else 'changed_things'] += 1
+            attributes = thing.get('attributes', {})
+            db.execute('INSERT OR REPLACE INTO things VALUES (?, ?, ?, ?, ?)',
+                       (name, attributes.get('serialNumber'),
+                        thing.get('thingTypeName'), thing.get('version'),
+                        json.dumps(attributes)))
+            fetch.append((self._thing_principals, name))
+        for name in known:
+            counts['removed_things'] += 1
+            db.execute('DELETE FROM things WHERE name = ?', (name,))
+            db.execute("DELETE FROM attachments "
+                       "WHERE kind = 'thing' AND target = ?", (name,))
+
+        stale = time.time() - self.max_age
+        known = {row['id']: row for row in
+                 db.execute('SELECT id, refreshed FROM certificates')}
+        for cert in certificates:
+            row = known.pop(cert['certificateId'], None)
+            created = calendar.timegm(cert['creationDate'].utctimetuple())
+            if row is None:
+                counts['new_certificates'] += 1
+                db.execute('INSERT INTO certificates VALUES (?, ?, ?, ?, ?)',
+                           (cert['certificateId'], cert['certificateArn'],
+                            cert['status'], created, None))
+            else:
+                db.execute('UPDATE certificates SET status = ? '
+                           'WHERE id = ?',
+                           (cert['status'], cert['certificateId']))
+            if full or row is None or (row['refreshed'] or 0) < stale:
+                fetch.append((self._certificate_attachments,
+                              cert['certificateArn']))
+        for cert_id in known:
+            counts['removed_certificates'] += 1
+            arn = db.execute('SELECT arn FROM certificates WHERE id = ?',
+                             (cert_id,)).fetchone()['arn']
+            db.execute('DELETE FROM certificates WHERE id = ?', (cert_id,))
+            db.execute('DELETE FROM attachments WHERE principal = ?', (arn,))
+
+        # The calls are made concurrently; the database is only written
+        # from this thread.
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            pending = [executor.submit(f, arg) for f, arg in fetch]
+            for future in futures.as_completed(pending):
+                self._record(*future.result())
+                counts['fetched'] += 1
+        finally:
+            executor.shutdown()
+
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                   ('refreshed', str(time.time())))
+        db.commit()
+        counts['calls'] = self.calls
+        counts['seconds'] = round(time.time() - start, 3)
+        return counts
+
+
+    def _record(self, kind, key, result):
+        db = self.db
+        if kind == 'thing':
+            db.execute("DELETE FROM attachments "
+                       "WHERE kind = 'thing' AND target = ?", (key,))
+            db.executemany("INSERT OR IGNORE INTO attachments "
+                           "VALUES ('thing', ?, ?)",
+                           [(principal, key) for principal in result])
+        else:
+            things, policies = result
+            db.execute('DELETE FROM attachments WHERE principal = ?',
+                       (key,))
+            db.executemany("INSERT OR IGNORE INTO attachments "
+                           "VALUES ('thing', ?, ?)",
+                           [(key, thing) for thing in things])
+            db.executemany("INSERT OR IGNORE INTO attachments "
+                           "VALUES ('policy', ?, ?)",
+                           [(key, policy) for policy in policies])
+            db.execute('UPDATE certificates SET refreshed = ? '
+                       'WHERE arn = ?', (time.time(), key))
+
+
+    def refreshed(self):
+        '''Returns the time of the last refresh, or None.'''
+        row = self.db.execute("SELECT value FROM meta "
+                              "WHERE key = 'refreshed'").fetchone()
+        return float(row['value']) if row else None
+
+
+    def buttons(self, pattern=None, status=None):
+        '''Returns a list of dicts describing each Button whose serial
+        number matches the shell-style pattern, and, if status is given,
+        that has a certificate with that status ('none' for Buttons with
+        no certificate).
+
+        '''
+
+        things = self.db.execute('SELECT name, serial FROM things '
+                                 'WHERE serial GLOB ? ORDER BY serial',
+                                 (pattern or '*',)).fetchall()
+        certificates = {}
+        for row in self.db.execute(
+                "SELECT a.target, c.id, c.arn, c.status, c.created, "
+                "       (SELECT group_concat(p.target) FROM attachments p "
+                "        WHERE p.kind = 'policy' AND p.principal = c.arn) "
+                "       AS policies "
+                "FROM things t "
+                "     JOIN attachments a ON a.kind = 'thing' "
+                "                        AND a.target = t.name "
+                "     JOIN certificates c ON c.arn = a.principal "
+                "WHERE t.serial GLOB ? ORDER BY c.created",
+                (pattern or '*',)):
+            policies = row['policies'].split(',') if row['policies'] else []
+            certificates.setdefault(row['target'], []).append(dict(
+                id=row['id'], status=row['status'], created=row['created'],
+                policies=policies))
+
+        buttons = []
+        for thing in things:
+            certs = certificates.get(thing['name'], [])
+            if status and not (
+                    status.lower() == 'none' and not certs or
+                    any(c['status'] == status.upper() for c in certs)):
+                continue
+            buttons.append(dict(serial=thing['serial'], thing=thing['name'],
+                                certificates=certs))
+        return buttons
+
+
+    def format_button(self, button):
+        '''Returns a line describing a Button returned by buttons().'''
+        certs = ['%s %s (%s)' % (c['id'][:12], c['status'],
+                                 ', '.join(c['policies']) or 'no policy')
+                 for c in button['certificates']]
+        return '%-20s %s' % (button['serial'],
+                             '; '.join(certs) or 'no certificate')
+
+
+    def orphans(self, certs_dir=None):
+        '''Returns a dict of lists of what is left over or incomplete:
+
+            certificates_without_things - IDs of certificates attached to
+                no Thing.
+            things_without_certificates - names of Things with no ACTIVE
+                certificate.
+            certificates_without_policies - IDs of ACTIVE certificates
+                with no Policy, which cannot connect.
+            local_certificates - serial numbers of Buttons whose
+                certificate in certs_dir is not in the account.
+
+        '''
+
+        db = self.db
+        column = lambda sql: [row[0] for row in db.execute(sql)]
+        orphans = {}
+        orphans['certificates_without_things'] = column(
+            "SELECT id FROM certificates c WHERE NOT EXISTS "
+            "(SELECT 1 FROM attachments a "
+            " WHERE a.kind = 'thing' AND a.principal = c.arn) "
+            "ORDER BY id")
+        orphans['things_without_certificates'] = column(
+            "SELECT name FROM things t WHERE NOT EXISTS "
+            "(SELECT 1 FROM attachments a JOIN certificates c "
+            " ON c.arn = a.principal "
+            " WHERE a.kind = 'thing' AND a.target = t.name "
+            " AND c.status = 'ACTIVE') "
+            "ORDER BY name")
+        orphans['certificates_without_policies'] = column(
+            "SELECT id FROM certificates c WHERE c.status = 'ACTIVE' "
+            "AND NOT EXISTS (SELECT 1 FROM attachments a "
+            " WHERE a.kind = 'policy' AND a.principal = c.arn) "
+            "ORDER BY id")
+        local = []
+        if certs_dir:
+            for path in sorted(glob.glob(os.path.join(certs_dir,
+                                                      '*-arn.txt'))):
+                with open(path) as f:
+                    arn = f.read().strip()
+                if not db.execute('SELECT 1 FROM certificates '
+                                  'WHERE arn = ?', (arn,)).fetchone():
+                    local.append(os.path.basename(path)[:-len('-arn.txt')])
+        orphans['local_certificates'] = local
+        return orphans
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
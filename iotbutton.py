@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
+import copy
 import json
 import logging
 import os
@@ -14,10 +15,26 @@ import boto3
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
 import common
+from spool import Drainer
 
 
 logger = None
 
+# Click types a Button sends, and the form of its battery voltage.
+CLICK_TYPES = ('SINGLE', 'DOUBLE', 'LONG')
+VOLTAGE_RE = re.compile(r'(?i)^\d{4}mV$')
+
+
+def validate_click(click_type, voltage):
+    '''Raise ValueError unless click_type and voltage are as a Button
+    would send them.
+
+    '''
+
+    if click_type not in CLICK_TYPES or not VOLTAGE_RE.match(voltage):
+        msg = 'Invalid click %r, voltage %r' % (click_type, voltage)
+        raise ValueError, msg
+
 
 class AWSIoTButton(object):
 
@@ -44,7 +61,8 @@ class AWSIoTButton(object):
     _endpoint = None
 
 
-    def __init__(self, certs_dir, rootCA_filename, profile_name, serial_num=None):
+    def __init__(self, certs_dir, rootCA_filename, profile_name, serial_num=None,
+                 stats=None):
         '''
         Args:
             certs_dir (string) - pathname to a directory in which to store
@@ -53,11 +71,16 @@ class AWSIoTButton(object):
             rootCA_filename (string) - filename in which to store the root
                 CA for AWS IoT.  The file is stored in certs_dir.
 
+            stats (apistats.APIStats) - if given, records the AWS API
+                calls made.
+
         '''
         self.certs_dir = os.path.expanduser(certs_dir)
         self.rootCA_pathname = os.path.join(self.certs_dir, rootCA_filename)
         self._ensure_rootCA()
         self.session = boto3.Session(profile_name=profile_name)
+        if stats is not None:
+            stats.instrument(self.session)
         self.client = self.session.client('iot')
         self.lambda_client = self.session.client('lambda')
         self.serial_num = serial_num
@@ -211,7 +234,7 @@ class AWSIoTButton(object):
 
     def one_shot(self, serial_num):
         resp1 = self.create_thing(serial_num)
-        resp2 = self.create_keys_and_certificates(serial_num)
+        resp2 = self.create_keys_and_certificate(serial_num)
         resp3 = self.attach_principal_policy(serial_num)
         resp4 = self.attach_thing_principal(serial_num)
         return (resp1, resp2, resp3, resp4)
@@ -242,28 +265,74 @@ class AWSIoTButton(object):
         myMQTTClient.configureCredentials(self.rootCA_pathname,
                                           self.private_key,
                                           self.certificate)
-        myMQTTClient.configureOfflinePublishQueueing(-1)
-        myMQTTClient.configureDrainingFrequency(2)
+        # Messages that cannot be published are kept in a Spool (see
+        # spool.py), not in the SDK's unbounded, in-memory queue.
+        myMQTTClient.configureOfflinePublishQueueing(0)
         myMQTTClient.configureConnectDisconnectTimeout(10)
         myMQTTClient.configureMQTTOperationTimeout(5)
         return myMQTTClient
 
 
-    def click(self, serial_num, click_type, voltage='9999mV'):
+    def click(self, serial_num, click_type, voltage='9999mV', spool=None,
+              drain_rate=20):
+        '''Publish a click.  If spool (a spool.Spool) is given, the click
+        is spooled, and then it and any clicks spooled earlier are
+        published, at most drain_rate per second, until the spool is
+        empty or publishing fails; those not published stay spooled for
+        the next time.  Returns the Drainer's stats, or None.
+
+        Nothing drains the spool while the click is being spooled, so if
+        it is full and its overflow policy is 'block', SpoolFull is
+        raised rather than waiting for room that would never be made.
+
+        '''
+
         self.serial_num = serial_num
-        if (click_type not in ['SINGLE', 'DOUBLE', 'LONG'] or 
-            not re.match(r'(?i)^\d{4}mV$', voltage)):
-           raise ValueError
-        mqtt_client = self._init_mqtt_client()
+        validate_click(click_type, voltage)
         payload = self.payload(click_type=click_type, voltage=voltage)
-        mqtt_client.connect()
-        mqtt_client.publish(self.topic, payload, 0)
-        mqtt_client.disconnect()
+        if spool is None:
+            mqtt_client = self._init_mqtt_client()
+            mqtt_client.connect()
+            mqtt_client.publish(self.topic, payload, 0)
+            mqtt_client.disconnect()
+            return None
+
+        spool.put(self.topic, payload, timeout=0)
+        publisher = Publisher(self)
+        drainer = Drainer(spool, publisher, rate=drain_rate)
+        try:
+            drainer.drain(timeout=0)
+        finally:
+            publisher.close()
+        return drainer.stats()
 
 
     def set_serial_num(self, serial_num):
         self.serial_num = serial_num
 
+
+    def for_serial_num(self, serial_num):
+        '''Returns a copy of this object for the Button serial_num,
+        sharing its AWS clients.  Unlike set_serial_num(), this lets
+        several Buttons be worked on at once, from different threads.
+
+        '''
+
+        button = copy.copy(self)
+        button.serial_num = serial_num
+        return button
+
+
+    @property
+    def certificate_files(self):
+        '''Returns the pathnames of the files holding this Button's
+        certificate, its keys, and its ARN.
+
+        '''
+
+        return [self.certificate, self.private_key, self.public_key,
+                self.certificate_arn_pathname]
+
             
     def create_topic_rule(self, serial_num):
         pdb.set_trace()
@@ -287,7 +356,41 @@ class AWSIoTButton(object):
         return resp
 
 
-    
+class Publisher(object):
+    '''Publishes messages over one MQTT connection, connecting, or
+    reconnecting after a failure, when needed.  Used by a spool.Drainer.
+
+    '''
+
+    def __init__(self, iotb):
+        self.iotb = iotb
+        self.client = None
+
+
+    def __call__(self, topic, payload):
+        if self.client is None:
+            client = self.iotb._init_mqtt_client()
+            client.connect()
+            self.client = client
+        try:
+            # At QoS 1, so publish() returns only once the broker has
+            # acknowledged the message, and the Drainer only then removes
+            # it from the spool.
+            return self.client.publish(topic, payload, 1)
+        except Exception:
+            self.close()
+            raise
+
+
+    def close(self):
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
 
 #;;; Local Variables:
 #;;; mode: python
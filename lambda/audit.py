@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+'''Buffered audit trail of events and notification outcomes.
+
+Every event the handler receives, and the outcome of every notification
+it sends, is added to an AuditLog as a record (a dict).  Records are
+only buffered in memory, so adding one costs the emergency path nothing;
+the buffer is written to S3 after the notifications have been sent, and
+only once it holds max_records records or max_bytes bytes, or its
+oldest record is max_seconds old.  A warm container therefore batches
+the records of many invocations into a few objects.
+
+Records are written as gzipped JSON, one record per line, under a key
+partitioned by the UTC date of the record and the serial number of the
+button it concerns:
+
+    <prefix>date=2017-06-01/serial=G030JF055364XVRB/<time>-<id>.ndjson.gz
+
+so the trail of one button on one day can be listed directly, and tools
+such as Athena can query it with date and serial as partitions.
+
+A flush may be limited to a number of objects, so that writing a
+backlog does not hold up the invocation that happens to flush it; the
+records of the objects not written stay buffered, oldest first.
+
+A write that fails keeps its records in the buffer for the next flush,
+up to MAX_BUFFERED_RECORDS; beyond that the oldest are dropped, so an
+unreachable bucket cannot exhaust the container's memory.  Audit
+failures are printed, never raised: the handler has already notified,
+and failing it would make Lambda retry the event.
+
+'''
+
+from __future__ import print_function
+
+import gzip
+import io
+import json
+import threading
+import time
+import uuid
+
+
+# Default thresholds at which the buffer is written.
+DEFAULT_MAX_RECORDS = 500
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_MAX_SECONDS = 60
+
+DEFAULT_PREFIX = 'audit/'
+
+# Most records kept while writes are failing.
+MAX_BUFFERED_RECORDS = 10000
+
+# Identifies this container in the keys it writes, so that containers
+# flushing at the same moment do not overwrite each other's objects.
+_CONTAINER_ID = uuid.uuid4().hex[:12]
+
+
+def object_key(prefix, date, serial, written, sequence):
+    return '%sdate=%s/serial=%s/%s-%s-%d.ndjson.gz' % (
+        prefix, date, serial or 'unknown',
+        time.strftime('%H%M%S', time.gmtime(written)), _CONTAINER_ID,
+        sequence)
+
+
+class AuditLog(object):
+
+
+    def __init__(self, s3, bucket, prefix=DEFAULT_PREFIX,
+                 max_records=DEFAULT_MAX_RECORDS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_seconds=DEFAULT_MAX_SECONDS):
+        '''
+        Args:
+            s3 - S3 client with which the records are written.
+
+            bucket (string) - the S3 bucket to write them to.
+
+            prefix (string) - prefix of the keys written.
+
+            max_records, max_bytes, max_seconds - the buffer is written
+                once it holds this many records, or this many bytes of
+                them (before compression), or its oldest record is this
+                many seconds old.
+
+        '''
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        # (time, serial, line) of each buffered record, oldest first.
+        self.records = []
+        self.size = 0
+        self.sequence = 0
+        self.written = 0
+        self.dropped = 0
+
+
+    def add(self, record, serial=None):
+        '''Buffer a record concerning the button serial.  The record's
+        'time' is set to now unless it has one.
+
+        '''
+
+        record.setdefault('time', time.time())
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self.lock:
+            self.records.append((record['time'], serial, line))
+            self.size += len(line)
+
+
+    def due(self):
+        '''Returns whether the buffer has reached a threshold.'''
+        with self.lock:
+            return bool(self.records) and (
+                len(self.records) >= self.max_records or
+                self.size >= self.max_bytes or
+                time.time() - self.records[0][0] >= self.max_seconds)
+
+
+    def flush(self, max_groups=None):
+        '''Write the buffered records, one object per date and serial
+        number, those with the oldest records first.  If max_groups is
+        given, at most that many objects are written, and the records of
+        the rest stay buffered.  Returns the number of records written.
+
+        '''
+
+        with self.lock:
+            records, self.records, self.size = self.records, [], 0
+        if not records:
+            return 0
+
+        groups = {}
+        for record in records:
+            date = time.strftime('%Y-%m-%d', time.gmtime(record[0]))
+            groups.setdefault((date, record[1]), []).append(record)
+
+        groups = sorted(groups.items(), key=lambda item: item[1][0][0])
+        failed = []
+        if max_groups is not None:
+            for _, group in groups[max_groups:]:
+                failed.extend(group)
+            del groups[max_groups:]
+        for (date, serial), group in groups:
+            with self.lock:
+                self.sequence += 1
+                sequence = self.sequence
+            body = io.BytesIO()
+            with gzip.GzipFile(fileobj=body, mode='wb') as f:
+                f.write(''.join(line for _, _, line in group))
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=object_key(self.prefix, date, serial, time.time(),
+                                   sequence),
+                    Body=body.getvalue(),
+                    ContentType='application/x-ndjson',
+                    ContentEncoding='gzip')
+            except Exception as exc:
+                print('Audit write to %s failed: %s' % (self.bucket, exc))
+                failed.extend(group)
+
+        with self.lock:
+            if failed:
+                failed.sort(key=lambda record: record[0])
+                self.records[:0] = failed
+                self.size += sum(len(line) for _, _, line in failed)
+                excess = len(self.records) - MAX_BUFFERED_RECORDS
+                if excess > 0:
+                    self.size -= sum(len(line) for _, _, line
+                                     in self.records[:excess])
+                    del self.records[:excess]
+                    self.dropped += excess
+            self.written += len(records) - len(failed)
+        return len(records) - len(failed)
+
+
+    def flush_if_due(self):
+        '''Write the buffered records if a threshold has been reached.
+        Returns the number of records written.
+
+        '''
+
+        return self.flush() if self.due() else 0
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Usage:
+    benchmark keepalive [options]
+    benchmark twiml [options]
+    benchmark coldstart [options]
+    benchmark routing [options]
+    benchmark snapshot [options]
+    benchmark senders [options]
+    benchmark bulksms [options]
+
+Benchmarks for notifier.py, run against a local fake Twilio API (see
+faketwilio.py).  Nothing is sent to AWS or Twilio.  The notifier config
+used is ./notifier.yml, with its Twilio settings pointed at the fake.
+
+    keepalive - Measure per-notification latency with Twilio connection
+                pooling off and on.  Each invocation constructs a new
+                Notifier, as lambda_handler() does in a warm container,
+                and sends every configured voice and SMS notification.
+
+    twiml     - Measure voice call setup latency -- from the start of the
+                call request until Twilio has the TwiML to speak -- with
+                the TwiML passed inline and fetched via twimlets.com.
+
+    coldstart - Measure the handler's cold start: the time taken by a new
+                interpreter to import notifier.py (as Lambda does when it
+                initializes a container), broken down by the modules
+                notifier.py imports.  With --package, the Deployment
+                Package built by 'helper.py package' is measured instead
+                of the source directory.  Bytecode is not written, since
+                Lambda cannot write it either.
+
+    routing   - Measure the time to compile the button routes of a config
+                covering --buttons buttons, half routed by serial number
+                and half by group, and to resolve a button's profile.
+
+    snapshot  - Measure the time to load the config file, with as many
+                buttons routed as for 'routing', from its YAML and from
+                the compiled snapshot that 'notifier.py config upload'
+                stores alongside it.
+
+    senders   - Measure the time to text many recipients at once when
+                the fake Twilio API allows each source number only a
+                limited rate of messages, answering others with 429:
+                from one number without rate limiting, from one number
+                with it, and from a pool of numbers with it (see
+                senders.py).
+
+    bulksms   - Measure the time to text --messages recipients with one
+                request per recipient, and with one Twilio Notify
+                request for all of them (twilio.notify_service_sid),
+                over cold and over kept-alive connections.
+
+Options:
+    --invocations=N    number of warm invocations to run [default: 50]
+    --handshake=MS     simulated connection setup time [default: 30]
+    --latency=MS       simulated API response time [default: 5]
+    --fetch=MS         simulated time to fetch TwiML from twimlets.com
+                       [default: 150]
+    --config=PATH      notifier config to use [default: notifier.yml]
+    --runs=N           number of cold starts to measure [default: 10]
+    --package=ZIP      Deployment Package to measure
+    --buttons=N        number of buttons routed [default: 20000]
+    --messages=N       number of recipients texted [default: 20]
+    --numbers=N        number of source numbers in the pool [default: 5]
+    --sms-rate=N       messages per second Twilio allows each source
+                       number [default: 1]
+    --sms-burst=N      messages Twilio allows each source number at once
+                       [default: 5]
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from faketwilio import FakeTwilioServer
+
+import notifier
+
+
+# Config() insists on these, although the benchmarks never touch S3.
+os.environ.setdefault('BUCKET_NAME', 'benchmark')
+os.environ.setdefault('KEY_NAME', 'benchmark')
+
+EVENT = {
+    'serialNumber': 'G030JF055364XVRB',
+    'clickType': 'SINGLE',
+    'batteryVoltage': '1975 mV',
+}
+
+
+# Run by a new interpreter to time 'import notifier'.  Prints a JSON
+# object with the total time and the time taken by each module that
+# notifier.py imports directly (including whatever those import).
+IMPORT_TIMER = '''
+import __builtin__, json, time
+_import = __builtin__.__import__
+depth = [0]
+imports = {}
+def timed_import(name, *args, **kwargs):
+    depth[0] += 1
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        if depth[0] == 1 and name not in imports:
+            imports[name] = time.time() - start
+__builtin__.__import__ = timed_import
+start = time.time()
+import notifier
+total = time.time() - start
+__builtin__.__import__ = _import
+print(json.dumps(dict(total=total, imports=imports)))
+'''
+
+
+def percentile(samples, pct):
+    '''Returns the pct'th percentile of a list of samples.'''
+    samples = sorted(samples)
+    index = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def summarize(label, samples):
+    '''Print count, mean, p50, and p99 (in milliseconds) of samples,
+    which are durations in seconds.
+
+    '''
+
+    ms = [s * 1000 for s in samples]
+    print('%-36s n=%-5d mean=%7.2fms  p50=%7.2fms  p99=%7.2fms' % (
+        label, len(ms), sum(ms) / len(ms),
+        percentile(ms, 50), percentile(ms, 99)))
+
+
+def load_config(path, server):
+    '''Returns a Config loaded from the local file at path, with Twilio
+    pointed at the fake server.
+
+    '''
+
+    config = notifier.Config()
+    config.load(aws_profile_name=None, filepath=path)
+    config.config.twilio.base_url = server.base_url
+    return config
+
+
+def reset_clients():
+    '''Forget cached Twilio clients and connections, as in a cold
+    container.
+
+    '''
+
+    notifier._twilio_clients.clear()
+    notifier._http_pool.clear()
+
+
+def timed_notifications(config, invocations):
+    '''Run invocations warm invocations, returning a list of the
+    duration of each individual notification.
+
+    '''
+
+    samples = []
+    for _ in range(invocations):
+        n = notifier.Notifier(EVENT, None, config)
+        for number in n.profile.voice_numbers:
+            start = time.time()
+            n.notify_voice(number)
+            samples.append(time.time() - start)
+        for number in n.profile.sms_numbers:
+            start = time.time()
+            n.notify_sms(number)
+            samples.append(time.time() - start)
+    return samples
+
+
+def start_server(args):
+    server = FakeTwilioServer(handshake=float(args.handshake) / 1000,
+                              latency=float(args.latency) / 1000,
+                              fetch=float(args.fetch) / 1000).start()
+    print('Fake Twilio: handshake=%sms latency=%sms fetch=%sms' % (
+        args.handshake, args.latency, args.fetch))
+    return server
+
+
+def bench_keepalive(args):
+
+    server = start_server(args)
+    config = load_config(args.config, server)
+
+    for keep_alive in (False, True):
+        reset_clients()
+        server.reset()
+        config.config.twilio.keep_alive = keep_alive
+        samples = timed_notifications(config, int(args.invocations))
+        summarize('keep_alive=%s' % keep_alive, samples)
+        print('%36s connections=%d auth challenges=%d' % (
+            '', server.counts['connections'], server.counts['challenges']))
+
+    reset_clients()
+    server.stop()
+
+
+def bench_twiml(args):
+
+    server = start_server(args)
+    config = load_config(args.config, server)
+
+    for inline_twiml in (False, True):
+        server.reset()
+        config.config.twilio.inline_twiml = inline_twiml
+        create, setup = [], []
+        for _ in range(int(args.invocations)):
+            n = notifier.Notifier(EVENT, None, config)
+            for number in n.profile.voice_numbers:
+                start = time.time()
+                sid = n.notify_voice(number)
+                create.append(time.time() - start)
+                while sid not in server.call_ready:
+                    time.sleep(0.001)
+                setup.append(server.call_ready[sid] - start)
+        summarize('inline_twiml=%s create' % inline_twiml, create)
+        summarize('inline_twiml=%s setup' % inline_twiml, setup)
+
+    reset_clients()
+    server.stop()
+
+
+def cold_starts(directory, runs):
+    '''Returns (process, total, imports): lists of the wall time of each
+    new interpreter, of its import of notifier, and a dict mapping each
+    module imported by notifier to a list of its import times.
+
+    '''
+
+    process, total, imports = [], [], {}
+    for _ in range(runs):
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable, '-B', '-c', IMPORT_TIMER], cwd=directory)
+        process.append(time.time() - start)
+        timings = json.loads(output.splitlines()[-1])
+        total.append(timings['total'])
+        for name, seconds in timings['imports'].items():
+            imports.setdefault(name, []).append(seconds)
+    return process, total, imports
+
+
+def bench_coldstart(args):
+
+    directory = '.'
+    if args.package:
+        directory = tempfile.mkdtemp(prefix='notifier-coldstart-')
+        zipfile.ZipFile(args.package).extractall(directory)
+        print('%s: %d bytes' % (args.package, os.path.getsize(args.package)))
+
+    try:
+        process, total, imports = cold_starts(directory, int(args.runs))
+    finally:
+        if args.package:
+            shutil.rmtree(directory)
+
+    summarize('interpreter + init', process)
+    summarize('init (import notifier)', total)
+    for name, samples in sorted(imports.items(),
+                                key=lambda i: -percentile(i[1], 50)):
+        summarize('  import %s' % name, samples)
+
+
+def routing_config(buttons):
+    '''Returns the notifier section of a config routing the given
+    number of buttons, ten to a profile.
+
+    '''
+
+    profiles, groups = {}, {}
+    for i in range(0, buttons, 10):
+        serials = ['G030JF%010d' % j for j in range(i, min(i + 10, buttons))]
+        profile = dict(person=dict(name='Person %d' % i, address='', age='',
+                                   sex=''),
+                       voice_numbers=['+1555%07d' % i],
+                       sms_numbers=['+1555%07d' % i, '+1556%07d' % i])
+        if (i / 10) % 2:
+            groups['group-%d' % i] = serials
+            profile['groups'] = ['group-%d' % i]
+        else:
+            profile['serials'] = serials
+        profiles['profile-%d' % i] = profile
+    return dict(profiles=profiles, groups=groups)
+
+
+def bench_routing(args):
+
+    buttons = int(args.buttons)
+    cfg = notifier.DotMap(routing_config(buttons))
+    cfg.update(voice_message='', sms_message='')
+    build = []
+    for _ in range(int(args.runs)):
+        start = time.time()
+        routes = notifier.routing.Routes(cfg)
+        build.append(time.time() - start)
+    summarize('compile %d buttons' % buttons, build)
+
+    serials = ['G030JF%010d' % (i * 7919 % buttons) for i in range(10000)]
+    start = time.time()
+    for serial in serials:
+        routes.resolve(serial)
+    elapsed = time.time() - start
+    print('%-36s %.3fus per lookup' % ('resolve',
+                                        elapsed * 1e6 / len(serials)))
+
+
+def bench_snapshot(args):
+
+    import yaml
+
+    buttons = int(args.buttons)
+    with open(args.config) as f:
+        cfg = yaml.load(f)
+    cfg['notifier'].update(routing_config(buttons))
+    source = yaml.safe_dump(cfg)
+    config = notifier.Config()
+    config._compile(source)
+    snapshot = config.snapshot()
+    print('%d buttons: YAML %d bytes, snapshot %d bytes' % (
+        buttons, len(source), len(snapshot)))
+
+    for label, load, data in (('YAML', config._compile, source),
+                              ('snapshot', config._load_snapshot, snapshot)):
+        samples = []
+        for _ in range(int(args.runs)):
+            start = time.time()
+            load(data)
+            samples.append(time.time() - start)
+        summarize('load from %s' % label, samples)
+
+
+def bench_senders(args):
+
+    server = FakeTwilioServer(latency=float(args.latency) / 1000,
+                              sms_rate=float(args.smsrate),
+                              sms_burst=int(args.smsburst)).start()
+    print('Fake Twilio: latency=%sms, %s messages/s per number, '
+          'bursts of %s' % (args.latency, args.smsrate, args.smsburst))
+    config = load_config(args.config, server)
+    config.routes.default.sms_numbers = [
+        '+1555%07d' % i for i in range(int(args.messages))]
+    pool = ['+1444%07d' % i for i in range(int(args.numbers))]
+
+    for label, numbers, limited in (('1 number, unlimited', pool[:1], False),
+                                    ('1 number, limited', pool[:1], True),
+                                    ('%d numbers, limited' % len(pool), pool,
+                                     True)):
+        server.reset()
+        notifier._sender_pools.clear()
+        twilio = config.config.twilio
+        twilio.source_numbers = numbers
+        twilio.sms_per_second = float(args.smsrate) if limited else 1e6
+        twilio.sms_burst = int(args.smsburst) if limited else 1e6
+        n = notifier.Notifier(EVENT, None, config)
+        start = time.time()
+        results = n.notify(kinds=('sms',))
+        elapsed = time.time() - start
+        print('%-36s %6.2fs  sent=%d failed=%d 429s=%d' % (
+            label, elapsed, len([r for r in results if r['ok']]),
+            len([r for r in results if not r['ok']]),
+            server.counts['throttled']))
+
+    reset_clients()
+    server.stop()
+
+
+def bench_bulksms(args):
+
+    server = start_server(args)
+    config = load_config(args.config, server)
+    config.routes.default.sms_numbers = [
+        '+1555%07d' % i for i in range(int(args.messages))]
+    twilio = config.config.twilio
+    twilio.notify_base_url = server.base_url
+    print('Texting %s recipients' % args.messages)
+
+    for label, service_sid in (('individual', None),
+                               ('bulk', 'IS%032d' % 0)):
+        if service_sid:
+            twilio.notify_service_sid = service_sid
+        for warm in (False, True):
+            reset_clients()
+            server.reset()
+            samples = []
+            for _ in range(int(args.invocations)):
+                if not warm:
+                    reset_clients()
+                n = notifier.Notifier(EVENT, None, config)
+                start = time.time()
+                results = n.notify(kinds=('sms',))
+                samples.append(time.time() - start)
+                assert all(r['ok'] for r in results), results
+            summarize('%s, %s' % (label, 'warm' if warm else 'cold'),
+                      samples)
+            print('    requests=%d connections=%d' % (
+                server.counts['messages'] + server.counts['notifications'],
+                server.counts['connections']))
+
+    reset_clients()
+    server.stop()
+
+
+
+if __name__ == '__main__':
+
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    args = {k.replace('-', '') : args[k] for k in args.keys()}
+    args = notifier.DotMap(args)
+
+    if args.keepalive:
+        bench_keepalive(args)
+    elif args.twiml:
+        bench_twiml(args)
+    elif args.coldstart:
+        bench_coldstart(args)
+    elif args.routing:
+        bench_routing(args)
+    elif args.snapshot:
+        bench_snapshot(args)
+    elif args.senders:
+        bench_senders(args)
+    elif args.bulksms:
+        bench_bulksms(args)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
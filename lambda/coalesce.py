@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+
+'''Coalesces bursts of clicks from the same IoT Button.
+
+A frightened person may press the button several times in quick
+succession.  Without coalescing, every press invokes the handler and
+every press calls and texts every recipient again.  With coalescing,
+the first press opens a window of notifier.coalesce.window_seconds for
+that button's serial number and is notified as usual.  Later presses
+within the window are only counted.  Once the window has closed, one
+summary message ("pressed 5 times, last LONG") is sent for all of them.
+
+Summaries are sent by whichever comes first: the button's next press
+after the window has closed, or a scheduled flush invocation of the
+handler (see 'helper.py create-schedule').
+
+Lambda retries a failed invocation with the same event.  Each window
+records the identity of the event that opened it, so a retry of that
+event is notified again (see ledger.py) rather than counted as another
+click.
+
+A summary is only forgotten once it has been sent.  When a press
+replaces a closed window, the summaries owed for it (and any the window
+itself still carried) are kept in the new window's 'pending' list until
+the invocation that opened it has sent them, so a retry of that event
+sends them again.  A flush claims the windows it summarizes, and takes
+the pending summaries of closed windows; those whose summaries fail are
+released (see Coalescer.release()) to be sent by a later flush.
+
+Window state has to be shared by every concurrent invocation of the
+handler, so it is kept in a DynamoDB table (DynamoStore) whose
+conditional writes guarantee that exactly one invocation notifies for a
+window and exactly one sends its summary.  MemoryStore is a stand-in
+for local testing; under Lambda it only sees clicks that land in the
+same container.
+
+'''
+
+import threading
+import time
+
+import boto3
+
+from botocore.exceptions import ClientError
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def _plain(item):
+    '''Returns a copy of a DynamoDB item with Decimal numbers converted
+    to int.
+
+    '''
+
+    if item is None:
+        return None
+    plain = dict((k, int(v) if k in ('window_start', 'clicks') else v)
+                 for k, v in item.items())
+    if 'pending' in plain:
+        plain['pending'] = [_plain(summary) for summary in plain['pending']]
+    return plain
+
+
+def summary_of(window):
+    '''Returns what a summary of window needs to be sent.'''
+    return dict((k, window[k])
+                for k in ('serialNumber', 'window_start', 'clicks',
+                          'last_click'))
+
+
+def owed(previous):
+    '''Returns the summaries owed when previous, a closed window (or
+    None), is replaced: those it still carried, and its own if it
+    counted more than one click and has not been summarized.
+
+    '''
+
+    if previous is None:
+        return []
+    pending = list(previous.get('pending', []))
+    if previous['clicks'] > 1 and not previous['summarized']:
+        pending.append(summary_of(previous))
+    return pending
+
+
+def _conditional_failure(exc):
+    return exc.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class DynamoStore(object):
+    '''Click windows, one item per serial number, in a DynamoDB table
+    whose hash key is the string 'serialNumber'.
+
+    '''
+
+    def __init__(self, table_name, session=None):
+        self.table = (session or boto3).resource('dynamodb').Table(table_name)
+
+
+    def start_window(self, serial, start, cutoff, click, event_id):
+        '''Open a new window for serial, first_event event_id, unless one
+        opened at or after cutoff is still open.  The new window's
+        'pending' holds the summaries owed for the window it replaces
+        (see owed()).  Returns (window, previous) if a window was
+        opened, where previous is the closed window it replaced, if
+        any; otherwise returns (None, None).
+
+        '''
+
+        previous = self.get(serial)
+        if previous and previous['window_start'] >= cutoff:
+            return None, None
+        item = dict(serialNumber=serial, window_start=start, clicks=1,
+                    last_click=click, summarized=False, first_event=event_id)
+        pending = owed(previous)
+        if pending:
+            item['pending'] = pending
+
+        # The window replaced must be as read, or the summaries owed for
+        # it may be wrong.
+        kwargs = dict(
+            ConditionExpression='attribute_not_exists(serialNumber)')
+        if previous:
+            kwargs = dict(
+                ConditionExpression=(
+                    'window_start = :start AND clicks = :clicks '
+                    'AND summarized = :summarized AND ' +
+                    ('size(pending) = :pending' if previous.get('pending')
+                     else 'attribute_not_exists(pending)')),
+                ExpressionAttributeValues={
+                    ':start': previous['window_start'],
+                    ':clicks': previous['clicks'],
+                    ':summarized': previous['summarized']})
+            if previous.get('pending'):
+                kwargs['ExpressionAttributeValues'][':pending'] = len(
+                    previous['pending'])
+        try:
+            self.table.put_item(Item=item, **kwargs)
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return None, None
+            raise
+        return item, previous
+
+
+    def add_click(self, serial, cutoff, click, event_id):
+        '''Count a click in serial's open window.  Returns the updated
+        window, or None if the window closed before cutoff or was opened
+        by event_id.
+
+        '''
+
+        try:
+            resp = self.table.update_item(
+                Key={'serialNumber': serial},
+                UpdateExpression='ADD clicks :one SET last_click = :click',
+                ConditionExpression=('window_start >= :cutoff '
+                                     'AND first_event <> :event'),
+                ExpressionAttributeValues={':one': 1, ':click': click,
+                                           ':cutoff': cutoff,
+                                           ':event': event_id},
+                ReturnValues='ALL_NEW')
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return None
+            raise
+        return _plain(resp['Attributes'])
+
+
+    def get(self, serial):
+        '''Returns serial's window, or None.'''
+        resp = self.table.get_item(Key={'serialNumber': serial},
+                                   ConsistentRead=True)
+        return _plain(resp.get('Item'))
+
+
+    def claim_summary(self, serial, window_start):
+        '''Mark the window that opened at window_start as summarized.
+        Returns True for exactly one caller.
+
+        '''
+
+        try:
+            self.table.update_item(
+                Key={'serialNumber': serial},
+                UpdateExpression='SET summarized = :true',
+                ConditionExpression=('window_start = :start '
+                                     'AND summarized = :false'),
+                ExpressionAttributeValues={':start': window_start,
+                                           ':true': True, ':false': False})
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return False
+            raise
+        return True
+
+
+    def release_summary(self, serial, window_start):
+        '''Undo claim_summary(), so that the window is summarized again.
+        Returns False if the window has since been replaced.
+
+        '''
+
+        try:
+            self.table.update_item(
+                Key={'serialNumber': serial},
+                UpdateExpression='SET summarized = :false',
+                ConditionExpression=('window_start = :start '
+                                     'AND summarized = :true'),
+                ExpressionAttributeValues={':start': window_start,
+                                           ':true': True, ':false': False})
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return False
+            raise
+        return True
+
+
+    def add_pending(self, serial, summaries):
+        '''Add summaries to those pending in serial's window.'''
+        self.table.update_item(
+            Key={'serialNumber': serial},
+            UpdateExpression=('SET pending = list_append('
+                              'if_not_exists(pending, :empty), :summaries)'),
+            ConditionExpression='attribute_exists(serialNumber)',
+            ExpressionAttributeValues={':empty': [],
+                                       ':summaries': summaries})
+
+
+    def take_pending(self, serial, window_start):
+        '''Remove and return the summaries pending in the window that
+        opened at window_start.  Returns them to exactly one caller.
+
+        '''
+
+        try:
+            resp = self.table.update_item(
+                Key={'serialNumber': serial},
+                UpdateExpression='REMOVE pending',
+                ConditionExpression=('window_start = :start '
+                                     'AND attribute_exists(pending)'),
+                ExpressionAttributeValues={':start': window_start},
+                ReturnValues='UPDATED_OLD')
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return []
+            raise
+        return _plain(resp['Attributes'])['pending']
+
+
+    def clear_pending(self, serial, window_start, count):
+        '''Remove the summaries pending in the window that opened at
+        window_start, if there are still count of them.  Returns whether
+        they were removed.
+
+        '''
+
+        try:
+            self.table.update_item(
+                Key={'serialNumber': serial},
+                UpdateExpression='REMOVE pending',
+                ConditionExpression=('window_start = :start '
+                                     'AND size(pending) = :count'),
+                ExpressionAttributeValues={':start': window_start,
+                                           ':count': count})
+        except ClientError as exc:
+            if _conditional_failure(exc):
+                return False
+            raise
+        return True
+
+
+    def unsummarized(self, cutoff):
+        '''Returns the windows opened before cutoff which either counted
+        more than one click and have not been summarized, or have
+        summaries pending.
+
+        '''
+
+        kwargs = dict(
+            FilterExpression=('window_start < :cutoff AND '
+                              '((clicks > :one AND summarized = :false) '
+                              'OR attribute_exists(pending))'),
+            ExpressionAttributeValues={':cutoff': cutoff, ':one': 1,
+                                       ':false': False})
+        windows = []
+        while True:
+            resp = self.table.scan(**kwargs)
+            windows.extend(_plain(item) for item in resp['Items'])
+            if 'LastEvaluatedKey' not in resp:
+                return windows
+            kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+class MemoryStore(object):
+    '''In-memory equivalent of DynamoStore.'''
+
+    def __init__(self):
+        self.windows = {}
+        self.lock = threading.Lock()
+
+
+    def start_window(self, serial, start, cutoff, click, event_id):
+        with self.lock:
+            previous = self.windows.get(serial)
+            if previous and previous['window_start'] >= cutoff:
+                return None, None
+            window = dict(serialNumber=serial, window_start=start, clicks=1,
+                          last_click=click, summarized=False,
+                          first_event=event_id)
+            pending = owed(previous)
+            if pending:
+                window['pending'] = pending
+            self.windows[serial] = window
+            return dict(window), previous
+
+
+    def add_click(self, serial, cutoff, click, event_id):
+        with self.lock:
+            window = self.windows.get(serial)
+            if (not window or window['window_start'] < cutoff or
+                window['first_event'] == event_id):
+                return None
+            window['clicks'] += 1
+            window['last_click'] = click
+            return dict(window)
+
+
+    def get(self, serial):
+        with self.lock:
+            window = self.windows.get(serial)
+            return dict(window) if window else None
+
+
+    def claim_summary(self, serial, window_start):
+        with self.lock:
+            window = self.windows.get(serial)
+            if (not window or window['window_start'] != window_start or
+                window['summarized']):
+                return False
+            window['summarized'] = True
+            return True
+
+
+    def release_summary(self, serial, window_start):
+        with self.lock:
+            window = self.windows.get(serial)
+            if (not window or window['window_start'] != window_start or
+                not window['summarized']):
+                return False
+            window['summarized'] = False
+            return True
+
+
+    def add_pending(self, serial, summaries):
+        with self.lock:
+            window = self.windows[serial]
+            window['pending'] = window.get('pending', []) + list(summaries)
+
+
+    def take_pending(self, serial, window_start):
+        with self.lock:
+            window = self.windows.get(serial)
+            if not window or window['window_start'] != window_start:
+                return []
+            return window.pop('pending', [])
+
+
+    def clear_pending(self, serial, window_start, count):
+        with self.lock:
+            window = self.windows.get(serial)
+            if (not window or window['window_start'] != window_start or
+                len(window.get('pending', [])) != count):
+                return False
+            del window['pending']
+            return True
+
+
+    def unsummarized(self, cutoff):
+        with self.lock:
+            return [dict(w) for w in self.windows.values()
+                    if w['window_start'] < cutoff and
+                    (w['clicks'] > 1 and not w['summarized'] or
+                     w.get('pending'))]
+
+
+class Coalescer(object):
+    '''Decides which clicks are notified and which are summarized.'''
+
+    def __init__(self, store, window_seconds):
+        self.store = store
+        self.window_ms = int(window_seconds * 1000)
+
+
+    def record(self, serial, click, event_id, now=None):
+        '''Record a click, identified by event_id.  Returns (window, due)
+        where window is the window in which the click was counted -- the
+        click should be notified only if it opened the window, i.e., if
+        window['first_event'] is event_id -- and due is a list of
+        summaries of closed windows which this caller must now send,
+        then settle().  Until then a retry of the event is given them
+        again.
+
+        '''
+
+        now = now or now_ms()
+        cutoff = now - self.window_ms
+        while True:
+            window, previous = self.store.start_window(serial, now, cutoff,
+                                                       click, event_id)
+            if window:
+                return window, window.get('pending', [])
+            window = self.store.add_click(serial, cutoff, click, event_id)
+            if window:
+                return window, []
+            window = self.store.get(serial)
+            if (window and window['window_start'] >= cutoff and
+                window['first_event'] == event_id):
+                # A retry of the event that opened the window.
+                return window, window.get('pending', [])
+            # The window closed between the calls; try again.
+
+
+    def settle(self, window, due):
+        '''Forget the summaries due that record() returned with window,
+        now that they have been sent.
+
+        '''
+
+        if due:
+            self.store.clear_pending(window['serialNumber'],
+                                     window['window_start'], len(due))
+
+
+    def due(self, now=None):
+        '''Returns summaries of closed windows which are due, claiming
+        each so that no other caller also sends it.  Those that are
+        then not sent must be release()d.
+
+        '''
+
+        cutoff = (now or now_ms()) - self.window_ms
+        due = []
+        for window in self.store.unsummarized(cutoff):
+            serial, start = window['serialNumber'], window['window_start']
+            if window.get('pending'):
+                due.extend(self.store.take_pending(serial, start))
+            if (window['clicks'] > 1 and not window['summarized'] and
+                self.store.claim_summary(serial, start)):
+                due.append(summary_of(window))
+        return due
+
+
+    def release(self, summaries):
+        '''Give back summaries, returned by due(), which were not sent,
+        so that a later flush sends them.
+
+        '''
+
+        for summary in summaries:
+            if not self.store.release_summary(summary['serialNumber'],
+                                              summary['window_start']):
+                # The window has been replaced since; its summary is now
+                # owed by its replacement.
+                self.store.add_pending(summary['serialNumber'], [summary])
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
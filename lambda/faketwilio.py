@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Usage:
+    faketwilio [options]
+
+A local stand-in for the parts of the Twilio REST API used by
+notifier.py.  It is used for benchmarking and load testing the notifier
+without placing real calls or sending real SMS messages.
+
+Point the notifier at it by setting 'twilio.base_url' in the notifier
+config to the URL printed on startup.
+
+The server speaks plain HTTP.  Since the cost being modeled is mostly
+that of connection setup, --handshake adds a delay to each new
+connection to stand in for the TCP + TLS handshake to api.twilio.com,
+and --latency adds a delay to every request to stand in for the API's
+own response time.  Like the real API, requests without credentials are
+answered with a 401 challenge.
+
+Calls are "set up" once their TwiML is in hand: immediately when it is
+passed inline (the Twiml parameter), or after --fetch when Twilio would
+first have to fetch it from the given Url.  The time each call's TwiML
+became available is kept in FakeTwilioServer.call_ready.
+
+The account resource may also be fetched (GET), as notifierd.py does to
+keep its connections open.
+
+Twilio Notify's notifications resource (POST
+/v1/Services/<sid>/Notifications) accepts an SMS message to many
+recipients (ToBinding), as the notifier sends when
+'twilio.notify_service_sid' is set; point 'twilio.notify_base_url' at
+the same URL.  The request is counted as one notification, however many
+recipients it names.
+
+With --sms-rate, each source (From) number may send only that many
+messages per second, in bursts of up to --sms-burst; further messages
+are answered with 429 (Too Many Requests), as Twilio does.
+
+Options:
+    --port=PORT            port to listen on [default: 8089]
+    --handshake=MS         delay added to each new connection [default: 0]
+    --latency=MS           delay added to each request [default: 0]
+    --fetch=MS             time taken to fetch TwiML from a Url [default: 0]
+    --no-inline-twiml      reject calls that pass TwiML inline
+    --sms-rate=N           messages per second per source number; 0 for
+                           no limit [default: 0]
+    --sms-burst=N          messages per source number at once [default: 1]
+
+'''
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import re
+import socket
+import sys
+import threading
+import time
+
+from urlparse import parse_qs
+
+from senders import TokenBucket
+
+
+RESOURCE_RE = re.compile(
+    r'^/2010-04-01/Accounts/(?P<account>\w+)/(?P<resource>Calls|Messages)'
+    r'(\.json)?$')
+
+ACCOUNT_RE = re.compile(r'^/2010-04-01/Accounts/(?P<account>\w+)(\.json)?$')
+
+NOTIFICATIONS_RE = re.compile(
+    r'^/v1/Services/(?P<service>\w+)/Notifications$')
+
+
+class FakeTwilioHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # HTTP/1.1 so that clients can keep connections alive.
+    protocol_version = 'HTTP/1.1'
+
+    # Write responses in one segment; otherwise Nagle's algorithm and the
+    # client's delayed ACK add ~40ms to every kept-alive request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.record('connections')
+        self.server.open_connections.add(self.connection)
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            # The client went away, e.g. after giving up on a request.
+            pass
+        finally:
+            self.server.open_connections.discard(self.connection)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if not self.headers.getheader('Authorization'):
+            self.server.record('challenges')
+            self.send_json(401, {'code': 20003, 'message': 'Authenticate'},
+                           {'WWW-Authenticate': 'Basic realm="Twilio API"'})
+            return
+
+        match = ACCOUNT_RE.match(self.path)
+        if not match:
+            self.send_json(404, {'code': 20404, 'message': 'Not found'})
+            return
+
+        self.server.record('accounts')
+        self.send_json(200, {
+            'sid': match.group('account'),
+            'status': 'active',
+            'uri': self.path,
+        })
+
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        values = parse_qs(self.rfile.read(length))
+        form = dict((k, v[0]) for k, v in values.items())
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if not self.headers.getheader('Authorization'):
+            self.server.record('challenges')
+            self.send_json(401, {'code': 20003, 'message': 'Authenticate'},
+                           {'WWW-Authenticate': 'Basic realm="Twilio API"'})
+            return
+
+        match = NOTIFICATIONS_RE.match(self.path)
+        if match:
+            self.notify(match.group('service'), values)
+            return
+
+        match = RESOURCE_RE.match(self.path)
+        if not match:
+            self.send_json(404, {'code': 20404, 'message': 'Not found'})
+            return
+
+        resource = match.group('resource')
+        if resource == 'Calls':
+            if 'Twiml' in form and not self.server.inline_twiml:
+                self.send_json(400, {'code': 21205,
+                                     'message': 'Twiml is not supported'})
+                return
+            if 'Twiml' not in form and 'Url' not in form:
+                self.send_json(400, {'code': 21205,
+                                     'message': 'Url or Twiml is required'})
+                return
+
+        if resource == 'Messages' and not self.server.allow_sms(form):
+            self.server.record('throttled')
+            self.send_json(429, {'code': 20429,
+                                 'message': 'Too Many Requests'})
+            return
+
+        self.server.record(resource.lower(), form)
+        prefix = 'CA' if resource == 'Calls' else 'SM'
+        sid = '%s%032d' % (prefix, next(self.server.sids))
+        if resource == 'Calls':
+            self.server.set_up_call(sid, form)
+        self.send_json(201, {
+            'sid': sid,
+            'account_sid': match.group('account'),
+            'to': form.get('To'),
+            'from': form.get('From'),
+            'body': form.get('Body'),
+            'status': 'queued',
+            'uri': '%s/%s.json' % (self.path.split('.json')[0], sid),
+        })
+
+
+    def notify(self, service, values):
+        '''Accept a Notify notification sending Body to every SMS
+        address in ToBinding.
+
+        '''
+
+        try:
+            bindings = [json.loads(b) for b in values.get('ToBinding', [])]
+            addresses = [b['address'] for b in bindings
+                         if b.get('binding_type') == 'sms']
+        except (ValueError, KeyError, TypeError):
+            addresses = []
+        if not addresses or 'Body' not in values:
+            self.send_json(400, {'code': 20001,
+                                 'message': 'Body and ToBinding are '
+                                            'required'})
+            return
+
+        form = dict(Body=values['Body'][0], To=addresses)
+        self.server.record('notifications', form)
+        sid = 'NT%032d' % next(self.server.sids)
+        self.send_json(201, {
+            'sid': sid,
+            'service_sid': service,
+            'body': form['Body'],
+            'url': '%s/%s' % (self.path, sid),
+        })
+
+
+class FakeTwilioServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+    def __init__(self, port=0, handshake=0.0, latency=0.0, fetch=0.0,
+                 inline_twiml=True, sms_rate=0, sms_burst=1):
+        '''Args:
+              port (int) -
+                  Port on which to listen; 0 picks a free port.
+              handshake (float) -
+                  Seconds of delay added to each new connection.
+              latency (float) -
+                  Seconds of delay added to each request.
+              fetch (float) -
+                  Seconds taken to fetch a call's TwiML from its Url.
+              inline_twiml (bool) -
+                  If False, calls that pass TwiML inline are rejected.
+              sms_rate (float) -
+                  Messages per second each source number may send, or 0
+                  for no limit.
+              sms_burst (int) -
+                  Messages each source number may send at once.
+
+        '''
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeTwilioHandler)
+        self.handshake = handshake
+        self.latency = latency
+        self.fetch = fetch
+        self.inline_twiml = inline_twiml
+        self.sms_rate = sms_rate
+        self.sms_burst = sms_burst
+        self.sids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.open_connections = set()
+        self.reset()
+
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning requests, and stop(), break connections;
+        # that is expected and not worth a traceback.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+    def reset(self):
+        '''Clear the counters and the record of received requests.'''
+        with self.lock:
+            self.counts = dict(connections=0, challenges=0, accounts=0,
+                               calls=0, messages=0, notifications=0,
+                               throttled=0)
+            self.received = []
+            self.call_ready = {}
+            self.buckets = {}
+
+
+    def record(self, name, form=None):
+        with self.lock:
+            self.counts[name] += 1
+            if form is not None:
+                self.received.append((name, form))
+
+
+    def allow_sms(self, form):
+        '''Returns whether the message's source number may send it now.'''
+
+        if not self.sms_rate:
+            return True
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(form.get('From'))
+            if bucket is None:
+                bucket = TokenBucket(self.sms_rate, self.sms_burst, now)
+                self.buckets[form.get('From')] = bucket
+            if bucket.available(now) > now:
+                return False
+            bucket.take(now)
+            return True
+
+
+    def set_up_call(self, sid, form):
+        '''Record when the call's TwiML is available: now if it was
+        passed inline, otherwise once it has been fetched.
+
+        '''
+
+        def ready():
+            with self.lock:
+                self.call_ready[sid] = time.time()
+
+        if 'Twiml' in form or not self.fetch:
+            ready()
+        else:
+            timer = threading.Timer(self.fetch, ready)
+            timer.daemon = True
+            timer.start()
+
+
+    def stop(self):
+        '''Stop serving, then close the listening socket and any
+        connections that clients have kept open.
+
+        '''
+
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.open_connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for _ in range(100):
+            if not self.open_connections:
+                break
+            time.sleep(0.01)
+
+
+    def start(self):
+        '''Serve requests on a daemon thread; returns the server.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+
+if __name__ == '__main__':
+
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    server = FakeTwilioServer(port=int(args['--port']),
+                              handshake=float(args['--handshake']) / 1000,
+                              latency=float(args['--latency']) / 1000,
+                              fetch=float(args['--fetch']) / 1000,
+                              inline_twiml=not args['--no-inline-twiml'],
+                              sms_rate=float(args['--sms-rate']),
+                              sms_burst=int(args['--sms-burst']))
+    print('Fake Twilio API listening at %s' % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -3,37 +3,221 @@
 
 '''Usage:
     helper [options] create-role (ROLE-NAME) (PROFILE-NAME)
+    helper [options] update-role (ROLE-NAME) (CONFIG-PATH) (PROFILE-NAME)
     helper [options] get-role-arn (ROLE-NAME) (PROFILE-NAME)
     helper [options] get-function-arn (FUNCTION-NAME) (PROFILE-NAME)
     helper [options] create-topic-rule (RULE-NAME) (FUNCTION-NAME) (SERIAL-NUMBER) (PROFILE-NAME)
+    helper [options] create-table (TABLE-NAME) (PROFILE-NAME)
+    helper [options] create-schedule (RULE-NAME) (FUNCTION-NAME) (SCHEDULE) (PAYLOAD) (PROFILE-NAME)
+    helper [options] package (ZIP-PATH)
+    helper [options] update-function-code (FUNCTION-NAME) (ZIP-PATH) (PROFILE-NAME)
+    helper [options] deploy (FUNCTION-NAME) (ROLE-NAME) (RULE-NAME) (SERIAL-NUMBER) (CONFIG-PATH) (PROFILE-NAME)
+    helper [options] warm (FUNCTION-NAME) (ALIAS) (PROFILE-NAME)
+    helper [options] latency-report (FUNCTION-NAME) (PROFILE-NAME)
 
-    create-role - Create IAM role named ROLE-NAME.
+    create-role - Create IAM role named ROLE-NAME, granted the resources
+                  the config --config uses, as by update-role, if given.
+    update-role - Grant the IAM role ROLE-NAME access to the DynamoDB
+                  tables the notifier config in CONFIG-PATH uses, for
+                  coalescing and the ledger, and to no others, and to
+                  write the audit trail under its debug_bucket.
     get-role-arn - Get ARN of the IAM role named ROLE-NAME.
     get-function-arn - Get ARN of Lambda function named FUNCTION-NAME
     create-topic-rule - Create IOT rule name RULE-NAME which invokes a
-                        Lambda function named FUNCTION-NAME when the
-                        IoT Button with serial number SERIAL-NUMBER is pressed.
+                        Lambda function named FUNCTION-NAME (its alias
+                        --alias, if given) when the IoT Button with
+                        serial number SERIAL-NUMBER is pressed.
+    create-table - Create DynamoDB table named TABLE-NAME, keyed by
+                   the string attribute named by --key, and wait for it
+                   to become active.
+    create-schedule - Create CloudWatch Events rule named RULE-NAME which
+                      invokes the Lambda function named FUNCTION-NAME (its
+                      alias --alias, if given) with the JSON string
+                      PAYLOAD on the schedule SCHEDULE (e.g., 'rate(1
+                      minute)').
+    package - Build a Lambda Deployment Package for the handler in
+              ZIP-PATH, using the requirements and ignore list in
+              lambda.json, and report its size.
+    update-function-code - Upload the Deployment Package in ZIP-PATH to
+                           the Lambda function named FUNCTION-NAME.
+    deploy - Create or update, as needed, the IAM role ROLE-NAME (and
+             its access, as by update-role), the Lambda function
+             FUNCTION-NAME, the config in CONFIG-PATH (uploaded to
+             BUCKET_NAME/KEY_NAME, as by 'notifier.py config upload'),
+             and the IoT rule RULE-NAME for the button SERIAL-NUMBER.
+             Steps whose inputs are unchanged since the last deploy are
+             skipped; see build/deploy-state.json.  With --alias, a
+             version of the function is published, the alias is pointed
+             at it, and the rule invokes the alias.
+    warm - Keep the function's alias ALIAS warm, so that a click does
+           not wait for a cold start: publish a version of the function,
+           point ALIAS at it, give ALIAS --provisioned containers of
+           provisioned concurrency (if given; 0 removes it), and invoke
+           ALIAS with the keep-warm ping (notifier.PING_EVENT) on the
+           schedule --ping, through the CloudWatch Events rule
+           --ping-rule ('off' disables the rule).  Point the topic rule
+           at ALIAS with 'deploy --alias' or 'create-topic-rule --alias'.
+    latency-report - Report how long the handler took for clicks that
+                     found a cold container and for those that found a
+                     warm one, over the last --hours hours, from the
+                     metrics and REPORT lines in the function's logs.
 
     This is example code - not production code - there is no error handling.
 
 Options:
     --V   - Set debug level to Info
     --VV  - Set debug level to Debug
+    --key=NAME  - Name of the table's hash key [default: serialNumber]
+    --config=PATH  - Notifier config whose resources 'create-role'
+                     grants
+    --force  - Deploy every step, even those whose inputs are unchanged
+    --stats  - Print the latency, retries, and throttling of each AWS
+               API call made (see ../apistats.py)
+    --stats-file=PATH  - As --stats, and also write them to PATH as JSON
+    --alias=ALIAS  - Alias of the function for rules to invoke
+    --provisioned=N  - Containers of provisioned concurrency for 'warm'
+    --ping=SCHEDULE  - Schedule of the keep-warm ping, or 'off'
+                       [default: rate(5 minutes)]
+    --ping-rule=NAME  - Name of the keep-warm ping's rule
+                        [default: EM247-Notifier-KeepWarm]
+    --hours=N  - Hours of logs covered by 'latency-report' [default: 24]
 
 '''
 
 from __future__ import print_function
 
+import compileall
+import hashlib
 import json
 import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
 
 import boto3
+import botocore.waiter
 import docopt
 import dotmap
 
 
 logger = None
 
+# Waits for a new IAM role to be visible; botocore has no waiter for
+# IAM roles.
+ROLE_EXISTS_WAITER = {
+    'version': 2,
+    'waiters': {
+        'RoleExists': {
+            'operation': 'GetRole',
+            'delay': 1,
+            'maxAttempts': 30,
+            'acceptors': [
+                {'matcher': 'status', 'expected': 200, 'state': 'success'},
+                {'matcher': 'error', 'expected': 'NoSuchEntity',
+                 'state': 'retry'},
+            ],
+        },
+    },
+}
+
+# Lambda rejects a role that is visible to IAM but not yet assumable;
+# creating the function is retried this many times, this many seconds
+# apart.
+ROLE_PROPAGATION_ATTEMPTS = 10
+ROLE_PROPAGATION_DELAY = 3
+
+# The inline policy of the handler's role granting it the DynamoDB
+# tables and the audit bucket its config uses (see notifier_policy()),
+# and what it does with the tables.  The coalescing table is also
+# scanned, by the flush.
+NOTIFIER_POLICY_NAME = 'EM247-Notifier-Resources'
+TABLE_ACTIONS = ['dynamodb:GetItem', 'dynamodb:PutItem',
+                 'dynamodb:UpdateItem', 'dynamodb:DeleteItem']
+
+# Attached to roles created by earlier versions, and replaced by the
+# inline policy.
+DYNAMODB_FULL_ACCESS = 'arn:aws:iam::aws:policy/AmazonDynamoDBFullAccess'
+
+# Records the AWS API calls made, if --stats is given.
+api_stats = None
+
+# Provisioned concurrency takes minutes to be ready; its status is
+# checked this many times, this many seconds apart.
+PROVISIONED_ATTEMPTS = 60
+PROVISIONED_DELAY = 10
+
+
+def new_session(aws_profile):
+    '''Returns a boto3 Session, instrumented if --stats is given.'''
+    session = boto3.Session(profile_name=aws_profile)
+    if api_stats is not None:
+        api_stats.instrument(session)
+    return session
+
+
+def notifier_resources(config_path):
+    '''Returns a dict describing the AWS resources the handler uses
+    according to the notifier config in config_path: 'tables' maps
+    'coalesce' and 'ledger' to their DynamoDB tables, if configured,
+    and 'audit' is the S3 bucket and key prefix (see audit.py) the
+    audit trail is written to, or None.
+
+    '''
+
+    import yaml
+    import audit
+
+    with open(config_path) as f:
+        cfg = yaml.safe_load(f) or {}
+    settings = cfg.get('notifier') or {}
+    tables = {}
+    for name in ('coalesce', 'ledger'):
+        table = (settings.get(name) or {}).get('table')
+        if table:
+            tables[name] = table
+    trail = None
+    if settings.get('debug_bucket'):
+        prefix = (settings.get('audit') or {}).get('prefix',
+                                                   audit.DEFAULT_PREFIX)
+        trail = dict(bucket=settings['debug_bucket'], prefix=prefix)
+    return dict(tables=tables, audit=trail)
+
+
+def table_arn(table_name):
+    return 'arn:aws:dynamodb:*:*:table/%s' % table_name
+
+
+def notifier_policy(resources):
+    '''Returns the policy document granting the handler the resources
+    (see notifier_resources()), or None if it needs none.
+
+    '''
+
+    statements = []
+    tables = resources['tables']
+    if tables:
+        statements.append(dict(
+            Effect='Allow', Action=TABLE_ACTIONS,
+            Resource=[table_arn(t) for t in sorted(set(tables.values()))]))
+    if 'coalesce' in tables:
+        statements.append(dict(
+            Effect='Allow', Action=['dynamodb:Scan'],
+            Resource=[table_arn(tables['coalesce'])]))
+    if resources.get('audit'):
+        statements.append(dict(
+            Effect='Allow', Action=['s3:PutObject'],
+            Resource=['arn:aws:s3:::%(bucket)s/%(prefix)s*' %
+                      resources['audit']]))
+    if not statements:
+        return None
+    return {'Version': '2012-10-17', 'Statement': statements}
+
 
 class AWS_IAM(object):
 
@@ -41,11 +225,11 @@ class AWS_IAM(object):
     def __init__(self, aws_profile):
 
         self.aws_profile = aws_profile
-        self.session = boto3.Session(profile_name=self.aws_profile)
+        self.session = new_session(self.aws_profile)
         self.client = self.session.client('iam')
 
 
-    def create_role(self, role_name):
+    def create_role(self, role_name, resources=None):
 
         # Step 1
         # Create IAM role that Lambda can assume upon execution.
@@ -71,13 +255,45 @@ class AWS_IAM(object):
         # Attach Policy to Role granting Lambda write access to logging.
         policy_Arns = [
             'arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess',
-            'arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole'
+            'arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole',
         ]
         for policy_Arn in policy_Arns:
             resp = self.client.attach_role_policy(
                 RoleName=role_name,
                 PolicyArn=policy_Arn)
 
+        # Step 3
+        # Grant the DynamoDB tables, where state such as coalesced clicks
+        # is kept, and the audit bucket, that the config uses.
+        if resources is not None:
+            self.put_notifier_policy(role_name, resources)
+
+
+    def put_notifier_policy(self, role_name, resources):
+        '''Grant the role the resources (see notifier_resources()), and
+        no others: replace its inline policy NOTIFIER_POLICY_NAME, and
+        detach AmazonDynamoDBFullAccess, which roles created by earlier
+        versions were given.
+
+        '''
+
+        policy = notifier_policy(resources)
+        if policy:
+            self.client.put_role_policy(RoleName=role_name,
+                                        PolicyName=NOTIFIER_POLICY_NAME,
+                                        PolicyDocument=json.dumps(policy))
+        else:
+            try:
+                self.client.delete_role_policy(
+                    RoleName=role_name, PolicyName=NOTIFIER_POLICY_NAME)
+            except self.client.exceptions.NoSuchEntityException:
+                pass
+        try:
+            self.client.detach_role_policy(RoleName=role_name,
+                                           PolicyArn=DYNAMODB_FULL_ACCESS)
+        except self.client.exceptions.NoSuchEntityException:
+            pass
+
 
     def get_role_arn(self, role_name):
         resp = self.client.get_role(RoleName=role_name)
@@ -85,44 +301,103 @@ class AWS_IAM(object):
         return role_arn
 
 
+    def wait_for_role(self, role_name):
+        '''Wait until GetRole finds the role, which IAM, being
+        eventually consistent, may not at first.
+
+        '''
+
+        waiter = botocore.waiter.create_waiter_with_client(
+            'RoleExists', botocore.waiter.WaiterModel(ROLE_EXISTS_WAITER),
+            self.client)
+        waiter.wait(RoleName=role_name)
+
+
+    def ensure_role(self, role_name, resources=None):
+        '''Create the role unless it exists, and wait for it.  If
+        resources is given, grant the role those (see
+        put_notifier_policy()).  Returns its ARN.
+
+        '''
+
+        try:
+            role_arn = self.get_role_arn(role_name)
+        except self.client.exceptions.NoSuchEntityException:
+            self.create_role(role_name)
+            self.wait_for_role(role_name)
+            role_arn = self.get_role_arn(role_name)
+        if resources is not None:
+            self.put_notifier_policy(role_name, resources)
+        return role_arn
+
+
 class AWS_IOT(object):
 
 
     def __init__(self, aws_profile):
 
         self.aws_profile = aws_profile
-        self.session = boto3.Session(profile_name=self.aws_profile)
+        self.session = new_session(self.aws_profile)
         self.client = self.session.client('iot')
 
 
-    def create_topic_rule(self, rule_name, function_name, serial_number):
-
-        aws_lambda = AWS_Lambda(self.aws_profile)
-
-        rule_payload = {
+    def _rule_payload(self, function_arn, serial_number):
+        return {
             'sql': "SELECT * FROM 'iotbutton/%s'" % serial_number,
             'description': 'EM247 Button Press Rule',
             'actions': [
                 {
                     'lambda': {
-                        'functionArn': aws_lambda.get_function_arn(function_name),
+                        'functionArn': function_arn,
                     },
                 },
             ],
             'ruleDisabled': False,
             'awsIotSqlVersion': '2016-03-23',
         }
+
+
+    def create_topic_rule(self, rule_name, function_name, serial_number,
+                          alias=None):
+
+        aws_lambda = AWS_Lambda(self.aws_profile)
+
+        if alias:
+            function_arn = aws_lambda.get_alias_arn(function_name, alias)
+        else:
+            function_arn = aws_lambda.get_function_arn(function_name)
+        rule_payload = self._rule_payload(function_arn, serial_number)
         resp = self.client.create_topic_rule(ruleName=rule_name,
                                              topicRulePayload=rule_payload)
 
 
+    def put_topic_rule(self, rule_name, function_arn, serial_number):
+        '''Create the rule, or replace it if it exists.  Returns its
+        ARN.
+
+        '''
+
+        rule_payload = self._rule_payload(function_arn, serial_number)
+        try:
+            resp = self.client.get_topic_rule(ruleName=rule_name)
+        except self.client.exceptions.UnauthorizedException:
+            # Returned by GetTopicRule for rules that do not exist.
+            self.client.create_topic_rule(ruleName=rule_name,
+                                          topicRulePayload=rule_payload)
+            resp = self.client.get_topic_rule(ruleName=rule_name)
+        else:
+            self.client.replace_topic_rule(ruleName=rule_name,
+                                           topicRulePayload=rule_payload)
+        return resp['ruleArn']
+
+
 class AWS_Lambda(object):
 
 
     def __init__(self, aws_profile):
 
         self.aws_profile = aws_profile
-        self.session = boto3.Session(profile_name=self.aws_profile)
+        self.session = new_session(self.aws_profile)
         self.client = self.session.client('lambda')
 
 
@@ -137,6 +412,700 @@ class AWS_Lambda(object):
         return function_arn
 
 
+    def update_function_code(self, function_name, zip_path):
+        with open(zip_path, 'rb') as f:
+            resp = self.client.update_function_code(FunctionName=function_name,
+                                                    ZipFile=f.read())
+        return resp
+
+
+    def create_function(self, function_name, zip_path, role_arn, spec,
+                        variables):
+        '''Create the function, with the settings in spec (as in
+        lambda.json) and the environment variables variables.
+
+        A role that has just been created may not yet be assumable by
+        Lambda, which then rejects the function; creating it is retried
+        until the role has propagated.
+
+        '''
+
+        with open(zip_path, 'rb') as f:
+            code = f.read()
+        for attempt in range(ROLE_PROPAGATION_ATTEMPTS):
+            try:
+                return self.client.create_function(
+                    FunctionName=function_name,
+                    Runtime=spec['runtime'],
+                    Role=role_arn,
+                    Handler=spec['handler'],
+                    Code={'ZipFile': code},
+                    Description=spec.get('description', ''),
+                    Timeout=spec['timeout'],
+                    MemorySize=spec['memory'],
+                    Environment={'Variables': variables})
+            except self.client.exceptions.InvalidParameterValueException \
+                   as exc:
+                if (attempt + 1 == ROLE_PROPAGATION_ATTEMPTS or
+                    'role' not in str(exc)):
+                    raise
+                logging.info('Waiting for role %s to propagate', role_arn)
+                time.sleep(ROLE_PROPAGATION_DELAY)
+
+
+    def update_function_configuration(self, function_name, role_arn, spec,
+                                      variables):
+        resp = self.client.update_function_configuration(
+            FunctionName=function_name,
+            Role=role_arn,
+            Handler=spec['handler'],
+            Description=spec.get('description', ''),
+            Timeout=spec['timeout'],
+            MemorySize=spec['memory'],
+            Environment={'Variables': variables},
+            Runtime=spec['runtime'])
+        return resp
+
+
+    def add_permission(self, function_name, statement_id, principal,
+                       source_arn, qualifier=None):
+        '''Allow principal (e.g., 'events.amazonaws.com') to invoke the
+        function, or its alias qualifier, on behalf of the resource
+        source_arn.
+
+        '''
+
+        kwargs = dict(Qualifier=qualifier) if qualifier else {}
+        resp = self.client.add_permission(FunctionName=function_name,
+                                          StatementId=statement_id,
+                                          Action='lambda:InvokeFunction',
+                                          Principal=principal,
+                                          SourceArn=source_arn, **kwargs)
+        return resp
+
+
+    def get_alias_arn(self, function_name, alias):
+        resp = self.client.get_alias(FunctionName=function_name, Name=alias)
+        return resp['AliasArn']
+
+
+    def publish_alias(self, function_name, alias):
+        '''Publish a version of the function's code and configuration,
+        and point alias at it, creating the alias if need be.  Lambda
+        publishes no new version if nothing has changed since the last.
+        Returns (alias ARN, version).
+
+        '''
+
+        version = self.client.publish_version(
+            FunctionName=function_name)['Version']
+        try:
+            resp = self.client.update_alias(FunctionName=function_name,
+                                            Name=alias,
+                                            FunctionVersion=version)
+        except self.client.exceptions.ResourceNotFoundException:
+            resp = self.client.create_alias(FunctionName=function_name,
+                                            Name=alias,
+                                            FunctionVersion=version)
+        return resp['AliasArn'], version
+
+
+    def set_provisioned_concurrency(self, function_name, alias, containers):
+        '''Keep containers containers of the function's alias
+        initialized, waiting until they are, or, if containers is 0,
+        remove the alias's provisioned concurrency.
+
+        '''
+
+        if not hasattr(self.client, 'put_provisioned_concurrency_config'):
+            msg = ('Provisioned concurrency needs a newer boto3 than %s; '
+                   'use the keep-warm ping instead' % boto3.__version__)
+            raise ValueError, msg
+        if not containers:
+            try:
+                self.client.delete_provisioned_concurrency_config(
+                    FunctionName=function_name, Qualifier=alias)
+            except self.client.exceptions.ResourceNotFoundException:
+                pass
+            return None
+        self.client.put_provisioned_concurrency_config(
+            FunctionName=function_name, Qualifier=alias,
+            ProvisionedConcurrentExecutions=containers)
+        for _ in range(PROVISIONED_ATTEMPTS):
+            resp = self.client.get_provisioned_concurrency_config(
+                FunctionName=function_name, Qualifier=alias)
+            if resp['Status'] != 'IN_PROGRESS':
+                break
+            logging.info('Waiting for %d containers of %s:%s', containers,
+                         function_name, alias)
+            time.sleep(PROVISIONED_DELAY)
+        if resp['Status'] == 'FAILED':
+            msg = ('Provisioned concurrency of %s:%s failed: %s' % (
+                function_name, alias, resp.get('StatusReason')))
+            raise ValueError, msg
+        return resp['Status']
+
+
+class AWS_DynamoDB(object):
+
+
+    def __init__(self, aws_profile):
+
+        self.aws_profile = aws_profile
+        self.session = new_session(self.aws_profile)
+        self.client = self.session.client('dynamodb')
+
+
+    def create_table(self, table_name, hash_key):
+        resp = self.client.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': hash_key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': hash_key, 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5,
+                                   'WriteCapacityUnits': 5})
+        waiter = self.client.get_waiter('table_exists')
+        waiter.wait(TableName=table_name)
+        return resp
+
+
+class AWS_Events(object):
+
+
+    def __init__(self, aws_profile):
+
+        self.aws_profile = aws_profile
+        self.session = new_session(self.aws_profile)
+        self.client = self.session.client('events')
+
+
+    def create_schedule(self, rule_name, function_name, schedule, payload,
+                        alias=None):
+        '''Create, or update, the rule invoking the function, or its
+        alias, on schedule.
+
+        '''
+
+        aws_lambda = AWS_Lambda(self.aws_profile)
+
+        resp = self.client.put_rule(Name=rule_name,
+                                    ScheduleExpression=schedule,
+                                    State='ENABLED')
+        try:
+            aws_lambda.add_permission(function_name, rule_name,
+                                      'events.amazonaws.com',
+                                      resp['RuleArn'], qualifier=alias)
+        except aws_lambda.client.exceptions.ResourceConflictException:
+            # Already granted when the rule was first created.
+            pass
+        if alias:
+            function_arn = aws_lambda.get_alias_arn(function_name, alias)
+        else:
+            function_arn = aws_lambda.get_function_arn(function_name)
+        resp = self.client.put_targets(
+            Rule=rule_name,
+            Targets=[{
+                'Id': function_name,
+                'Arn': function_arn,
+                'Input': payload,
+            }])
+        return resp
+
+
+    def disable_schedule(self, rule_name):
+        '''Disable the rule, if it exists.'''
+        try:
+            self.client.disable_rule(Name=rule_name)
+        except self.client.exceptions.ResourceNotFoundException:
+            pass
+
+
+class AWS_Logs(object):
+
+
+    def __init__(self, aws_profile):
+
+        self.aws_profile = aws_profile
+        self.session = new_session(self.aws_profile)
+        self.client = self.session.client('logs')
+
+
+    def events(self, log_group, pattern, start):
+        '''Yields the messages of log_group's events since start (a
+        time) that match the filter pattern.
+
+        '''
+
+        kwargs = dict(logGroupName=log_group, filterPattern=pattern,
+                      startTime=int(start * 1000), interleaved=True)
+        while True:
+            resp = self.client.filter_log_events(**kwargs)
+            for event in resp.get('events', []):
+                yield event['message']
+            if not resp.get('nextToken'):
+                return
+            kwargs['nextToken'] = resp['nextToken']
+
+
+def warm(aws_profile, function_name, alias, provisioned, ping, ping_rule):
+    '''Point the function's alias at a newly published version, set its
+    provisioned concurrency (unless provisioned is None), and schedule
+    the keep-warm ping (or disable it, if ping is 'off').
+
+    '''
+
+    import notifier
+
+    aws_lambda = AWS_Lambda(aws_profile)
+    alias_arn, version = aws_lambda.publish_alias(function_name, alias)
+    print('%s points at version %s' % (alias_arn, version))
+    if provisioned is not None:
+        status = aws_lambda.set_provisioned_concurrency(function_name, alias,
+                                                        provisioned)
+        print('Provisioned concurrency: %s' % (
+            '%d containers, %s' % (provisioned, status) if provisioned
+            else 'none'))
+    aws_events = AWS_Events(aws_profile)
+    if ping.lower() == 'off':
+        aws_events.disable_schedule(ping_rule)
+        print('Keep-warm ping: off')
+    else:
+        aws_events.create_schedule(ping_rule, function_name, ping,
+                                   json.dumps(notifier.PING_EVENT),
+                                   alias=alias)
+        print('Keep-warm ping: %s, by rule %s' % (ping, ping_rule))
+
+
+# Lambda's summary of an invocation, logged at its end.  Init Duration
+# appears only for an invocation that initialized its container.
+REPORT_RE = re.compile(r'REPORT RequestId: (?P<id>\S+)\s+'
+                       r'Duration: (?P<duration>[\d.]+) ms'
+                       r'(.*Init Duration: (?P<init>[\d.]+) ms)?')
+
+
+def percentile(samples, pct):
+    '''Returns the pct'th percentile of a list of samples.'''
+    samples = sorted(samples)
+    index = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def latency_report(aws_profile, function_name, hours):
+    '''Print how long clicks took over the last hours hours, those that
+    found a cold container apart from those that found a warm one.
+
+    Clicks are found by the metrics the handler logs (see metrics.py),
+    which say whether the container was cold, and how long the handler
+    took (Duration).  Lambda's REPORT line for the same request adds
+    the time taken to initialize the container (Init Duration), which
+    the handler cannot see.  Pings log no metrics, so are not counted.
+
+    '''
+
+    aws_logs = AWS_Logs(aws_profile)
+    log_group = '/aws/lambda/%s' % function_name
+    start = time.time() - hours * 3600
+
+    clicks = {}
+    for message in aws_logs.events(
+            log_group, '{ ($.ColdStart = 0) || ($.ColdStart = 1) }', start):
+        try:
+            document = json.loads(message[message.index('{'):])
+        except ValueError:
+            continue
+        clicks[document.get('requestId')] = dict(
+            cold=bool(document.get('ColdStart')),
+            handler=float(document.get('Duration', 0)), init=0.0)
+    invocations = 0
+    for message in aws_logs.events(log_group, '"REPORT RequestId"', start):
+        match = REPORT_RE.search(message)
+        if not match:
+            continue
+        invocations += 1
+        click = clicks.get(match.group('id'))
+        if click:
+            click['init'] = float(match.group('init') or 0)
+
+    print('%d events handled, and %d other invocations (e.g., pings), in '
+          'the last %g hours' % (len(clicks), invocations - len(clicks),
+                                 hours))
+    for label, cold in (('cold', True), ('warm', False)):
+        found = [c for c in clicks.values() if c['cold'] == cold]
+        if not found:
+            print('%-5s none' % label)
+            continue
+        for phase, samples in (
+                ('handler', [c['handler'] for c in found]),
+                ('total', [c['handler'] + c['init'] for c in found])):
+            print('%-5s %-8s n=%-5d mean=%8.1fms  p50=%8.1fms  p99=%8.1fms'
+                  % (label, phase, len(samples), sum(samples) / len(samples),
+                     percentile(samples, 50), percentile(samples, 99)))
+    if clicks:
+        print('%.0f%% of events found a cold container' % (
+            100.0 * len([c for c in clicks.values() if c['cold']]) /
+            len(clicks)))
+
+
+class Package(object):
+    '''Builds a Lambda Deployment Package for the handler.
+
+    lambda-uploader ships the whole virtualenv, as source.  This ships
+    only what the handler needs at runtime, byte-compiled: Lambda's
+    /var/task is read-only, so any module without a .pyc is compiled
+    anew on every cold start.  Third-party modules are shipped only as
+    .pyc; the handler's own are shipped as source too, for tracebacks.
+
+    The requirements are installed once per set of requirements and
+    kept, byte-compiled, under cache_dir, so rebuilding the package
+    after changing only the handler just zips what is there.
+
+    '''
+
+    # Paths, relative to the root of the package, that are not needed at
+    # runtime.
+    prune = [
+        r'^[^/]+\.(dist|egg)-info/',
+        r'(^|/)tests?/',
+        r'^(pip|setuptools|wheel|pkg_resources)/',
+        r'^easy_install\.py',
+        # Provided by the Lambda runtime.
+        r'^(boto3|botocore|s3transfer|jmespath|dateutil|docutils)/',
+    ]
+
+
+    def __init__(self, source_dir='.', spec_filename='lambda.json',
+                 cache_dir=None):
+
+        self.source_dir = source_dir
+        with open(os.path.join(source_dir, spec_filename)) as f:
+            self.spec = json.load(f)
+        self.cache_dir = cache_dir or os.path.join(source_dir, 'build',
+                                                   'deps')
+
+
+    def _source_files(self):
+        '''Yields the names of the handler's own files.'''
+        for name in sorted(os.listdir(self.source_dir)):
+            path = os.path.join(self.source_dir, name)
+            if (os.path.isfile(path) and name.endswith('.py') and
+                not any(re.search(p, name) for p in self.spec['ignore'])):
+                yield name
+
+
+    def requirements_digest(self):
+        '''Returns a hash of the requirements and of the interpreter
+        they are installed for.
+
+        '''
+
+        digest = hashlib.sha1(sys.version)
+        for requirement in sorted(self.spec['requirements']):
+            digest.update(requirement + '\n')
+        return digest.hexdigest()
+
+
+    def digest(self):
+        '''Returns a hash of everything that goes into the package: the
+        requirements and the handler's own files.
+
+        '''
+
+        digest = hashlib.sha1(self.requirements_digest())
+        for name in self._source_files():
+            with open(os.path.join(self.source_dir, name), 'rb') as f:
+                digest.update('%s\0%s\0' % (name, f.read()))
+        return digest.hexdigest()
+
+
+    def dependencies(self):
+        '''Returns a directory holding the requirements, installed and
+        byte-compiled.  Each set of requirements is installed only once,
+        under cache_dir.
+
+        '''
+
+        deps_dir = os.path.join(self.cache_dir,
+                                self.requirements_digest()[:16])
+        if os.path.isdir(deps_dir):
+            return deps_dir
+        # Install alongside, and move into place only once complete, so
+        # an interrupted install is not mistaken for a cached one.
+        tmp_dir = deps_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        subprocess.check_call(
+            [sys.executable, '-m', 'pip', 'install', '--quiet',
+             '--no-compile', '--target', tmp_dir] +
+            self.spec['requirements'])
+        compileall.compile_dir(tmp_dir, quiet=True)
+        os.rename(tmp_dir, deps_dir)
+        return deps_dir
+
+
+    def build(self, zip_path):
+        '''Build the package in zip_path.  Returns a dict mapping each
+        top-level name in the package to its compressed size in bytes.
+
+        '''
+
+        deps_dir = self.dependencies()
+        build_dir = tempfile.mkdtemp(prefix='notifier-package-')
+        try:
+            sources = list(self._source_files())
+            for name in sources:
+                shutil.copy(os.path.join(self.source_dir, name), build_dir)
+            compileall.compile_dir(build_dir, quiet=True)
+
+            sizes = {}
+            zip_dir = os.path.dirname(zip_path)
+            if zip_dir and not os.path.isdir(zip_dir):
+                os.makedirs(zip_dir)
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for top_dir in (deps_dir, build_dir):
+                    for root, dirs, files in os.walk(top_dir):
+                        for filename in files:
+                            path = os.path.join(root, filename)
+                            arcname = os.path.relpath(path, top_dir)
+                            if any(re.search(p, arcname)
+                                   for p in self.prune):
+                                continue
+                            if (arcname.endswith('.py') and
+                                arcname not in sources and
+                                os.path.exists(path + 'c')):
+                                continue
+                            zf.write(path, arcname)
+                            top = arcname.split(os.sep)[0]
+                            info = zf.getinfo(arcname)
+                            sizes[top] = (sizes.get(top, 0) +
+                                          info.compress_size)
+        finally:
+            shutil.rmtree(build_dir)
+        return sizes
+
+
+    def report(self, zip_path, sizes):
+        for top, size in sorted(sizes.items(), key=lambda i: -i[1]):
+            print('%10d  %s' % (size, top))
+        print('%10d  total compressed; %s is %d bytes' % (
+            sum(sizes.values()), zip_path, os.path.getsize(zip_path)))
+
+
+class Deploy(object):
+    '''Deploys the notifier: its IAM role, config, Lambda function, and
+    IoT rule.
+
+    Each step is run only if its inputs -- the hash of the handler's
+    code and requirements, of the config file, the names and settings
+    it is given -- differ from those of the last successful deploy,
+    which are kept in state_path.  The role, the package, and the config
+    do not depend on one another and are done concurrently; the function
+    waits for the role and the package, and the rule for the function.
+
+    '''
+
+    def __init__(self, aws_profile, function_name, role_name, rule_name,
+                 serial_number, config_path,
+                 state_path='build/deploy-state.json', force=False,
+                 alias=None):
+
+        self.aws_profile = aws_profile
+        self.function_name = function_name
+        self.role_name = role_name
+        self.rule_name = rule_name
+        self.serial_number = serial_number
+        self.config_path = config_path
+        self.alias = alias
+        self.state_path = state_path
+        self.package = Package()
+        self.lock = threading.Lock()
+        self.state = {}
+        if not force and os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+        try:
+            self.variables = {'BUCKET_NAME': os.environ['BUCKET_NAME'],
+                              'KEY_NAME': os.environ['KEY_NAME']}
+        except KeyError:
+            msg = ('Missing config environment variables: '
+                   'BUCKET_NAME and KEY_NAME')
+            raise ValueError, msg
+
+
+    def _save(self):
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+
+    def step(self, name, inputs, run):
+        '''Returns the result of run(), or, if inputs are those of the
+        last deploy, the result it returned then.
+
+        '''
+
+        digest = hashlib.sha1(json.dumps(inputs, sort_keys=True))
+        digest = digest.hexdigest()
+        with self.lock:
+            previous = self.state.get(name)
+        start = time.time()
+        if previous and previous['inputs'] == digest:
+            print('%-10s skipped, unchanged' % name)
+            return previous['result']
+        result = run()
+        with self.lock:
+            self.state[name] = dict(inputs=digest, result=result)
+            self._save()
+        print('%-10s done in %.1fs' % (name, time.time() - start))
+        return result
+
+
+    def deploy_role(self):
+        resources = notifier_resources(self.config_path)
+        return self.step(
+            'role',
+            dict(role=self.role_name, resources=resources),
+            lambda: AWS_IAM(self.aws_profile).ensure_role(self.role_name,
+                                                          resources))
+
+
+    def build_package(self):
+        '''Returns (digest, path) of the package, building it unless
+        it was already built from the same inputs.
+
+        '''
+
+        digest = self.package.digest()
+        zip_path = os.path.join('build', 'notifier-%s.zip' % digest[:16])
+        start = time.time()
+        if os.path.exists(zip_path):
+            print('%-10s skipped, unchanged' % 'package')
+        else:
+            # Build under another name, so an interrupted build is not
+            # mistaken for a finished one.
+            self.package.build(zip_path + '.tmp')
+            os.rename(zip_path + '.tmp', zip_path)
+            print('%-10s done in %.1fs' % ('package', time.time() - start))
+        return digest, zip_path
+
+
+    def deploy_config(self):
+        with open(self.config_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+
+        def upload():
+            import notifier
+            return notifier.Config().upload(self.aws_profile,
+                                            self.config_path)
+
+        return self.step('config', dict(config=digest, **self.variables),
+                         upload)
+
+
+    def deploy_function(self, role_arn, package):
+        digest, zip_path = package
+        spec = self.package.spec
+        settings = dict(role=role_arn, variables=self.variables,
+                        **{k: spec.get(k) for k in ('runtime', 'handler',
+                                                     'description',
+                                                     'timeout', 'memory')})
+
+        def deploy():
+            aws_lambda = AWS_Lambda(self.aws_profile)
+            previous = self.state.get('function', {}).get('result', {})
+            try:
+                resp = aws_lambda.get_function(self.function_name)
+            except aws_lambda.client.exceptions.ResourceNotFoundException:
+                resp = aws_lambda.create_function(
+                    self.function_name, zip_path, role_arn, spec,
+                    self.variables)
+                return dict(arn=resp['FunctionArn'], code=digest,
+                            settings=settings)
+            if previous.get('code') != digest:
+                aws_lambda.update_function_code(self.function_name,
+                                                zip_path)
+            if previous.get('settings') != settings:
+                aws_lambda.update_function_configuration(
+                    self.function_name, role_arn, spec, self.variables)
+            return dict(arn=resp['Configuration']['FunctionArn'],
+                        code=digest, settings=settings)
+
+        return self.step('function', dict(code=digest, settings=settings,
+                                          function=self.function_name),
+                         deploy)
+
+
+    def deploy_alias(self, function):
+        '''Returns the ARN of the alias, pointed at a version published
+        from the function as deployed.
+
+        '''
+
+        def deploy():
+            aws_lambda = AWS_Lambda(self.aws_profile)
+            return aws_lambda.publish_alias(self.function_name,
+                                            self.alias)[0]
+
+        return self.step('alias', dict(alias=self.alias, function=function),
+                         deploy)
+
+
+    def deploy_rule(self, function_arn):
+
+        def deploy():
+            aws_iot = AWS_IOT(self.aws_profile)
+            rule_arn = aws_iot.put_topic_rule(self.rule_name, function_arn,
+                                              self.serial_number)
+            aws_lambda = AWS_Lambda(self.aws_profile)
+            try:
+                aws_lambda.add_permission(self.function_name,
+                                          self.rule_name,
+                                          'iot.amazonaws.com', rule_arn,
+                                          qualifier=self.alias)
+            except aws_lambda.client.exceptions.ResourceConflictException:
+                # Already granted by an earlier deploy.
+                pass
+            return rule_arn
+
+        return self.step('rule', dict(rule=self.rule_name,
+                                      function=function_arn,
+                                      serial=self.serial_number),
+                         deploy)
+
+
+    def run(self):
+        from concurrent import futures
+
+        start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=3) as executor:
+            role = executor.submit(self.deploy_role)
+            package = executor.submit(self.build_package)
+            config = executor.submit(self.deploy_config)
+            function = self.deploy_function(role.result(),
+                                            package.result())
+            if self.alias:
+                self.deploy_rule(self.deploy_alias(function))
+            else:
+                self.deploy_rule(function['arn'])
+            config.result()
+        print('Deployed in %.1fs' % (time.time() - start))
+
+
+def setup_stats(args):
+
+    global api_stats
+
+    if args.stats or args.statsfile:
+        # apistats.py is shared with riprock.py, in the parent directory.
+        sys.path.append(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), os.pardir))
+        import apistats
+        api_stats = apistats.collect(args.statsfile)
+
+
 def setup_logging(args):
 
     logger = logging.getLogger('')
@@ -167,10 +1136,16 @@ if __name__ == '__main__':
     args = dotmap.DotMap(args)
 
     setup_logging(args)
+    setup_stats(args)
 
     if args.createrole:
         aws_iam = AWS_IAM(args.PROFILENAME)
-        aws_iam.create_role(args.ROLENAME)
+        aws_iam.create_role(args.ROLENAME, args.config and
+                            notifier_resources(args.config))
+    elif args.updaterole:
+        aws_iam = AWS_IAM(args.PROFILENAME)
+        aws_iam.put_notifier_policy(args.ROLENAME,
+                                    notifier_resources(args.CONFIGPATH))
     elif args.getrolearn:
         aws_iam = AWS_IAM(args.PROFILENAME)
         arn = aws_iam.get_role_arn(args.ROLENAME)
@@ -181,7 +1156,35 @@ if __name__ == '__main__':
         print(arn)
     elif args.createtopicrule:
         aws_iot = AWS_IOT(args.PROFILENAME)
-        aws_iot.create_topic_rule(args.RULENAME, args.FUNCTIONNAME, args.SERIALNUMBER)
+        aws_iot.create_topic_rule(args.RULENAME, args.FUNCTIONNAME,
+                                  args.SERIALNUMBER, alias=args.alias)
+    elif args.createtable:
+        aws_dynamodb = AWS_DynamoDB(args.PROFILENAME)
+        aws_dynamodb.create_table(args.TABLENAME, args.key)
+    elif args.createschedule:
+        aws_events = AWS_Events(args.PROFILENAME)
+        aws_events.create_schedule(args.RULENAME, args.FUNCTIONNAME,
+                                   args.SCHEDULE, args.PAYLOAD,
+                                   alias=args.alias)
+    elif args.package:
+        package = Package()
+        sizes = package.build(args.ZIPPATH)
+        package.report(args.ZIPPATH, sizes)
+    elif args.updatefunctioncode:
+        aws_lambda = AWS_Lambda(args.PROFILENAME)
+        aws_lambda.update_function_code(args.FUNCTIONNAME, args.ZIPPATH)
+    elif args.deploy:
+        deploy = Deploy(args.PROFILENAME, args.FUNCTIONNAME, args.ROLENAME,
+                        args.RULENAME, args.SERIALNUMBER, args.CONFIGPATH,
+                        force=args.force, alias=args.alias)
+        deploy.run()
+    elif args.warm:
+        warm(args.PROFILENAME, args.FUNCTIONNAME, args.ALIAS,
+             None if args.provisioned is None else int(args.provisioned),
+             args.ping, args.pingrule)
+    elif args.latencyreport:
+        latency_report(args.PROFILENAME, args.FUNCTIONNAME,
+                       float(args.hours))
     else:
         print(docopt.docopt.printable_usage(__doc__))
         sys.exit(1)
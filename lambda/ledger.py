@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+'''Records completed notifications so that retries do not repeat them.
+
+If the handler fails partway through (say the third SMS times out),
+Lambda retries the whole event.  Without a ledger, every recipient who
+was already reached would be called or texted again.  With one, each
+completed notification is recorded under the identity of the event and
+the recipient, and a retry sends only those not yet recorded.
+
+DynamoLedger keeps the records in a DynamoDB table whose hash key is the
+string 'sendId'.  Each record carries an 'expires' attribute (epoch
+seconds) which the table's time-to-live setting may use to delete it.
+MemoryLedger is a stand-in for local testing.
+
+'''
+
+import threading
+import time
+
+import boto3
+
+
+# How long records are kept; Lambda stops retrying well before this.
+RETENTION_SECONDS = 24 * 60 * 60
+
+
+def send_id(event_id, kind, number):
+    return '%s|%s|%s' % (event_id, kind, number)
+
+
+class DynamoLedger(object):
+
+
+    def __init__(self, table_name, session=None):
+        self.table = (session or boto3).resource('dynamodb').Table(table_name)
+
+
+    def completed(self, event_id, kind, number):
+        '''Returns the sid of the recorded notification, or None if it
+        has not been recorded.
+
+        '''
+
+        resp = self.table.get_item(Key={'sendId': send_id(event_id, kind,
+                                                          number)},
+                                   ConsistentRead=True)
+        return resp.get('Item', {}).get('sid')
+
+
+    def record(self, event_id, kind, number, sid):
+        '''Record a completed notification.'''
+        now = int(time.time())
+        self.table.put_item(Item={'sendId': send_id(event_id, kind, number),
+                                  'sid': sid,
+                                  'sent': now,
+                                  'expires': now + RETENTION_SECONDS})
+
+
+class MemoryLedger(object):
+    '''In-memory equivalent of DynamoLedger.'''
+
+    def __init__(self):
+        self.sids = {}
+        self.lock = threading.Lock()
+
+
+    def completed(self, event_id, kind, number):
+        with self.lock:
+            return self.sids.get(send_id(event_id, kind, number))
+
+
+    def record(self, event_id, kind, number, sid):
+        with self.lock:
+            self.sids[send_id(event_id, kind, number)] = sid
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
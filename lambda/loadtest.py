@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Usage:
+    loadtest run [options]
+    loadtest container --objects=DIR [--timeout=MS]
+
+Load tests notifier.py's lambda_handler() locally, under an emulation of
+the Lambda runtime.  Nothing is sent to AWS or Twilio.
+
+    run       - Invoke the handler with IoT Button events arriving at a
+                steady rate, with at most a given number of invocations
+                running at once; events that arrive while all of the
+                containers are busy wait for one, as Lambda queues
+                asynchronous invocations.  Then print the throughput,
+                the duration of cold and warm invocations, and the time
+                taken to initialize each container.
+
+    container - Run one emulated container.  Used by 'run'; not meant to
+                be run by hand.
+
+Each container is a separate interpreter, so that, as under Lambda, a
+cold container pays for importing notifier.py and a warm one reuses the
+module state (config, clients, connections) of its earlier invocations.
+A container handles one invocation at a time and is reused while it has
+been idle for less than the idle time; after that it is retired, so the
+next invocation starts a new, cold container.
+
+Each invocation is passed a Lambda-like context whose remaining time
+counts down from the function timeout.  The config is the given file,
+with the Twilio API pointed at a fake (see faketwilio.py) and any
+DynamoDB tables removed, so the coalescing store and ledger are kept in
+memory.  S3 is emulated by serving the config file, and the compiled
+snapshot that 'notifier.py config upload' would store alongside it, from
+a temporary directory.
+
+Options:
+    --rate=N           events per second [default: 20]
+    --duration=S       seconds over which events arrive [default: 10]
+    --concurrency=N    most invocations run at once [default: 10]
+    --idle=S           seconds a container may idle and stay warm
+                       [default: 300]
+    --timeout=MS       Lambda function timeout [default: 15000]
+    --config=PATH      notifier config to use [default: notifier.yml]
+    --no-snapshot      serve only the config file, not its snapshot
+    --handshake=MS     simulated Twilio connection setup [default: 30]
+    --latency=MS       simulated Twilio API response time [default: 5]
+    --verbose          show the containers' logs
+
+'''
+
+# Only the standard library is imported here, so that 'loadtest
+# container' can time its import of notifier.py as a cold start.
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import uuid
+
+
+FUNCTION_NAME = 'EM247-Notifier'
+
+CLICK_TYPES = ('SINGLE', 'DOUBLE', 'LONG')
+
+
+class LambdaContext(object):
+    '''The parts of the Lambda context object that handlers use.'''
+
+    def __init__(self, timeout_ms, memory_limit_in_mb=512):
+        self.function_name = FUNCTION_NAME
+        self.function_version = '$LATEST'
+        self.invoked_function_arn = (
+            'arn:aws:lambda:us-west-2:123456789012:function:%s' %
+            FUNCTION_NAME)
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = '/aws/lambda/%s' % FUNCTION_NAME
+        self.log_stream_name = 'loadtest/%d' % os.getpid()
+        self.identity = None
+        self.client_context = None
+        self.deadline = time.time() + timeout_ms / 1000.0
+
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.deadline - time.time()) * 1000), 0)
+
+
+class LocalS3(object):
+    '''Stand-in for the S3 client used by notifier.Config, serving
+    objects from files in a directory (see object_path()).
+
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        from botocore.exceptions import ClientError
+
+        try:
+            with open(object_path(self.directory, Key), 'rb') as f:
+                content = f.read()
+        except IOError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if etag == IfNoneMatch:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': _Body(content), 'ETag': etag}
+
+
+class _Body(object):
+
+    def __init__(self, content):
+        self.content = content
+
+
+    def read(self):
+        return self.content
+
+
+def object_path(directory, key):
+    return os.path.join(directory, urllib.quote(key, safe=''))
+
+
+def run_container(objects, timeout_ms):
+    '''Serve invocations read from stdin, one JSON event per line,
+    writing one JSON result per line to stdout.  The first line written
+    reports the time taken to import notifier.py.
+
+    '''
+
+    # Anything the handler prints goes to stderr; stdout is for results.
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout = sys.stderr
+
+    start = time.time()
+    import notifier
+    init = time.time() - start
+
+    notifier._s3_clients[None] = LocalS3(objects)
+    results.write(json.dumps(dict(init=init)) + '\n')
+    results.flush()
+
+    for line in iter(sys.stdin.readline, ''):
+        event = json.loads(line)
+        context = LambdaContext(timeout_ms)
+        start = time.time()
+        result = dict(ok=True)
+        try:
+            response = notifier.lambda_handler(event, context)
+            result['notifications'] = len(response.get('notifications', []))
+        except Exception as exc:
+            result.update(ok=False, error='%s: %s' % (type(exc).__name__,
+                                                      exc))
+        result['duration'] = time.time() - start
+        result['timed_out'] = result['duration'] * 1000 > timeout_ms
+        results.write(json.dumps(result) + '\n')
+        results.flush()
+
+
+class Container(object):
+    '''An emulated container, running 'loadtest container'.'''
+
+    def __init__(self, objects, timeout, verbose=False):
+        start = time.time()
+        stderr = None if verbose else open(os.devnull, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, '-B', os.path.abspath(__file__), 'container',
+             '--objects=%s' % objects, '--timeout=%s' % timeout],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.init = json.loads(self.process.stdout.readline())['init']
+        self.start_time = time.time() - start
+        self.last_used = time.time()
+
+
+    def invoke(self, event):
+        self.process.stdin.write(json.dumps(event) + '\n')
+        self.process.stdin.flush()
+        result = json.loads(self.process.stdout.readline())
+        self.last_used = time.time()
+        return result
+
+
+    def stop(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class Runtime(object):
+    '''Hands each invocation to a warm container if one is idle, and
+    otherwise to a new, cold one.
+
+    '''
+
+    def __init__(self, objects, timeout, idle, verbose=False):
+        self.objects = objects
+        self.timeout = timeout
+        self.idle = idle
+        self.verbose = verbose
+        self.warm = []
+        self.lock = threading.Lock()
+        self.inits = []
+        self.start_times = []
+
+
+    def _acquire(self):
+        '''Returns (container, cold).'''
+        with self.lock:
+            while self.warm:
+                container = self.warm.pop()
+                if time.time() - container.last_used < self.idle:
+                    return container, False
+                container.stop()
+        container = Container(self.objects, self.timeout, self.verbose)
+        with self.lock:
+            self.inits.append(container.init)
+            self.start_times.append(container.start_time)
+        return container, True
+
+
+    def invoke(self, event):
+        container, cold = self._acquire()
+        result = container.invoke(event)
+        result['cold'] = cold
+        with self.lock:
+            self.warm.append(container)
+        return result
+
+
+    def stop(self):
+        with self.lock:
+            for container in self.warm:
+                container.stop()
+            self.warm = []
+
+
+def make_event(serials):
+    return {
+        'serialNumber': random.choice(serials),
+        'clickType': random.choice(CLICK_TYPES),
+        'batteryVoltage': '%d mV' % random.randint(1500, 2000),
+    }
+
+
+def publish_config(config_path, directory, server, snapshot):
+    '''Store the config, pointed at the fake Twilio server, and its
+    snapshot as the objects LocalS3 serves from directory.  Returns the
+    serial numbers the config routes, plus one it does not.
+
+    '''
+
+    import yaml
+    import notifier
+
+    with open(config_path) as f:
+        cfg = yaml.load(f)
+    cfg['twilio']['base_url'] = server.base_url
+    for section in ('coalesce', 'ledger'):
+        if isinstance(cfg['notifier'].get(section), dict):
+            cfg['notifier'][section].pop('table', None)
+    source = yaml.safe_dump(cfg)
+
+    config = notifier.Config()
+    config._compile(source)
+    objects = {config.config_key_name: source}
+    if snapshot:
+        objects[config.config_key_name + notifier.SNAPSHOT_SUFFIX] = (
+            config.snapshot())
+    for key, content in objects.items():
+        with open(object_path(directory, key), 'wb') as f:
+            f.write(content)
+    return sorted(config.routes.index) + ['G030JF0000000000']
+
+
+def run(args):
+
+    from concurrent import futures
+
+    from benchmark import summarize
+    from faketwilio import FakeTwilioServer
+
+    server = FakeTwilioServer(handshake=float(args.handshake) / 1000,
+                              latency=float(args.latency) / 1000).start()
+    directory = tempfile.mkdtemp(prefix='notifier-loadtest-')
+    serials = publish_config(args.config, directory, server,
+                             not args.nosnapshot)
+    runtime = Runtime(directory, args.timeout, float(args.idle),
+                      args.verbose)
+    rate = float(args.rate)
+    count = int(rate * float(args.duration))
+    print('%d events at %s/s, concurrency %s, against fake Twilio at %s' % (
+        count, args.rate, args.concurrency, server.base_url))
+
+    executor = futures.ThreadPoolExecutor(max_workers=int(args.concurrency))
+    pending = []
+    start = time.time()
+    try:
+        for i in range(count):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pending.append(executor.submit(runtime.invoke,
+                                           make_event(serials)))
+        results = [f.result() for f in pending]
+        elapsed = time.time() - start
+    finally:
+        executor.shutdown()
+        runtime.stop()
+        server.stop()
+        shutil.rmtree(directory)
+
+    failed = [r for r in results if not r['ok']]
+    print('%d invocations in %.2fs: %.1f invocations/s, %d cold, '
+          '%d failed, %d timed out' % (
+              len(results), elapsed, len(results) / elapsed,
+              len([r for r in results if r['cold']]), len(failed),
+              len([r for r in results if r['timed_out']])))
+    summarize('duration', [r['duration'] for r in results])
+    for cold in (True, False):
+        samples = [r['duration'] for r in results if r['cold'] == cold]
+        if samples:
+            summarize('duration (%s)' % ('cold' if cold else 'warm'),
+                      samples)
+    summarize('init (import notifier)', runtime.inits)
+    summarize('container start', runtime.start_times)
+    for error in sorted(set(r['error'] for r in failed))[:5]:
+        print('error: %s' % error)
+
+
+
+if __name__ == '__main__':
+
+    from docopt import docopt
+
+    args = docopt(__doc__)
+
+    if args['container']:
+        run_container(args['--objects'], int(args['--timeout']))
+    elif args['run']:
+        from dotmap import DotMap
+        args = {k.replace('-', '') : args[k] for k in args.keys()}
+        run(DotMap(args))
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
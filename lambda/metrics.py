@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+'''Per-invocation timing metrics for the notifier.
+
+A Metrics object collects the duration of each phase of an invocation
+(fetching and parsing the config, constructing the Twilio client, each
+Twilio request, ...) and counts such as the number of recipients and
+of failed notifications.  emit() then prints them as one JSON log line
+in CloudWatch Embedded Metric Format, from which CloudWatch Logs
+extracts them as metrics; see
+https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+NULL_METRICS has the same interface but does nothing, so instrumented
+code runs at full speed when metrics are turned off (notifier.metrics
+in the config).
+
+'''
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+
+NAMESPACE = 'EM247/Notifier'
+
+# A phase timed more than once in an invocation (e.g., a Twilio request
+# per recipient) is reported as a list of values; EMF allows at most
+# this many.
+MAX_VALUES = 100
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'name', 'start')
+
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, (time.time() - self.start) * 1000)
+
+
+class Metrics(object):
+
+
+    def __init__(self, namespace=NAMESPACE):
+        self.namespace = namespace
+        self.dimensions = {}
+        self.properties = {}
+        self.timings = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+
+    def timer(self, name):
+        '''Returns a context manager that records the duration of its
+        block as the phase name.
+
+        '''
+
+        return _Timer(self, name)
+
+
+    def record(self, name, milliseconds):
+        '''Record a duration of the phase name.'''
+        with self.lock:
+            values = self.timings.setdefault(name, [])
+            if len(values) < MAX_VALUES:
+                values.append(round(milliseconds, 3))
+
+
+    def count(self, name, n=1):
+        '''Add n to the count name.'''
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+
+    def set_property(self, name, value):
+        '''Set a value that is logged, but is not a metric.'''
+        self.properties[name] = value
+
+
+    def document(self):
+        '''Returns the metrics as an Embedded Metric Format document.'''
+
+        with self.lock:
+            definitions = (
+                [dict(Name=name, Unit='Milliseconds')
+                 for name in sorted(self.timings)] +
+                [dict(Name=name, Unit='Count')
+                 for name in sorted(self.counts)])
+            document = dict(self.properties)
+            document.update(self.dimensions)
+            for name, values in self.timings.items():
+                document[name] = values[0] if len(values) == 1 else values
+            document.update(self.counts)
+
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': definitions,
+            }],
+        }
+        return document
+
+
+    def emit(self):
+        '''Print the metrics as one line of JSON.'''
+        print(json.dumps(self.document(), sort_keys=True))
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullMetrics(object):
+    '''Metrics that are not collected.'''
+
+    _timer = _NullTimer()
+
+
+    def timer(self, name):
+        return self._timer
+
+
+    def record(self, name, milliseconds):
+        pass
+
+
+    def count(self, name, n=1):
+        pass
+
+
+    def set_dimension(self, name, value):
+        pass
+
+
+    def set_property(self, name, value):
+        pass
+
+
+    def emit(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -56,6 +56,13 @@ will look something like this:
         },
     }
 
+Buttons may also be routed to other people and recipients by serial
+number; see routing.py.
+
+'config upload' also stores a compiled snapshot of the config file
+alongside it on S3 (see Config.upload()), which the handler loads in
+place of the config file.
+
 Two environment variables must be set to use this code, either on
 Lambda or locally:
 
@@ -75,24 +82,166 @@ function will fail.
 
 from __future__ import print_function
 
+import atexit
+import hashlib
+import json
 import time
 import os
-import platform
-import re
-import StringIO
-import sys
-import yaml
+import signal
+import threading
 
-from pprint import pprint as pp
 from urllib import urlencode
 
 import boto3
 
+from botocore.config import Config as BotocoreConfig
+from botocore.exceptions import ClientError
+
+import audit
+import coalesce
+import ledger
+import metrics
+import routing
+import senders
+
 # NOTE that any packages used past this point MUST be
 # included in the Lambda Distribution Package for this code.
+#
+# Cold starts add directly to the time taken to notify, so only modules
+# needed on every invocation are imported here.  Others (yaml, docopt,
+# pprint) are imported where they are used.
 
+from concurrent import futures
 from dotmap import DotMap
 from twilio.rest import TwilioRestClient
+from twilio.rest.exceptions import TwilioRestException
+from twilio.rest.resources import base as twilio_base
+from twilio.rest.resources.imports import httplib2
+
+
+TWILIO_BASE_URL = 'https://api.twilio.com'
+
+# Twilio Notify, which sends one SMS message to many recipients in a
+# single request, through a Notify service's Messaging Service.  A
+# request may name at most NOTIFY_MAX_BINDINGS recipients.
+NOTIFY_BASE_URL = 'https://notify.twilio.com'
+NOTIFY_MAX_BINDINGS = 10000
+
+# Serves the TwiML passed in its query string; used for voice calls when
+# TwiML can't be passed inline in the call request.
+TWIMLETS_ECHO_URL = 'http://twimlets.com/echo'
+
+# Twilio's limit on the length of TwiML passed inline.
+MAX_INLINE_TWIML = 4000
+
+# Clients are cached at module level.  Lambda reuses a warm container --
+# and therefore this module -- across invocations, so a cached client
+# skips client construction and reuses connections that are already
+# open, rather than paying for a new TLS handshake on every invocation.
+_s3_clients = {}
+_twilio_clients = {}
+
+# Idle httplib2.Http objects used by _pooled_make_request(), by
+# credentials.  Each invocation notifies on new threads, so the pool is
+# shared by all threads rather than kept per thread.
+_http_pool = {}
+_http_pool_lock = threading.Lock()
+
+# The twilio library's own (non-pooling) request function.
+_twilio_make_request = twilio_base.make_request
+
+# Time allowed for notifications when there is no Lambda context to ask
+# (i.e., when running locally), and the time held back from the Lambda
+# deadline so the handler can report results before Lambda kills it.
+DEFAULT_DEADLINE_MS = 10000
+DEFAULT_DEADLINE_MARGIN_MS = 1000
+
+# Twilio requests time out at the deadline, so that a notification
+# abandoned then, and reported as failed, is not completed afterward.
+# The timeout is rounded down to a multiple of REQUEST_TIMEOUT_STEP
+# seconds, so that few clients are cached for the different timeouts,
+# and is never less than that.
+REQUEST_TIMEOUT_STEP = 0.5
+
+# Event sent by the schedule that flushes coalesced click summaries.
+FLUSH_EVENT = {'notifier': 'flush'}
+
+# Event sent by the keep-warm schedule (see 'helper.py warm').  It is
+# answered at once, without loading the config or contacting Twilio; its
+# only purpose is to keep a container initialized for the next click.
+PING_EVENT = {'notifier': 'ping'}
+
+DEFAULT_SUMMARY_MESSAGE = (
+    "{name}'s button was pressed {clicks} times, last {clickType}.")
+
+# Configs loaded from S3, by location, along with their ETags.  A warm
+# container re-parses the config file (and rebuilds its routing index)
+# only when the file has changed.
+_configs = {}
+
+# The compiled snapshot of the config file is stored on S3 under the
+# config file's key plus this suffix.  SNAPSHOT_FORMAT changes whenever
+# the snapshot's layout does.
+SNAPSHOT_SUFFIX = '.snapshot.json'
+SNAPSHOT_FORMAT = 1
+
+# Coalescing stores and ledgers, cached for the same reason as the
+# clients above.
+_stores = {}
+
+# Pools of SMS source numbers (see senders.py), kept per container so
+# their rate limits span warm invocations.  A number in a pool may send
+# DEFAULT_SMS_PER_SECOND messages per second in bursts of up to
+# DEFAULT_SMS_BURST.  A message answered with 429 (Too Many Requests) is
+# sent again, up to SMS_ATTEMPTS times in all, once the number that sent
+# it has rested for THROTTLED_REST_SECONDS, doubled for each attempt.
+_sender_pools = {}
+DEFAULT_SMS_PER_SECOND = 1
+DEFAULT_SMS_BURST = 5
+SMS_ATTEMPTS = 3
+THROTTLED_REST_SECONDS = 1.0
+
+
+# Audit logs (see audit.py), by bucket, prefix, and AWS profile, kept
+# per container so that the records of warm invocations are written to
+# S3 together.
+_audit_logs = {}
+
+# The audit log is written with its own S3 client, which gives up on a
+# write after AUDIT_CONNECT_TIMEOUT seconds connecting or
+# AUDIT_READ_TIMEOUT seconds waiting for S3, without retrying, rather
+# than after the default client's 60-second timeouts and retries.
+AUDIT_CONNECT_TIMEOUT = 1
+AUDIT_READ_TIMEOUT = 2
+
+# An invocation with less than DEFAULT_AUDIT_FLUSH_MARGIN_MS left before
+# the Lambda deadline leaves a due audit log for a later invocation, the
+# scheduled flush event, or exit; one that flushes writes at most
+# DEFAULT_AUDIT_MAX_GROUPS objects.
+DEFAULT_AUDIT_FLUSH_MARGIN_MS = 5000
+DEFAULT_AUDIT_MAX_GROUPS = 4
+
+# Whether install_exit_hooks() has been called.
+_exit_hooks = [False]
+
+
+# Whether this container has yet to handle an invocation, and when it
+# was initialized.
+_cold = [True]
+_initialized = time.time()
+
+# The metric (see metrics.py) under which the time taken by each kind of
+# notification is recorded.
+NOTIFY_METRICS = dict(voice='TwilioVoice', sms='TwilioSMS',
+                      summary='TwilioSummary', bulk='TwilioBulkSMS')
+
+
+class NotificationError(Exception):
+    '''Raised by lambda_handler() when notifications failed and a
+    ledger is configured, so that Lambda retries the event.
+
+    '''
+    pass
 
 
 def lambda_handler(event, context, aws_profile_name=None):
@@ -103,14 +252,500 @@ def lambda_handler(event, context, aws_profile_name=None):
     Lambda; it is only used when running locally.  aws_profile_name
     specifies the AWS profile to use when saving data to an S3 bucket.
 
+    If notifier.ledger is configured and any notification fails,
+    NotificationError is raised, so that Lambda retries the event; the
+    ledger ensures that the retry sends only the failed notifications.
+
+    Unless notifier.metrics is false, the duration of each phase of the
+    invocation is logged as metrics (see metrics.py).
+
+    If notifier.debug_bucket is configured, the event and the outcome
+    of each notification are added to the audit log (see audit.py),
+    which is written once the notifications have been sent.
+
+    A keep-warm ping (PING_EVENT) is answered at once, with nothing
+    logged, and only serves to keep the container initialized.
+
+    '''
+
+    if event.get('notifier') == PING_EVENT['notifier']:
+        cold, _cold[0] = _cold[0], False
+        return {'event': event, 'cold': cold,
+                'containerAge': round(time.time() - _initialized, 3)}
+
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        install_exit_hooks()
+
+    start = time.time()
+    stats = metrics.Metrics()
+    try:
+        config = Config()
+        config.load(aws_profile_name=aws_profile_name, filepath=None,
+                    stats=stats)
+        if not config.config.notifier.get('metrics', True):
+            stats = metrics.NULL_METRICS
+        stats.set_dimension('FunctionName', getattr(
+            context, 'function_name', 'local'))
+        stats.set_property('requestId', getattr(
+            context, 'aws_request_id', None))
+        stats.set_property('configVersion', config.version)
+        stats.count('ColdStart', 1 if _cold[0] else 0)
+        _cold[0] = False
+        return handle_event(event, context, config, stats)
+    except Exception:
+        stats.count('HandlerErrors')
+        raise
+    finally:
+        stats.record('Duration', (time.time() - start) * 1000)
+        stats.emit()
+
+
+def handle_event(event, context, config, stats=metrics.NULL_METRICS):
+    '''Handles the event with an already loaded Config: notifies,
+    coalesces, and records in the ledger and the audit log, as
+    configured.  Used by lambda_handler(), and by the local notifier
+    daemon (notifierd.py), which keeps the Config loaded between
+    events.
+
+    '''
+
+    audit_log = get_audit_log(config)
+    error = None
+    try:
+        return _handle(event, context, config, stats)
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        if audit_log:
+            audit_invocation(audit_log, event, context, stats, error)
+
+
+def _handle(event, context, config, stats):
+    '''Handles the event for handle_event().'''
+
+    coalescer = get_coalescer(config.config)
+    sent = get_ledger(config.config)
+    event_id = event_identity(event, context)
+
+    if event.get('notifier') == FLUSH_EVENT['notifier']:
+        with stats.timer('Coalesce'):
+            due = coalescer.due() if coalescer else []
+        response = {'event': event, 'notifications': [],
+                    'summaries': send_summaries(due, context, config, sent,
+                                                stats)}
+        unsent = unsent_summaries(due, response['summaries'])
+        if unsent:
+            with stats.timer('Coalesce'):
+                coalescer.release(unsent)
+    else:
+        response = {'event': event, 'notifications': []}
+        due = []
+        if coalescer:
+            with stats.timer('Coalesce'):
+                window, due = coalescer.record(event.get('serialNumber'),
+                                               event.get('clickType'),
+                                               event_id)
+            response['clicks'] = window['clicks']
+        if not coalescer or window['first_event'] == event_id:
+            notifier = Notifier(event, context, config, sent, stats)
+            response['notifications'] = notifier.notify()
+        if due:
+            response['summaries'] = send_summaries(due, context, config,
+                                                   sent, stats)
+            # Otherwise they stay pending, for a retry or a flush.
+            if not unsent_summaries(due, response['summaries']):
+                with stats.timer('Coalesce'):
+                    coalescer.settle(window, due)
+
+    results = response['notifications'] + response.get('summaries', [])
+    failed = [r for r in results if not r['ok']]
+    if sent and failed:
+        raise NotificationError('%d of %d notifications failed: %s' % (
+            len(failed), len(results), json.dumps(failed)))
+    return response
+
+
+def event_identity(event, context):
+    '''Returns a string identifying the event, which is the same when
+    Lambda retries the event.
+
+    That is the event's 'eventId' if it has one (an IoT rule can add one
+    with newuuid()), otherwise the Lambda request id, which Lambda
+    reuses when it retries an asynchronous invocation.  Locally, with no
+    context, it is a hash of the event.
+
+    '''
+
+    if event.get('eventId'):
+        return event['eventId']
+    if context is not None:
+        return context.aws_request_id
+    return hashlib.sha1(json.dumps(event, sort_keys=True)).hexdigest()
+
+
+def get_audit_log(config):
+    '''Returns the audit.AuditLog writing to notifier.debug_bucket, or
+    None if no debug bucket is configured.  Its thresholds are taken
+    from notifier.audit, if given.
+
+    '''
+
+    cfg = config.config
+    bucket = cfg.notifier.get('debug_bucket')
+    if not bucket:
+        return None
+
+    settings = cfg.notifier.get('audit') or {}
+    aws_profile_name = cfg.notifier.get('aws_profile_name')
+    prefix = settings.get('prefix', audit.DEFAULT_PREFIX)
+    key = (bucket, prefix, aws_profile_name)
+    audit_log = _audit_logs.get(key)
+    if audit_log is None:
+        audit_log = _audit_logs[key] = audit.AuditLog(
+            get_audit_s3client(aws_profile_name), bucket, prefix)
+    # The thresholds follow the config as it changes.
+    audit_log.max_records = settings.get('max_records',
+                                         audit.DEFAULT_MAX_RECORDS)
+    audit_log.max_bytes = settings.get('max_bytes', audit.DEFAULT_MAX_BYTES)
+    audit_log.max_seconds = settings.get('max_seconds',
+                                         audit.DEFAULT_MAX_SECONDS)
+    audit_log.flush_margin_ms = settings.get('flush_margin_ms',
+                                             DEFAULT_AUDIT_FLUSH_MARGIN_MS)
+    audit_log.max_groups = settings.get('max_groups',
+                                        DEFAULT_AUDIT_MAX_GROUPS)
+    return audit_log
+
+
+def get_audit_s3client(aws_profile_name):
+    '''Returns a new S3 client for writing an audit log, with short
+    timeouts and no retries.
+
+    '''
+
+    try:
+        client_config = BotocoreConfig(connect_timeout=AUDIT_CONNECT_TIMEOUT,
+                                       read_timeout=AUDIT_READ_TIMEOUT,
+                                       retries={'max_attempts': 0})
+    except TypeError:
+        # botocore before 1.6 has no retries option; the client's retry
+        # handler is removed below instead.
+        client_config = BotocoreConfig(connect_timeout=AUDIT_CONNECT_TIMEOUT,
+                                       read_timeout=AUDIT_READ_TIMEOUT)
+    if aws_profile_name:
+        # non-Lambda invocation
+        session = boto3.Session(profile_name=aws_profile_name)
+        s3client = session.client('s3', config=client_config)
+    else:
+        # Lambda invocation
+        s3client = boto3.client('s3', config=client_config)
+    s3client.meta.events.unregister('needs-retry.s3',
+                                    unique_id='retry-config-s3')
+    return s3client
+
+
+def audit_invocation(audit_log, event, context, stats, error=None):
+    '''Adds the event, and the error the handler raised if any, to the
+    audit log, then writes the log if it is due.  The scheduled flush
+    event is not recorded, but writes the log whether or not it is due,
+    so that an idle container's records are not held indefinitely.
+    Other events write at most audit_log.max_groups objects, and none
+    if less than audit_log.flush_margin_ms is left before the deadline,
+    leaving the rest to a later invocation, the flush event, or exit.
+
+    Audit failures are printed rather than raised, since the
+    notifications have already been sent.
+
+    '''
+
+    try:
+        max_groups = None
+        if event.get('notifier') == FLUSH_EVENT['notifier']:
+            due = True
+        else:
+            record = dict(record='event', event=event,
+                          eventId=event_identity(event, context),
+                          requestId=getattr(context, 'aws_request_id', None))
+            if error is not None:
+                record['error'] = '%s: %s' % (type(error).__name__, error)
+            audit_log.add(record, event.get('serialNumber'))
+            due = audit_log.due() and (
+                context is None or
+                context.get_remaining_time_in_millis() >=
+                audit_log.flush_margin_ms)
+            max_groups = audit_log.max_groups
+        if due:
+            with stats.timer('AuditWrite'):
+                stats.count('AuditRecords', audit_log.flush(max_groups))
+    except Exception as exc:
+        print('Audit failed: %s' % exc)
+
+
+def flush_audit_logs():
+    '''Write every audit log's buffered records.  Run at exit, and on
+    SIGTERM, once install_exit_hooks() has been called, so that records
+    are not lost when the container shuts down.
+
     '''
 
-    config = Config()
-    config.load(aws_profile_name=aws_profile_name, filepath=None)
-    notifier = Notifier(event, context, config)
-    notifier.notify()
+    for audit_log in _audit_logs.values():
+        try:
+            audit_log.flush()
+        except Exception as exc:
+            print('Audit failed: %s' % exc)
+
+
+def _terminate(signum, frame):
+    flush_audit_logs()
+    raise SystemExit(128 + signum)
+
+
+def install_exit_hooks():
+    '''Arrange for flush_audit_logs() to run at exit, and on SIGTERM
+    unless a handler for it is already set.  Called by lambda_handler()
+    when running under Lambda, and from the command line; other users of
+    this module (e.g., notifierd.py) flush the audit logs themselves.
+
+    '''
+
+    if _exit_hooks[0]:
+        return
+    _exit_hooks[0] = True
+    atexit.register(flush_audit_logs)
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _terminate)
+    except ValueError:
+        # Called outside the main thread, where handlers can't be set.
+        pass
+
 
-    return {'event': event}
+def get_coalescer(cfg):
+    '''Returns the coalesce.Coalescer described by notifier.coalesce in
+    the config, or None if clicks are not to be coalesced.
+
+    '''
+
+    settings = cfg.notifier.get('coalesce')
+    if not settings or not settings.get('window_seconds'):
+        return None
+
+    store = _get_store(cfg, settings.get('table'),
+                       coalesce.DynamoStore, coalesce.MemoryStore)
+    return coalesce.Coalescer(store, settings.window_seconds)
+
+
+def get_ledger(cfg):
+    '''Returns the ledger (see ledger.py) described by notifier.ledger
+    in the config, or None if completed notifications are not recorded.
+
+    '''
+
+    settings = cfg.notifier.get('ledger')
+    if not settings:
+        return None
+    return _get_store(cfg, settings.get('table'),
+                      ledger.DynamoLedger, ledger.MemoryLedger)
+
+
+def _get_store(cfg, table, dynamo_class, memory_class):
+    '''Returns a cached dynamo_class instance for the DynamoDB table, or,
+    if no table is given, a cached memory_class instance.
+
+    '''
+
+    aws_profile_name = cfg.notifier.get('aws_profile_name')
+    key = (dynamo_class, table, aws_profile_name)
+    store = _stores.get(key)
+    if store is None:
+        if table:
+            session = (boto3.Session(profile_name=aws_profile_name)
+                       if aws_profile_name else None)
+            store = dynamo_class(table, session)
+        else:
+            store = memory_class()
+        _stores[key] = store
+    return store
+
+
+def send_summaries(windows, context, config, sent=None,
+                   stats=metrics.NULL_METRICS):
+    '''Send the summary message for each of the closed click windows
+    (see coalesce.py).  Returns a list of the notification results,
+    each with the 'eventId' of its window's summary.
+
+    Each summary is its own event, identified by its window, so that the
+    ledger tells apart the summaries sent by one invocation, and a
+    summary sent again, by a retry or a later flush, is not repeated.
+
+    '''
+
+    results = []
+    for window in windows:
+        event = dict(eventId=summary_identity(window),
+                     serialNumber=window['serialNumber'],
+                     clickType=window['last_click'],
+                     clicks=window['clicks'])
+        notifier = Notifier(event, context, config, sent, stats)
+        results.extend(dict(result, eventId=event['eventId'])
+                       for result in notifier.notify(kinds=('summary',)))
+    return results
+
+
+def summary_identity(window):
+    '''Returns the event identity of the summary of a click window.'''
+    return '%s:%s' % (window['serialNumber'], window['window_start'])
+
+
+def unsent_summaries(windows, results):
+    '''Returns those of windows whose summaries, according to results
+    (from send_summaries()), were not sent to every recipient.
+
+    '''
+
+    failed = set(r['eventId'] for r in results if not r['ok'])
+    return [w for w in windows if summary_identity(w) in failed]
+
+
+def get_sender_pool(cfg):
+    '''Returns the senders.SenderPool of SMS source numbers described by
+    the 'twilio' section of the config: twilio.source_numbers, or else
+    just twilio.source_number.  The latter is not rate limited unless
+    twilio.sms_per_second is given, since Twilio queues the messages
+    sent from a single number itself.
+
+    '''
+
+    numbers = cfg.get('source_numbers')
+    rate = cfg.get('sms_per_second', DEFAULT_SMS_PER_SECOND)
+    if not numbers:
+        numbers = [cfg.source_number]
+        rate = cfg.get('sms_per_second')
+    burst = cfg.get('sms_burst', DEFAULT_SMS_BURST)
+    key = (tuple(numbers), rate, burst)
+    pool = _sender_pools.get(key)
+    if pool is None:
+        pool = _sender_pools[key] = senders.SenderPool(numbers, rate, burst)
+    return pool
+
+
+def get_twilio_client(account_sid, auth_token, base_url=TWILIO_BASE_URL,
+                      timeout=None):
+    '''Returns a TwilioRestClient whose requests time out after timeout
+    seconds (if not None), reusing one created by an earlier invocation
+    in this container if there is one.
+
+    '''
+
+    key = (account_sid, auth_token, base_url, timeout)
+    client = _twilio_clients.get(key)
+    if client is None:
+        client = TwilioRestClient(
+            account_sid, auth_token, base=base_url,
+            timeout=twilio_base.UNSET_TIMEOUT if timeout is None else timeout)
+        _twilio_clients[key] = client
+    return client
+
+
+def warm_connections(cfg, connections):
+    '''Open up to connections kept-alive connections to the Twilio API,
+    or refresh those already open, by fetching the account resource
+    that many times at once.  Used by notifierd.py, so that a click
+    after a quiet spell does not wait on connection setup.  Does nothing
+    unless twilio.keep_alive is on.  Returns the number of requests that
+    succeeded.
+
+    '''
+
+    if not cfg.twilio.get('keep_alive', True):
+        return 0
+    set_keep_alive(True)
+    client = get_twilio_client(cfg.twilio.account_sid, cfg.twilio.auth_token,
+                               cfg.twilio.get('base_url', TWILIO_BASE_URL))
+    executor = futures.ThreadPoolExecutor(max_workers=connections)
+    try:
+        pending = [executor.submit(client.accounts.get,
+                                   cfg.twilio.account_sid)
+                   for _ in range(connections)]
+    finally:
+        executor.shutdown()
+    failed = [f.exception() for f in pending if f.exception()]
+    if failed:
+        print('Warming Twilio connections failed: %s' % failed[0])
+    return connections - len(failed)
+
+
+def set_keep_alive(enabled):
+    '''Enable or disable HTTP keep-alive for Twilio API requests.
+
+    The twilio library creates a new httplib2.Http object for every
+    request, so every request opens a new connection and, because
+    httplib2 only sends credentials after a 401 challenge, makes two
+    round trips.  When enabled, the library's make_request() is replaced
+    by _pooled_make_request(), which avoids both.
+
+    '''
+
+    if enabled:
+        twilio_base.make_request = _pooled_make_request
+    else:
+        twilio_base.make_request = _twilio_make_request
+
+
+def _utf8(value):
+    '''Returns value (or each item of a list value) encoded as UTF-8.'''
+
+    if isinstance(value, (list, tuple, set)):
+        return [_utf8(item) for item in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _pooled_make_request(method, url, params=None, data=None, headers=None,
+                         cookies=None, files=None, auth=None, timeout=None,
+                         allow_redirects=False, proxies=None):
+    '''Drop-in replacement for twilio.rest.resources.base.make_request()
+    that reuses httplib2.Http objects from a pool kept per set of
+    credentials.  An Http object holds its connection open and
+    remembers that the server wants Basic authentication, so later
+    requests reuse the connection and are authenticated on the first
+    try.  Each request is given its own timeout, on the connection it
+    reuses as well as on any it opens.
+
+    httplib2.Http is not thread-safe, so each is checked out of the pool
+    for the duration of a request.  Concurrent requests use separate
+    Http objects, and therefore separate connections.  An Http object
+    whose request failed is not returned to the pool.
+
+    '''
+
+    with _http_pool_lock:
+        idle = _http_pool.setdefault(auth, [])
+        http = idle.pop() if idle else None
+    if http is None:
+        http = httplib2.Http(ca_certs=twilio_base.get_cert_file(),
+                             proxy_info=twilio_base.Connection.proxy_info())
+        if auth is not None:
+            http.add_credentials(auth[0], auth[1])
+    http.follow_redirects = allow_redirects
+    http.timeout = timeout
+    for conn in http.connections.values():
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    if data is not None:
+        data = urlencode(dict((_utf8(k), _utf8(v)) for k, v in data.items()),
+                         doseq=True)
+    if params is not None:
+        separator = '&' if '?' in url else '?'
+        url = '%s%s%s' % (url, separator, urlencode(params, doseq=True))
+
+    resp, content = http.request(url, method, headers=headers, body=data)
+    with _http_pool_lock:
+        idle.append(http)
+    return twilio_base.Response(resp, content.decode('utf-8'), url)
 
 
 class Config(object):
@@ -132,10 +767,15 @@ class Config(object):
 
 
     def get_s3client(self, aws_profile_name):
-        '''Returns a boto S3 client object.
+        '''Returns a boto S3 client object.  The client is cached so
+        that warm invocations reuse it and its connection pool.
 
         '''
 
+        s3client = _s3_clients.get(aws_profile_name)
+        if s3client is not None:
+            return s3client
+
         if aws_profile_name:
             # non-Lambda invocation
             session = boto3.Session(profile_name=aws_profile_name)
@@ -143,6 +783,7 @@ class Config(object):
         else:
             # Lambda invocation
             s3client = boto3.client('s3')
+        _s3_clients[aws_profile_name] = s3client
         return s3client
 
 
@@ -152,17 +793,80 @@ class Config(object):
 
         '''
 
+        import yaml
         return DotMap(yaml.load(stream))
 
 
+    def _compile(self, source):
+        '''Sets self.config, self.routes, and self.version from the YAML
+        source of a config file.  The version is a hash of the source.
+
+        '''
+
+        self.config = self._parse(source)
+        self.routes = routing.Routes(self.config.notifier)
+        self.version = hashlib.sha1(source).hexdigest()
+
+
+    def snapshot(self):
+        '''Returns the compiled snapshot of the loaded config, as JSON.
+
+        The snapshot holds the config, less the groups and profiles
+        which are compiled into its routes, and the routes themselves
+        (see routing.Routes.snapshot()).  Loading it takes a fraction of
+        the time taken to parse the YAML and compile the routes.
+
+        '''
+
+        config = self.config.toDict()
+        for key in ('groups', 'profiles', 'aws_profile_name'):
+            config['notifier'].pop(key, None)
+        return json.dumps(dict(format=SNAPSHOT_FORMAT,
+                               version=self.version,
+                               config=config,
+                               routes=self.routes.snapshot()),
+                          separators=(',', ':'))
+
+
+    def _load_snapshot(self, source):
+        '''Sets self.config, self.routes, and self.version from a
+        snapshot().
+
+        '''
+
+        snapshot = json.loads(source)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            msg = 'Unsupported config snapshot format: %s' % (
+                snapshot.get('format'))
+            raise ValueError, msg
+        self.config = DotMap(snapshot['config'])
+        self.routes = routing.Routes.from_snapshot(snapshot['routes'])
+        self.version = snapshot['version']
+
+
     def upload(self, aws_profile_name, filepath):
-        '''Upload a local file to S3.'''
+        '''Upload a local file to S3, along with its compiled snapshot.
+
+        The file is compiled first, so one that is not valid YAML or
+        whose button routes do not compile is not uploaded.  Returns
+        the version of the snapshot.
+
+        '''
 
-        s3client = self.get_s3client(aws_profile_name)
         with open(filepath, 'rb') as f:
-            s3client.upload_fileobj(f, self.config_bucket,
-                                    self.config_key_name)
-        return
+            source = f.read()
+        self._compile(source)
+        snapshot = self.snapshot()
+
+        s3client = self.get_s3client(aws_profile_name)
+        s3client.put_object(Bucket=self.config_bucket,
+                            Key=self.config_key_name,
+                            Body=source)
+        s3client.put_object(Bucket=self.config_bucket,
+                            Key=self.config_key_name + SNAPSHOT_SUFFIX,
+                            Body=snapshot,
+                            ContentType='application/json')
+        return self.version
     
 
     def get_content_stream(self, aws_profile_name, filepath):
@@ -212,14 +916,79 @@ class Config(object):
         return
 
     
-    def load(self, aws_profile_name, filepath):
+    def _load_s3(self, aws_profile_name, stats):
+        '''Sets self.config, self.routes, and self.version from the
+        config file's snapshot on S3 or, if it has none (i.e., it was
+        not stored by 'config upload'), from the config file itself.
+
+        Note that a config file changed by other means than 'config
+        upload' must be uploaded again; until then, the snapshot of its
+        previous version is used.
+
+        '''
+
+        try:
+            self._load_object(aws_profile_name,
+                              self.config_key_name + SNAPSHOT_SUFFIX,
+                              self._load_snapshot, stats)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            self._load_object(aws_profile_name, self.config_key_name,
+                              self._compile, stats)
+
+
+    def _load_object(self, aws_profile_name, key_name, load, stats):
+        '''Loads the S3 object key_name by calling load() with its
+        content, reusing the result of an earlier invocation in this
+        container if the object hasn't changed since.  The time taken to
+        fetch and to load the object are recorded in stats.
+
+        '''
+
+        key = (self.config_bucket, key_name, aws_profile_name)
+        cached = _configs.get(key)
+        kwargs = dict(Bucket=self.config_bucket, Key=key_name)
+        if cached:
+            kwargs['IfNoneMatch'] = cached[0]
+
+        with stats.timer('ConfigFetch'):
+            s3client = self.get_s3client(aws_profile_name)
+            try:
+                resp = s3client.get_object(**kwargs)
+                content = resp['Body'].read()
+            except ClientError as exc:
+                if cached and exc.response['Error']['Code'] in (
+                        '304', 'NotModified'):
+                    resp = None
+                else:
+                    raise
+        if resp is None:
+            stats.count('ConfigCached')
+            self.config, self.routes, self.version = cached[1:]
+            return
+
+        with stats.timer('ConfigParse'):
+            load(content)
+        _configs[key] = (resp['ETag'], self.config, self.routes,
+                         self.version)
+
+
+    def load(self, aws_profile_name, filepath,
+             stats=metrics.NULL_METRICS):
         '''Load the contents of a config file and return its resulting
-        DotMap object.
+        DotMap object.  Also compiles the config's button routes (see
+        routing.py) into self.routes, and sets self.version.  The time
+        taken is recorded in stats (see metrics.py).
 
         '''
 
-        stream = self.get_content_stream(aws_profile_name, filepath)
-        self.config = self._parse(stream)
+        if filepath:
+            with self.get_content_stream(aws_profile_name, filepath) as f:
+                with stats.timer('ConfigParse'):
+                    self._compile(f.read())
+        else:
+            self._load_s3(aws_profile_name, stats)
         # Note that aws_profile_name is added to the config here
         self.config.notifier.aws_profile_name = aws_profile_name
         return self.config
@@ -230,31 +999,51 @@ class Notifier(object):
 
     '''
 
-    def __init__(self, event, context, config):
+    def __init__(self, event, context, config, sent=None,
+                 stats=metrics.NULL_METRICS):
         '''Args:
               event (Lambda event) - 
                   Event passed by Lambda to the handler when triggered.
                   Currently unused.  Can be None.
               context (Lambda context) -
                   Context passed by Lambda to the handler when triggered.
-                  Currently unused.  Can be None.
+                  Used to determine the time remaining for notifications.
+                  Can be None.
               config (Config) -
                   A Config object populated with the contents of the YAML
                   configuration file stored on S3.
+              sent (ledger) -
+                  Ledger of completed notifications (see ledger.py).
+                  Notifications already recorded for this event are not
+                  sent again.  Can be None.
+              stats (metrics.Metrics) -
+                  Records the time taken by each notification.
 
         '''
 
         self.event = event
         self.context = context
         self.cfg = config.config
+        self.profile = config.routes.resolve(event.get('serialNumber'))
+        self.sent = sent
+        self.stats = stats
+        self.event_id = event_identity(event, context)
 
-        self.client = TwilioRestClient(self.cfg.twilio.account_sid,
-                                       self.cfg.twilio.auth_token)
+        set_keep_alive(self.cfg.twilio.get('keep_alive', True))
+        self.senders = get_sender_pool(self.cfg.twilio)
+        # Calls are always made from the same number, so that recipients
+        # recognize it.
+        self.source_number = (self.cfg.twilio.get('source_number') or
+                              self.cfg.twilio.source_numbers[0])
+        # The time by which notifications must be sent; see notify().
+        self.expires = None
 
-        try:
-            self.debug_bucket = self.cfg.notifier.debug_bucket
-        except KeyError:
-            self.debug_bucket = None
+        # Notification outcomes are recorded here; see audit.py.
+        self.audit = get_audit_log(config)
+
+        # Messages depending on the event are rendered once per event,
+        # when first needed, rather than for every recipient.
+        self._messages = {}
 
 
     def _clean_message(self, message):
@@ -265,22 +1054,301 @@ class Notifier(object):
                 String containing the voice/SMS message to be sent.
 
         '''
-        message = re.sub(r' {2,}', ' ', message)
-        message = re.sub(r'\n', ' ', message)
-        message = message.strip()
+        return routing.clean_message(message)
+
+
+    def _render(self, kind):
+        '''Returns the SMS message of the given kind ('sms' or 'summary')
+        for this event.
+
+        '''
+
+        message = self._messages.get(kind)
+        if message is not None:
+            return message
+
+        fields = dict(name=self.profile.person.name,
+                      address=self.profile.person.address,
+                      clickType=self.event.get('clickType', None),
+                      serialNumber=self.event.get('serialNumber', None))
+        if kind == 'sms':
+            fields.update(batteryVoltage=self.event.get('batteryVoltage',
+                                                        None))
+            template = self.profile.sms_message
+        else:
+            fields.update(clicks=self.event.get('clicks', None))
+            template = self.cfg.notifier.coalesce.get(
+                'summary_message', DEFAULT_SUMMARY_MESSAGE)
+        message = self._messages[kind] = self._clean_message(
+            template.format(**fields))
         return message
 
 
-    def notify(self):
-        '''Perform the notifications specified in the config file.
+    def deadline(self):
+        '''Returns the number of seconds the notifications may take.
+
+        Under Lambda this is the time remaining before the function
+        times out, less notifier.deadline_margin_ms.  Locally, with no
+        context, it is DEFAULT_DEADLINE_MS.
 
         '''
 
-        for number in self.cfg.notifier.voice_numbers:
-            self.notify_voice(number)
+        if self.context is None:
+            remaining_ms = DEFAULT_DEADLINE_MS
+        else:
+            remaining_ms = self.context.get_remaining_time_in_millis()
+        margin_ms = self.cfg.notifier.get('deadline_margin_ms',
+                                          DEFAULT_DEADLINE_MARGIN_MS)
+        return max(remaining_ms - margin_ms, 0) / 1000.0
+
+
+    def request_timeout(self):
+        '''Returns the number of seconds a Twilio request made now may
+        take: the time left until the deadline, rounded down to a
+        multiple of REQUEST_TIMEOUT_STEP; or None before notify() has
+        set the deadline.
+
+        '''
+
+        if self.expires is None:
+            return None
+        steps = int((self.expires - time.time()) / REQUEST_TIMEOUT_STEP)
+        return max(steps, 1) * REQUEST_TIMEOUT_STEP
+
+
+    @property
+    def client(self):
+        '''The TwilioRestClient for a request made now, whose requests
+        time out at the deadline (see request_timeout()).
+
+        '''
+
+        with self.stats.timer('TwilioClient'):
+            return get_twilio_client(
+                self.cfg.twilio.account_sid,
+                self.cfg.twilio.auth_token,
+                self.cfg.twilio.get('base_url', TWILIO_BASE_URL),
+                self.request_timeout())
+
+
+    def _completed(self, kind, number):
+        '''Returns the result of the notification if it is already in
+        the ledger, otherwise None.  The ledger is only an optimization,
+        so if it can't be read the notification is sent regardless.
+
+        '''
+
+        if not self.sent:
+            return None
+        try:
+            with self.stats.timer('LedgerLookup'):
+                sid = self.sent.completed(self.event_id, kind, number)
+        except Exception as exc:
+            print('Ledger lookup failed: %s' % exc)
+            return None
+        if not sid:
+            return None
+        return dict(type=kind, number=number, ok=True, sid=sid,
+                    seconds=0.0, duplicate=True)
+
+
+    def _record(self, kind, number, sid):
+        '''Record a completed notification in the ledger, if there is
+        one.
+
+        '''
+
+        if not self.sent:
+            return
+        try:
+            with self.stats.timer('LedgerRecord'):
+                self.sent.record(self.event_id, kind, number, sid)
+        except Exception as exc:
+            print('Ledger update failed: %s' % exc)
+
 
-        for number in self.cfg.notifier.sms_numbers:
-            self.notify_sms(number)
+    def _send(self, kind, number):
+        '''Perform one notification, returning a dict describing the
+        outcome rather than raising, so that one failed recipient does
+        not hide the others.
+
+        If the notification is already in the ledger, it is not sent
+        again; the result then has 'duplicate' set.
+
+        '''
+
+        completed = self._completed(kind, number)
+        if completed:
+            return completed
+
+        send = dict(voice=self.notify_voice,
+                    sms=self.notify_sms,
+                    summary=self.notify_summary)[kind]
+        start = time.time()
+        try:
+            sid = send(number)
+        except Exception as exc:
+            result = dict(ok=False, error='%s: %s' % (
+                type(exc).__name__, exc))
+        else:
+            result = dict(ok=True, sid=sid)
+        elapsed = time.time() - start
+        self.stats.record(NOTIFY_METRICS[kind], elapsed * 1000)
+        result.update(type=kind, number=number, seconds=round(elapsed, 3))
+
+        if result['ok']:
+            self._record(kind, number, sid)
+        return result
+
+
+    def _send_bulk(self, kind, numbers):
+        '''Text the SMS message of the given kind ('sms' or 'summary') to
+        all of numbers with Twilio Notify, in one request per
+        NOTIFY_MAX_BINDINGS recipients rather than one per recipient.
+        Returns a list of results, one per number, as _send() does.
+
+        Numbers already in the ledger are skipped.  Notify accepts the
+        message for every recipient at once, so each result's sid is
+        that of the Notify notification, and 'bulk' is set.  If Notify
+        does not accept the message, it is sent to each number in turn
+        instead, concurrently.
+
+        '''
+
+        results = {}
+        remaining = []
+        for number in numbers:
+            results[number] = self._completed(kind, number)
+            if not results[number]:
+                remaining.append(number)
+
+        body = self._render(kind)
+        failed = []
+        for i in range(0, len(remaining), NOTIFY_MAX_BINDINGS):
+            chunk = remaining[i:i + NOTIFY_MAX_BINDINGS]
+            start = time.time()
+            try:
+                sid = self.notify_bulk(chunk, body)
+            except Exception as exc:
+                print('Bulk SMS to %d recipients failed, sending them '
+                      'individually: %s: %s' % (len(chunk),
+                                                type(exc).__name__, exc))
+                failed.extend(chunk)
+                continue
+            elapsed = time.time() - start
+            self.stats.record(NOTIFY_METRICS['bulk'], elapsed * 1000)
+            for number in chunk:
+                results[number] = dict(type=kind, number=number, ok=True,
+                                       sid=sid, seconds=round(elapsed, 3),
+                                       bulk=True)
+                self._record(kind, number, sid)
+
+        if failed:
+            executor = futures.ThreadPoolExecutor(max_workers=len(failed))
+            try:
+                for number, result in zip(failed, executor.map(
+                        lambda number: self._send(kind, number), failed)):
+                    results[number] = result
+            finally:
+                executor.shutdown(wait=False)
+        return [results[number] for number in numbers]
+
+
+    def _bulk(self, kind, numbers):
+        '''Returns whether to text numbers the message of the given kind
+        in bulk (see _send_bulk()): only SMS messages, to more than one
+        number, when twilio.notify_service_sid is configured.
+
+        '''
+
+        return (kind in ('sms', 'summary') and len(numbers) > 1 and
+                bool(self.cfg.twilio.get('notify_service_sid')))
+
+
+    def notify(self, kinds=('voice', 'sms')):
+        '''Perform the notifications specified in the config file.
+
+        All recipients are notified concurrently, so the last recipient
+        in the config does not wait on everyone before them.  Each
+        notification must complete by the deadline (see deadline());
+        any still outstanding then are reported as failed and
+        abandoned, and their requests time out (see request_timeout()).
+
+        Args:
+            kinds (sequence of str) -
+                The kinds of notification to send: 'voice' calls the
+                voice_numbers, 'sms' texts the sms_numbers, and 'summary'
+                texts the sms_numbers a summary of coalesced clicks.
+
+        SMS messages are sent to all their recipients in one request if
+        twilio.notify_service_sid is configured (see _send_bulk()).
+
+        Returns a list containing one dict per recipient, with keys
+        'type' (one of kinds), 'number', 'ok', 'seconds', and either
+        'sid' (on success) or 'error'.
+
+        '''
+
+        profile = self.profile
+        groups = []
+        if 'voice' in kinds:
+            groups.append(('voice', profile.voice_numbers))
+        if 'sms' in kinds:
+            groups.append(('sms', profile.sms_numbers))
+        if 'summary' in kinds:
+            groups.append(('summary', profile.sms_numbers))
+        # Each job sends to a list of recipients.
+        jobs = []
+        for kind, numbers in groups:
+            if self._bulk(kind, numbers):
+                jobs.append((kind, list(numbers)))
+            else:
+                jobs.extend((kind, [number]) for number in numbers)
+        if not jobs:
+            return []
+
+        start = time.time()
+        deadline = self.deadline()
+        self.expires = start + deadline
+        executor = futures.ThreadPoolExecutor(max_workers=len(jobs))
+        pending = [executor.submit(self._send_bulk, kind, numbers)
+                   if len(numbers) > 1 else
+                   executor.submit(lambda k, n: [self._send(k, n)],
+                                   kind, numbers[0])
+                   for kind, numbers in jobs]
+        futures.wait(pending, timeout=deadline)
+        # Don't wait on stragglers; they are reported below.
+        executor.shutdown(wait=False)
+
+        results = []
+        serial_number = self.event.get('serialNumber')
+        for (kind, numbers), future in zip(jobs, pending):
+            if future.done():
+                job_results = future.result()
+            else:
+                future.cancel()
+                job_results = [
+                    dict(type=kind, number=number, ok=False,
+                         seconds=deadline,
+                         error='Deadline of %.3fs exceeded' % deadline)
+                    for number in numbers]
+            for result in job_results:
+                if not result['ok']:
+                    print('Notification failed: %(type)s %(number)s: '
+                          '%(error)s' % result)
+                results.append(result)
+                if self.audit:
+                    self.audit.add(dict(result, record='notification',
+                                        eventId=self.event_id,
+                                        serialNumber=serial_number),
+                                   serial_number)
+
+        self.stats.record('Notify', (time.time() - start) * 1000)
+        self.stats.count('Recipients', len(results))
+        self.stats.count('Errors', len([r for r in results if not r['ok']]))
+        self.stats.count('Duplicates',
+                         len([r for r in results if r.get('duplicate')]))
+        return results
 
 
     def notify_voice(self, number):
@@ -291,20 +1359,41 @@ class Notifier(object):
                 String containing a single phone number to call.  Must
                 be in Twilio acceptable format: '+1NNNEEEFFFF'.
 
+        The TwiML is passed inline in the call request, so Twilio can
+        start speaking without fetching it from elsewhere first.  If
+        twilio.inline_twiml is false, if the TwiML is too long to pass
+        inline, or if Twilio rejects the request, the TwiML is instead
+        served via the twimlets.com echo URL.
+
+        Returns the sid of the call.
+
         '''
 
-        message = self._clean_message(
-            self.cfg.notifier.voice_message.format(
-                name=   self.cfg.notifier.person.name,
-                age=    self.cfg.notifier.person.age,
-                sex=    self.cfg.notifier.person.sex,
-                address=self.cfg.notifier.person.address))
-        query = {'Twiml': message}
-        url = 'http://twimlets.com/echo?%s' % urlencode(query)
+        # Rendered once, when the profile was compiled.
+        message = self.profile.voice_twiml
+
+        if (self.cfg.twilio.get('inline_twiml', True) and
+            len(message) <= MAX_INLINE_TWIML):
+            try:
+                call = self.client.calls.create(
+                    to=number,
+                    from_=self.source_number,
+                    url=None,
+                    twiml=message)
+                return call.sid
+            except TwilioRestException as exc:
+                if exc.status != 400:
+                    raise
+                print('Inline TwiML rejected, using %s: %s' % (
+                    TWIMLETS_ECHO_URL, exc.msg))
+
+        query = {'Twiml': _utf8(message)}
+        url = '%s?%s' % (TWIMLETS_ECHO_URL, urlencode(query))
         call = self.client.calls.create(
             to=number,
-            from_=self.cfg.twilio.source_number,
+            from_=self.source_number,
             url=url)
+        return call.sid
 
 
     def notify_sms(self, number):
@@ -315,20 +1404,77 @@ class Notifier(object):
                 String containing a single phone number to call.  Must
                 be in Twilio acceptable format: '+1NNNEEEFFFF'.
 
+        Returns the sid of the message.
+
         '''
-        
-        fields = dict(name=self.cfg.notifier.person.name,
-                      address=self.cfg.notifier.person.address,
-                      clickType=self.event.get('clickType', None),
-                      serialNumber=self.event.get('serialNumber', None),
-                      batteryVoltage=self.event.get('batteryVoltage', None))
-        message = self._clean_message(
-            self.cfg.notifier.sms_message.format(**fields))
-        sms = self.client.messages.create(
-            body=message,
-            to=number,
-            from_=self.cfg.twilio.source_number
-        )
+
+        return self._send_sms(number, self._render('sms'))
+
+
+    def notify_summary(self, number):
+        '''Send a SMS summarizing a burst of coalesced clicks to the
+        specified number.  The event describes the burst: its clicks and
+        its last clickType.
+
+        Args:
+            number (str) -
+                String containing a single phone number to text.  Must
+                be in Twilio acceptable format: '+1NNNEEEFFFF'.
+
+        Returns the sid of the message.
+
+        '''
+
+        return self._send_sms(number, self._render('summary'))
+
+
+    def notify_bulk(self, numbers, body):
+        '''Text body to all of numbers with one Twilio Notify request,
+        through the Notify service twilio.notify_service_sid.  Notify
+        sends the messages through the service's Messaging Service, and
+        its senders, rather than from the source numbers.
+
+        Returns the sid of the Notify notification.
+
+        '''
+
+        twilio = self.cfg.twilio
+        url = '%s/v1/Services/%s/Notifications' % (
+            twilio.get('notify_base_url', NOTIFY_BASE_URL),
+            twilio.notify_service_sid)
+        bindings = [json.dumps(dict(binding_type='sms', address=number))
+                    for number in numbers]
+        resp = twilio_base.make_twilio_request(
+            'POST', url, auth=(twilio.account_sid, twilio.auth_token),
+            data=dict(Body=body, ToBinding=bindings),
+            timeout=self.request_timeout())
+        return json.loads(resp.content)['sid']
+
+
+    def _send_sms(self, number, body):
+        '''Send body to number from the source number in the pool that
+        can send it soonest (see senders.py), waiting for one if need
+        be.  A message that is throttled is sent again, possibly from
+        another number.  Raises senders.Throttled if no number can send
+        it by the deadline.
+
+        Returns the sid of the message.
+
+        '''
+
+        for attempt in range(SMS_ATTEMPTS):
+            source = self.senders.acquire(self.expires)
+            try:
+                sms = self.client.messages.create(
+                    body=body,
+                    to=number,
+                    from_=source
+                )
+                return sms.sid
+            except TwilioRestException as exc:
+                if exc.status != 429 or attempt == SMS_ATTEMPTS - 1:
+                    raise
+                self.senders.rest(source, THROTTLED_REST_SECONDS * 2**attempt)
 
 
 
@@ -337,6 +1483,7 @@ if __name__ == '__main__':
     # On local system -- not on Lambda.
 
     from docopt import docopt
+    from pprint import pprint as pp
  
 
     usage = '''
@@ -357,13 +1504,15 @@ if __name__ == '__main__':
 
     config validate -
         Confirm that the local config file specified by CONFIGPATH is
-        valid YAML.  Note that syntax is validated but semantics are
-        not. 
+        valid YAML and that its button routes compile.  Note that
+        other semantics are not validated.
 
     config upload -
-        Upload the config file stored locally at CONFIGPATH to S3.
-        This will overwrite any existing config file on S3.  No
-        validation is performed.  An AWS user profile must be
+        Upload the config file stored locally at CONFIGPATH to S3,
+        along with a compiled snapshot of it which the Lambda handler
+        loads in place of the YAML.  This will overwrite any existing
+        config file on S3.  The file is validated as by 'config
+        validate' first.  An AWS user profile must be
         specified in PROFILE.  This profile should be present in
         ~/.aws/credentials.  If you wish use another mechanism to
         provide credentials, you'll have to modify this code.  The
@@ -383,15 +1532,20 @@ if __name__ == '__main__':
     args = docopt(usage, version='notifier v1.0')
     args = {k.replace('-', '') : args[k] for k in args.keys()}
     args = DotMap(args)
+    install_exit_hooks()
 
     if args.validate:
         config = Config()
         config.load(aws_profile_name=None, filepath=args.path)
         pp(config.config)
         print('The configuration file is syntactically correct YAML.')
+        print('%d serial numbers are routed to %d profiles.' % (
+            len(config.routes.index), len(config.routes.profiles)))
+        print('Config version %s.' % config.version)
     elif args.upload:
         config = Config()
-        config.upload(args.profile, args.path)
+        version = config.upload(args.profile, args.path)
+        print('Uploaded config version %s.' % version)
     elif args.download:
         config = Config()
         config.download(args.profile, args.path)
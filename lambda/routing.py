@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+'''Routes each IoT Button to the person and recipients it notifies for.
+
+The settings directly under 'notifier' in the config -- person,
+voice_numbers, voice_message, sms_numbers, and sms_message -- form the
+default profile, used for any button not routed elsewhere.  Additional
+profiles may be defined under 'notifier.profiles'.  Each may override
+any of those settings and lists the buttons routed to it, by serial
+number ('serials') and by serial group ('groups'; see
+'notifier.groups'):
+
+    notifier:
+        groups:
+            smith-house:
+                - G030JF055364XVRB
+                - G030JF055364XVRC
+        profiles:
+            smith:
+                groups: [smith-house]
+                serials: [G030JF055364XVRD]
+                person:
+                    name: ...
+                voice_numbers: [...]
+                sms_numbers: [...]
+
+When the config is loaded, the profiles are compiled into a dict
+indexed by serial number, so resolving a button costs one lookup no
+matter how many buttons the config covers.  Profiles are shared by all
+of their buttons.  They are plain slotted objects, and their voice
+TwiML, which depends only on the person, is rendered once when they are
+compiled rather than for every call.
+
+Compiled routes can be saved as plain data with snapshot() and restored
+with Routes.from_snapshot(), which is much quicker than compiling them
+again (see Config.upload() in notifier.py).
+
+'''
+
+import re
+
+
+PROFILE_KEYS = ('person', 'voice_numbers', 'voice_message',
+                'sms_numbers', 'sms_message')
+
+
+def clean_message(message):
+    '''Returns new message, less unnecessary whitespace.'''
+    message = re.sub(r' {2,}', ' ', message)
+    message = re.sub(r'\n', ' ', message)
+    message = message.strip()
+    return message
+
+
+class Person(object):
+
+    __slots__ = ('name', 'address', 'age', 'sex')
+
+
+    def __init__(self, name=None, address=None, age=None, sex=None):
+        self.name = name
+        self.address = address
+        self.age = age
+        self.sex = sex
+
+
+class Profile(object):
+    '''The person a button notifies for, the recipients it notifies,
+    and the messages they are sent.
+
+    '''
+
+    __slots__ = ('profile', 'person', 'voice_numbers', 'voice_message',
+                 'sms_numbers', 'sms_message', 'voice_twiml')
+
+
+    def __init__(self, profile, person, voice_numbers, voice_message,
+                 sms_numbers, sms_message, voice_twiml=None):
+        self.profile = profile
+        self.person = person
+        self.voice_numbers = voice_numbers or []
+        self.voice_message = voice_message
+        self.sms_numbers = sms_numbers or []
+        self.sms_message = sms_message
+        if voice_twiml is None and voice_message is not None:
+            voice_twiml = clean_message(voice_message.format(
+                name=   person.name,
+                age=    person.age,
+                sex=    person.sex,
+                address=person.address))
+        self.voice_twiml = voice_twiml
+
+
+    def to_dict(self):
+        '''Returns the profile as plain, JSON serializable data.'''
+        data = dict((key, getattr(self, key)) for key in self.__slots__)
+        data['person'] = dict((key, getattr(self.person, key))
+                              for key in Person.__slots__)
+        return data
+
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data['person'] = Person(**data['person'])
+        return cls(**data)
+
+
+class Routes(object):
+
+
+    def __init__(self, cfg=None):
+        '''Args:
+              cfg (DotMap) -
+                  The 'notifier' section of the config.  If None, the
+                  routes are empty; see from_snapshot().
+
+           Raises ValueError if a profile refers to an unknown group or
+           if a serial number is routed to more than one profile.
+
+        '''
+
+        self.default = None
+        self.profiles = {}
+        self.index = {}
+        if cfg is None:
+            return
+
+        self.default = self._profile('default', cfg, {})
+        groups = cfg.get('groups') or {}
+        for name, settings in (cfg.get('profiles') or {}).items():
+            profile = self._profile(name, cfg, settings)
+            self.profiles[name] = profile
+            serials = list(settings.get('serials') or [])
+            for group in settings.get('groups') or []:
+                if group not in groups:
+                    msg = 'Profile %s refers to unknown group %s' % (
+                        name, group)
+                    raise ValueError, msg
+                serials.extend(groups[group])
+            for serial in serials:
+                routed = self.index.setdefault(str(serial), profile)
+                if routed is not profile:
+                    msg = 'Serial %s is routed to profiles %s and %s' % (
+                        serial, routed.profile, name)
+                    raise ValueError, msg
+
+
+    def _profile(self, name, cfg, settings):
+        '''Returns a Profile of the PROFILE_KEYS settings, taken from
+        settings where present and from cfg otherwise.
+
+        '''
+
+        values = {}
+        for key in PROFILE_KEYS:
+            value = settings.get(key)
+            values[key] = value if value is not None else cfg.get(key)
+        person = values.pop('person') or {}
+        person = Person(**dict((key, person.get(key))
+                               for key in Person.__slots__))
+        return Profile(name, person, **values)
+
+
+    def resolve(self, serial):
+        '''Returns the profile for the button with serial number serial.'''
+        return self.index.get(serial, self.default)
+
+
+    def snapshot(self):
+        '''Returns the compiled routes as plain, JSON serializable data.'''
+        return dict(
+            default=self.default.to_dict(),
+            profiles=dict((name, profile.to_dict())
+                          for name, profile in self.profiles.items()),
+            index=dict((serial, profile.profile)
+                       for serial, profile in self.index.items()))
+
+
+    @classmethod
+    def from_snapshot(cls, data):
+        '''Returns the Routes saved by snapshot().'''
+        routes = cls()
+        routes.default = Profile.from_dict(data['default'])
+        routes.profiles = dict((name, Profile.from_dict(profile))
+                               for name, profile in data['profiles'].items())
+        profiles = routes.profiles
+        routes.index = dict((serial, profiles[name])
+                            for serial, name in data['index'].items())
+        return routes
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''Spreads SMS messages over a pool of source numbers.
+
+Twilio sends SMS from a long code number at about one message per
+second, and answers requests beyond that with 429 (Too Many Requests).
+A fan-out to many recipients, or many buttons pressed at once, from a
+single number therefore queues up or fails.  With a pool of source
+numbers (twilio.source_numbers in the config), each number is limited
+by a token bucket to twilio.sms_per_second messages per second, with
+bursts of up to twilio.sms_burst, and each message is sent from the
+number that can send it soonest.  A number whose request is answered
+with 429 is rested before it is used again.
+
+Pools are kept per container, so the limits apply to the messages sent
+by one container; concurrent containers each have their own.
+
+'''
+
+import threading
+import time
+
+
+class Throttled(Exception):
+    '''Raised when no number in the pool can send before the deadline.'''
+    pass
+
+
+class TokenBucket(object):
+    '''Allows rate sends per second on average, and bursts of up to
+    burst sends.  Sends may be reserved ahead of time, in which case the
+    bucket holds fewer than zero tokens until they are paid back.  If
+    rate is None, sends are not limited.
+
+    '''
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate) if rate is not None else None
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+        self.resting_until = now
+
+
+    def _refill(self, now):
+        if self.rate is None:
+            self.tokens = self.burst
+        elif now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+
+    def available(self, now):
+        '''Returns the time at which the next send may be made.'''
+        self._refill(now)
+        at = now
+        if self.tokens < 1:
+            at = now + (1 - self.tokens) / self.rate
+        return max(at, self.resting_until)
+
+
+    def take(self, now):
+        '''Reserve a send.'''
+        self._refill(now)
+        self.tokens -= 1
+
+
+    def rest(self, until):
+        '''Allow no sends before until.'''
+        self.resting_until = max(self.resting_until, until)
+
+
+class SenderPool(object):
+
+
+    def __init__(self, numbers, rate, burst, clock=time.time):
+        '''Args:
+              numbers (list of str) -
+                  Source numbers to send from.
+              rate (float) -
+                  Messages per second each number may send, or None for
+                  no limit.
+              burst (int) -
+                  Messages each number may send at once.
+              clock (function) -
+                  Returns the current time in seconds.
+
+        '''
+
+        self.clock = clock
+        now = clock()
+        self.buckets = [(number, TokenBucket(rate, burst, now))
+                        for number in numbers]
+        self.lock = threading.Lock()
+
+
+    def acquire(self, deadline=None):
+        '''Reserve a send from the number that can send soonest, wait
+        until it may send, and return it.
+
+        Raises Throttled, having reserved nothing, if no number can send
+        before deadline (in seconds since the epoch).
+
+        '''
+
+        with self.lock:
+            now = self.clock()
+            at, _, number, bucket = min(
+                (bucket.available(now), -bucket.tokens, number, bucket)
+                for number, bucket in self.buckets)
+            if deadline is not None and at > deadline:
+                msg = 'No source number can send for %.3fs' % (at - now)
+                raise Throttled(msg)
+            bucket.take(now)
+        if at > now:
+            time.sleep(at - now)
+        return number
+
+
+    def rest(self, number, seconds):
+        '''Rest number for seconds, e.g., after it was throttled.'''
+        with self.lock:
+            for n, bucket in self.buckets:
+                if n == number:
+                    bucket.rest(self.clock() + seconds)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Usage:
+    microbench run [options] [NAME...]
+    microbench save [options] [NAME...]
+    microbench compare [options] [NAME...]
+    microbench list
+
+Microbenchmarks of the code run for every click: building and validating
+a simulated click, looking up a Button's certificate files, handling a
+message received by 'riprock subscribe', and, in the Lambda handler,
+parsing the config file and rendering messages.  Everything runs
+locally; no AWS or Twilio API is called, and the AWS and Twilio clients
+constructed are never used.
+
+    run     - Time the benchmarks NAME (by default all of them; a NAME
+              ending in '.' selects those it prefixes, e.g. 'notifier.')
+              and print the time taken per call.
+
+    save    - As run, and store the times as the baselines in the
+              baseline file, replacing those of the same benchmarks.
+
+    compare - As run, and compare the times with the baselines, exiting
+              with status 1 if any benchmark is slower than its baseline
+              by more than the threshold.
+
+    list    - List the benchmarks.
+
+Each benchmark is timed as timeit does, calling it enough times to take
+at least the minimum time, and that is done a number of times over.  The
+median of these is taken as the time per call: on a shared or virtual
+machine the fastest is as much a fluke as the slowest.  A benchmark
+that compare finds slower than its baseline is timed again before it is
+reported as a regression.  Times depend on the machine, so the baseline
+file records where it was made, and compare warns when that was
+elsewhere.
+
+Options:
+    --baseline=PATH     baseline file [default: microbench.json]
+    --threshold=PCT     slowdown, in percent, reported as a regression
+                        [default: 25]
+    --repeat=N          number of times each benchmark is timed
+                        [default: 7]
+    --min-time=SECONDS  least time each timing takes [default: 0.1]
+    --buttons=N         buttons routed by the large config [default: 1000]
+
+'''
+
+from __future__ import print_function
+
+import cStringIO
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from common import LAMBDA_DIR, import_notifier
+
+SERIAL_NUM = 'G030JF055364XVRB'
+
+# Times a benchmark that appears to have regressed is measured again.
+CONFIRM_ATTEMPTS = 2
+
+
+def button(workdir):
+    '''Returns an AWSIoTButton whose certs_dir is in workdir.'''
+
+    from iotbutton import AWSIoTButton
+
+    # AWSIoTButton downloads the root CA unless it is there already, and
+    # creates (unused) clients, which need a region.
+    open(os.path.join(workdir, 'aws-iot-rootCA.pem'), 'w').close()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+    return AWSIoTButton(workdir, 'aws-iot-rootCA.pem', None,
+                        serial_num=SERIAL_NUM)
+
+
+def notifier_module():
+    # Config() requires these, though they are only used to fetch the
+    # config from S3.
+    os.environ.setdefault('BUCKET_NAME', 'microbench')
+    os.environ.setdefault('KEY_NAME', 'notifier.yml')
+    return import_notifier()
+
+
+def config_source(buttons=0):
+    '''Returns the YAML of the sample notifier config, with buttons
+    buttons routed ten to a profile.
+
+    '''
+
+    with open(os.path.join(LAMBDA_DIR, 'notifier.yml')) as f:
+        source = f.read()
+    if not buttons:
+        return source
+
+    import yaml
+    notifier_module()
+    from benchmark import routing_config
+    config = yaml.safe_load(source)
+    config['notifier'].update(routing_config(buttons))
+    return yaml.safe_dump(config, default_flow_style=False)
+
+
+class _Message(object):
+    '''A message as paho passes it to on_message.'''
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+# Each benchmark's setup function takes the working directory and the
+# options, and returns the function to be timed.
+
+def bench_payload(workdir, args):
+    iotb = button(workdir)
+    return lambda: iotb.payload('1234mV', 'SINGLE')
+
+
+def bench_validate_click(workdir, args):
+    from iotbutton import validate_click
+    return lambda: validate_click('DOUBLE', '1234mV')
+
+
+def bench_validate_click_invalid(workdir, args):
+    from iotbutton import validate_click
+
+    def invalid():
+        try:
+            validate_click('TRIPLE', '1234mV')
+        except ValueError:
+            pass
+    return invalid
+
+
+def bench_for_serial_num(workdir, args):
+    iotb = button(workdir)
+    return lambda: iotb.for_serial_num(SERIAL_NUM)
+
+
+def bench_certificate_files(workdir, args):
+    iotb = button(workdir)
+    return lambda: iotb.certificate_files
+
+
+def bench_parse_small(workdir, args):
+    config = notifier_module().Config()
+    source = config_source()
+    return lambda: config._parse(source)
+
+
+def bench_parse_large(workdir, args):
+    config = notifier_module().Config()
+    source = config_source(int(args.buttons))
+    return lambda: config._parse(source)
+
+
+def _notifier(workdir):
+    module = notifier_module()
+    config = module.Config()
+    config.load(aws_profile_name=None,
+                filepath=os.path.join(LAMBDA_DIR, 'notifier.yml'))
+    event = dict(serialNumber=SERIAL_NUM, clickType='SINGLE',
+                 batteryVoltage='1234mV')
+    return module.Notifier(event, None, config)
+
+
+def bench_clean_message(workdir, args):
+    notifier = _notifier(workdir)
+    message = notifier.cfg.notifier.voice_message
+    return lambda: notifier._clean_message(message)
+
+
+def bench_render_sms(workdir, args):
+    notifier = _notifier(workdir)
+
+    def render():
+        # Messages are rendered once per event, so the cache is cleared
+        # to render it afresh.
+        notifier._messages.clear()
+        notifier._render('sms')
+    return render
+
+
+def _on_message(stream):
+    from subscriber import message_handler
+    handler = message_handler(stream)
+    msg = _Message('iotbutton/%s' % SERIAL_NUM, json.dumps(dict(
+        serialNumber=SERIAL_NUM, batteryVoltage='1234mV',
+        clickType='SINGLE')))
+    return lambda: handler(None, None, msg)
+
+
+def bench_on_message_devnull(workdir, args):
+    return _on_message(open(os.devnull, 'w'))
+
+
+def bench_on_message_file(workdir, args):
+    return _on_message(open(os.path.join(workdir, 'messages.log'), 'w'))
+
+
+def bench_on_message_memory(workdir, args):
+    return _on_message(cStringIO.StringIO())
+
+
+BENCHMARKS = [
+    ('iotbutton.payload', bench_payload),
+    ('iotbutton.validate_click', bench_validate_click),
+    ('iotbutton.validate_click_invalid', bench_validate_click_invalid),
+    ('iotbutton.for_serial_num', bench_for_serial_num),
+    ('iotbutton.certificate_files', bench_certificate_files),
+    ('notifier.parse_small', bench_parse_small),
+    ('notifier.parse_large', bench_parse_large),
+    ('notifier.clean_message', bench_clean_message),
+    ('notifier.render_sms', bench_render_sms),
+    ('subscriber.on_message.devnull', bench_on_message_devnull),
+    ('subscriber.on_message.file', bench_on_message_file),
+    ('subscriber.on_message.memory', bench_on_message_memory),
+]
+
+
+def select(names):
+    '''Returns the (name, setup) of the benchmarks names select.'''
+
+    if not names:
+        return BENCHMARKS
+    selected = [(name, setup) for name, setup in BENCHMARKS
+                if any(name == n or n.endswith('.') and name.startswith(n)
+                       for n in names)]
+    unknown = [n for n in names
+               if not any(name == n or n.endswith('.') and
+                          name.startswith(n) for name, _ in BENCHMARKS)]
+    if unknown:
+        msg = 'Unknown benchmark(s): %s' % ', '.join(unknown)
+        raise ValueError, msg
+    return selected
+
+
+def measure(function, repeat, min_time):
+    '''Returns the median of repeat timings of function, in seconds per
+    call, each timing calling it enough times to take min_time.
+
+    '''
+
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = sorted([elapsed / number] +
+                   [timer.timeit(number) / number
+                    for _ in range(repeat - 1)])
+    return times[len(times) / 2]
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return '%8.2fus' % (seconds * 1e6)
+    return '%8.2fms' % (seconds * 1e3)
+
+
+def run(args, baselines=None):
+    '''Time the selected benchmarks, printing each, and return a dict
+    of their times.  A benchmark slower than its baseline in baselines
+    (a dict) by more than the threshold is timed again, up to
+    CONFIRM_ATTEMPTS times, to tell a regression from a disturbance.
+
+    '''
+
+    limit = 1 + float(args.threshold) / 100
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='riprock-microbench-')
+    try:
+        for name, setup in select(args.NAME):
+            function = setup(workdir, args)
+            results[name] = measure(function, int(args.repeat),
+                                    float(args.mintime))
+            baseline = (baselines or {}).get(name)
+            for _ in range(CONFIRM_ATTEMPTS):
+                if baseline is None or results[name] <= baseline * limit:
+                    break
+                results[name] = min(results[name], measure(
+                    function, int(args.repeat), float(args.mintime)))
+            print('%-36s %s' % (name, format_time(results[name])))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def machine():
+    '''Returns a description of where the benchmarks are run.'''
+    return dict(python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(),
+                processor=platform.processor() or platform.machine())
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return dict(machine=None, benchmarks={})
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(args, results):
+    baselines = load_baselines(args.baseline)
+    if baselines['machine'] != machine():
+        # Times from another machine are not comparable with these.
+        baselines['benchmarks'] = {}
+    baselines['machine'] = machine()
+    baselines['saved'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    baselines['benchmarks'].update(results)
+    with open(args.baseline + '.tmp', 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.rename(args.baseline + '.tmp', args.baseline)
+    print('Saved %d baselines in %s' % (len(results), args.baseline))
+
+
+def compare(args, results):
+    '''Print how each time compares with its baseline, and return the
+    number of regressions.
+
+    '''
+
+    baselines = load_baselines(args.baseline)
+    if baselines['machine'] != machine():
+        print('Warning: the baselines in %s were made on another machine '
+              '(%s), so the comparison may not be meaningful' % (
+                  args.baseline, json.dumps(baselines['machine'],
+                                            sort_keys=True)))
+    threshold = float(args.threshold)
+    regressions = 0
+    print()
+    for name in sorted(results):
+        baseline = baselines['benchmarks'].get(name)
+        if baseline is None:
+            print('%-36s %s  (no baseline)' % (name,
+                                                format_time(results[name])))
+            continue
+        change = (results[name] - baseline) / baseline * 100
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-36s %s  baseline %s  %+6.1f%%%s' % (
+            name, format_time(results[name]), format_time(baseline).strip(),
+            change, flag))
+    print('%d of %d benchmarks slower than baseline by more than %g%%' % (
+        regressions, len(results), threshold))
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    from common import docopt_plus
+
+    args = docopt_plus(__doc__, 'v 1.0')
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+    else:
+        if args.compare:
+            results = run(args, load_baselines(args.baseline)['benchmarks'])
+            sys.exit(1 if compare(args, results) else 0)
+        results = run(args)
+        if args.save:
+            save(args, results)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+'''A long-running notifier that takes clicks straight from AWS IoT.
+
+Normally a click reaches a phone by way of an IoT rule, which invokes
+the Lambda handler (lambda/notifier.py); each invocation may pay for a
+cold start, fetches the config from S3, and constructs its clients.  A
+NotifierDaemon runs the same handler code on a local machine instead:
+it subscribes to the Buttons' topic (iotbutton/+) over MQTT, with a
+Button's certificate, and hands each click to notifier.handle_event()
+on a pool of worker threads, so a click is being notified within
+milliseconds of its arrival.  Between clicks it keeps
+
+    * the config loaded, in the same format as the Lambda handler's,
+      either from a local file, reloaded when the file changes, or from
+      S3 (BUCKET_NAME and KEY_NAME, as for the handler), checked for
+      changes every reload interval;
+    * its Twilio connections open, refreshing them every warm interval
+      (see notifier.warm_connections()).
+
+Coalescing, the ledger, metrics, and the audit log (notifier.coalesce,
+notifier.ledger, notifier.metrics, notifier.debug_bucket) work as they
+do under Lambda, and, as Lambda would, the daemon handles a click again
+when a ledger is configured and some of its notifications failed.
+Every click the daemon receives also triggers the IoT rule, so a Button
+notified by a daemon should not also be routed to the Lambda handler by
+a rule (see 'riprock create-topic-rule'), and only one daemon should
+run for the same Buttons unless a ledger is configured.
+
+SIGTERM or SIGINT stops the daemon gracefully: it disconnects, so no
+more clicks are taken, waits for the notifications in progress to
+finish, and writes the audit log.  SIGHUP reloads the config at once.
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from concurrent import futures
+
+import subscriber
+from common import import_notifier
+
+
+# Topic to which Buttons publish their clicks.
+CLICK_TOPIC = 'iotbutton/+'
+
+# With a ledger, a click whose notifications partly failed is handled
+# again, as Lambda retries an invocation, up to EVENT_ATTEMPTS times in
+# all, RETRY_DELAY seconds apart.
+EVENT_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+
+class DaemonContext(object):
+    '''Stands in for the Lambda context of an invocation, giving each
+    click its own request id, and the notifications a deadline.
+
+    '''
+
+    function_name = 'notifierd'
+
+
+    def __init__(self, deadline, received, request_id=None):
+        self.aws_request_id = request_id or str(uuid.uuid4())
+        self.expires = received + deadline
+
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.expires - time.time()) * 1000), 0)
+
+
+class NotifierDaemon(object):
+
+
+    def __init__(self, iotb, config_path=None, aws_profile_name=None,
+                 workers=8, deadline=10, reload_interval=60,
+                 warm_interval=60, stream=None):
+        '''
+        Args:
+            iotb (AWSIoTButton) - supplies the AWS IoT endpoint, and, for
+                its serial_num, the certificate to connect with.
+
+            config_path (string) - pathname of the notifier config file;
+                if None, the config is loaded from S3, as the Lambda
+                handler loads it.
+
+            aws_profile_name (string) - AWS profile used to reach S3.
+
+            workers (int) - most clicks handled at once.
+
+            deadline (float) - seconds a click's notifications may take.
+
+            reload_interval (float) - seconds between checks for a
+                changed config.
+
+            warm_interval (float) - seconds between refreshes of the
+                Twilio connections; 0 not to keep them open.
+
+        '''
+        self.iotb = iotb
+        self.config_path = config_path
+        self.aws_profile_name = aws_profile_name
+        self.workers = workers
+        self.deadline = deadline
+        self.reload_interval = reload_interval
+        self.warm_interval = warm_interval
+        self.stream = stream or sys.stdout
+        if config_path:
+            # Config() requires these, though they are only used to
+            # fetch the config from S3.
+            os.environ.setdefault('BUCKET_NAME', '')
+            os.environ.setdefault('KEY_NAME', '')
+        self.notifier = import_notifier()
+        self.config = None
+        self.config_mtime = None
+        self.executor = None
+        self.mqttc = None
+        self.stopping = threading.Event()
+        self.reloading = threading.Event()
+        self.lock = threading.Lock()
+        self.handled = 0
+        self.failed = 0
+
+
+    def _log(self, msg):
+        with self.lock:
+            print('%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), msg),
+                  file=self.stream)
+            self.stream.flush()
+
+
+    def load_config(self):
+        '''Load the config if it has changed, and return whether it did.
+        A config that fails to load is reported, and the one already
+        loaded is kept.
+
+        '''
+
+        try:
+            if self.config_path:
+                mtime = os.path.getmtime(self.config_path)
+                if mtime == self.config_mtime:
+                    return False
+            config = self.notifier.Config()
+            config.load(aws_profile_name=self.aws_profile_name,
+                        filepath=self.config_path)
+        except Exception as exc:
+            if self.config is None:
+                raise
+            self._log('Reloading the config failed, keeping version %s: '
+                      '%s' % (self.config.version[:12], exc))
+            return False
+        if self.config_path:
+            self.config_mtime = mtime
+        if self.config and config.version == self.config.version:
+            return False
+        self.config = config
+        self._log('Loaded config version %s' % config.version[:12])
+        return True
+
+
+    def warm(self):
+        '''Open, or refresh, as many Twilio connections as the default
+        recipients need.
+
+        '''
+
+        profile = self.config.routes.default
+        connections = max(len(profile.voice_numbers) +
+                          len(profile.sms_numbers), 1)
+        return self.notifier.warm_connections(self.config.config,
+                                              connections)
+
+
+    def handle(self, event, received):
+        '''Notify for one click.  Returns handle_event()'s response, or
+        None if it failed.
+
+        '''
+
+        notifier = self.notifier
+        config = self.config
+        context = DaemonContext(self.deadline, received)
+        stats = notifier.metrics.NULL_METRICS
+        if config.config.notifier.get('metrics', True):
+            stats = notifier.metrics.Metrics()
+        stats.set_dimension('FunctionName', context.function_name)
+        stats.set_property('requestId', context.aws_request_id)
+        stats.set_property('configVersion', config.version)
+        start = time.time()
+        stats.record('Queued', (start - received) * 1000)
+        response = None
+        try:
+            for attempt in range(EVENT_ATTEMPTS):
+                try:
+                    response = notifier.handle_event(event, context, config,
+                                                     stats)
+                except notifier.NotificationError as exc:
+                    # As Lambda would, retry the click; the ledger keeps
+                    # the retry from repeating what was sent.
+                    if (attempt + 1 == EVENT_ATTEMPTS or
+                        self.stopping.is_set()):
+                        raise
+                    self._log('Retrying %s: %s' % (
+                        event.get('serialNumber'), exc))
+                    time.sleep(RETRY_DELAY)
+                    context = DaemonContext(self.deadline, time.time(),
+                                            context.aws_request_id)
+                else:
+                    break
+        except Exception as exc:
+            stats.count('HandlerErrors')
+            error = '%s: %s' % (type(exc).__name__, exc)
+        else:
+            error = None
+        finally:
+            stats.record('Duration', (time.time() - start) * 1000)
+            stats.emit()
+
+        results = (response or {}).get('notifications', [])
+        with self.lock:
+            self.handled += 1
+            if error:
+                self.failed += 1
+        self._log('%s %s: %d notified, %d failed, %.0fms after receipt%s' % (
+            event.get('serialNumber'), event.get('clickType'),
+            len([r for r in results if r['ok']]),
+            len([r for r in results if not r['ok']]),
+            (time.time() - received) * 1000,
+            '; %s' % error if error else ''))
+        return response
+
+
+    def on_connect(self, client, userdata, flags, rc):
+        self._log('Connected to %s (result %s)' % (self.iotb.endpoint, rc))
+        # Subscribing here renews the subscription after a reconnect.
+        client.subscribe(CLICK_TOPIC, 1)
+
+
+    def on_disconnect(self, client, userdata, rc):
+        if not self.stopping.is_set():
+            self._log('Disconnected (result %s); reconnecting' % rc)
+
+
+    def on_message(self, client, userdata, msg):
+        received = time.time()
+        try:
+            event = json.loads(msg.payload)
+            if not isinstance(event, dict):
+                raise ValueError('not an object')
+        except ValueError as exc:
+            self._log('Ignoring message on %s: %s' % (msg.topic, exc))
+            return
+        # Handled on a worker, so the network loop is free to take the
+        # next message at once.
+        self.executor.submit(self.handle, event, received)
+
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading.set()
+        else:
+            self.stopping.set()
+
+
+    def run(self):
+        '''Take clicks until stopped by a signal or stop().'''
+
+        self.load_config()
+        if self.warm_interval:
+            self._log('Warmed %d Twilio connections' % self.warm())
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._signal)
+
+        client_id = 'notifierd-%s-%d' % (socket.gethostname(), os.getpid())
+        self.mqttc = subscriber.mqtt_client(self.iotb, client_id)
+        self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_disconnect = self.on_disconnect
+        self.mqttc.on_message = self.on_message
+        self.mqttc.connect_async(self.iotb.endpoint, subscriber.AWS_IOT_PORT,
+                                 keepalive=60)
+        self.mqttc.loop_start()
+
+        next_reload = time.time() + self.reload_interval
+        next_warm = time.time() + self.warm_interval
+        try:
+            while not self.stopping.is_set():
+                # A short wait, so that signals are handled promptly.
+                self.stopping.wait(1)
+                now = time.time()
+                if self.reloading.is_set() or now >= next_reload:
+                    self.reloading.clear()
+                    self.load_config()
+                    next_reload = now + self.reload_interval
+                if self.warm_interval and now >= next_warm:
+                    self.warm()
+                    next_warm = now + self.warm_interval
+        finally:
+            self.shutdown()
+
+
+    def stop(self):
+        self.stopping.set()
+
+
+    def shutdown(self):
+        '''Stop taking clicks, finish those in progress, and write the
+        audit log.
+
+        '''
+
+        self.stopping.set()
+        self._log('Stopping; finishing the clicks in progress')
+        self.mqttc.disconnect()
+        self.mqttc.loop_stop()
+        self.executor.shutdown(wait=True)
+        self.notifier.flush_audit_logs()
+        self._log('Stopped after %d clicks, %d failed' % (self.handled,
+                                                           self.failed))
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -15,6 +15,15 @@ Usage:
     riprock [options] click SERIALNUM (--single | --double | --long) [VOLTAGE]
     riprock [options] create-topic-rule SERIALNUM
     riprock [options] subscribe SERIALNUM
+    riprock [options] rotate-certs MANIFEST
+    riprock [options] provision-bulk MANIFEST --bucket=NAME --role-arn=ARN
+    riprock [options] inventory refresh
+    riprock [options] inventory list
+    riprock [options] inventory orphans
+    riprock [options] simulate SERIALNUM
+    riprock [options] notifier-daemon SERIALNUM
+    riprock [options] batch FILE
+    riprock [options] verify-fleet MANIFEST
 
 Options:
     --single         emulate single button press
@@ -24,6 +33,42 @@ Options:
     --version        show
     --args           show commandline args then exit
     --config=CONFIG  path to configuration file to use
+    --stats          print the latency, retries, and throttling of each AWS
+                     API call made (see apistats.py)
+    --stats-file=PATH  as --stats, and also write them to PATH as JSON
+    --overlap=SECONDS  how long an old certificate stays active after its
+                       replacement is pushed [default: 3600]
+    --concurrency=N    most Buttons worked on at once [default: 8]
+    --rate=N           most AWS API calls, or MQTT connections, made per
+                       second [default: 10]
+    --state=PATH       rotation state file [default: MANIFEST.rotation.json]
+    --wait             wait out the overlap window instead of exiting
+    --bucket=NAME      S3 bucket for bulk registration input files
+    --role-arn=ARN     IAM role AWS IoT assumes for bulk registration
+    --task=ID          collect the results of this earlier bulk
+                       registration task instead of starting one
+    --db=PATH          inventory database [default: inventory.db]
+    --full             refresh every certificate's attachments
+    --max-age=SECONDS  refresh attachments fetched longer ago than this
+                       [default: 86400]
+    --serial=PATTERN   list only Buttons whose serial number matches the
+                       shell-style PATTERN
+    --status=STATUS    list only Buttons with a certificate whose status
+                       is STATUS (e.g., ACTIVE, INACTIVE), or 'none'
+    --clicks=N         clicks to simulate [default: 100]
+    --interval=SECONDS  time between simulated clicks [default: 1]
+    --notifier-config=PATH  notifier config file; by default the one on
+                       S3 given by BUCKET_NAME and KEY_NAME
+    --workers=N        most clicks notified at once [default: 8]
+    --deadline=SECONDS  time a click's notifications may take
+                       [default: 10]
+    --reload=SECONDS   time between checks for a changed notifier config
+                       [default: 60]
+    --warm=SECONDS     time between refreshes of the Twilio connections;
+                       0 not to keep them open [default: 60]
+    --jobs=N           most commands of a batch run at once [default: 1]
+    --report=PATH      also write the result of each Button to PATH as
+                       JSON
 
 Description:
     riprock is example code showing how to provision an Amazon IoT Button
@@ -86,6 +131,92 @@ Commands:
         the provided SERIALNUM.  SERIALNUM must match your Button's serial
         number.  This is simply a convenience command.
 
+    rotate-certs - Rotates the Certificates of every Button whose serial
+        number is listed, one per line, in the file MANIFEST.  Each Button
+        gets a new Certificate, to which the Policy and its Thing are
+        attached, and which then replaces its Certificate in ./certs; the
+        old Certificate is kept active for the overlap window, then
+        deactivated, detached, and deleted.  Buttons are rotated
+        concurrently, at a limited rate of AWS API calls.  Progress is
+        reported per Button and kept in the state file, so an interrupted
+        rotation picks up where it left off when run again, as does one
+        that exited, not having been given --wait, before the overlap
+        window ended.  See rotation.py.
+
+    provision-bulk - Provisions every Button whose serial number is
+        listed, one per line, in the file MANIFEST, as 'one-shot' would,
+        but with a single AWS IoT bulk registration task rather than four
+        API calls per Button.  A key pair is generated in ./certs for
+        each Button not yet provisioned; their certificate signing
+        requests are uploaded to the bucket, and the task registers them
+        with the role.  Certificates are saved in ./certs as the task
+        reports them.  See bulk.py, and fakeiot.py to try it locally.
+
+    inventory - Keeps a local inventory of the Buttons' Things, the
+        account's certificates, and what they are attached to, in the
+        SQLite database --db.  'inventory refresh' brings it up to date,
+        fetching only what has changed or is older than --max-age.
+        'inventory list' lists the Buttons and their certificates, and
+        'inventory orphans' lists certificates attached to no Thing,
+        Things with no active certificate, active certificates with no
+        Policy, and certificates in ./certs that are not in the account.
+        Neither calls AWS.  See inventory.py.
+
+    click - Publishes a click from the Button SERIALNUM, as the Button
+        would.  The click is first written to the spool (see below), and
+        then it and any clicks spooled earlier, e.g., while the broker
+        was unreachable, are published until the spool is empty or
+        publishing fails.
+
+    simulate - Publishes clicks from the Button SERIALNUM at a steady
+        interval, through the spool, over one MQTT connection, reporting
+        the spool's depth and drain throughput every 10 seconds.  During
+        an outage clicks accumulate in the spool, and are published, at
+        the drain rate, once the broker is reachable.
+
+    notifier-daemon - Runs the Lambda handler's notifier locally, as a
+        daemon: it subscribes to every Button's clicks, connecting with
+        the certificate of the Button SERIALNUM, and notifies each click
+        as the handler would, with the same config, which it keeps loaded,
+        and with its Twilio connections kept open.  Stop it with SIGTERM
+        or Ctrl-C; it finishes the notifications in progress first.
+        SIGHUP reloads the config.  Buttons it notifies should not also
+        have an IoT rule invoking the handler.  See notifierd.py.
+
+    verify-fleet - Verifies that every Button whose serial number is
+        listed, one per line, in the file MANIFEST can connect to AWS IoT
+        and publish, with its own certificate and key from ./certs,
+        without pressing it.  Each Button opens an MQTT connection of its
+        own and publishes a probe to its topic plus '/probe', which does
+        not invoke the notifier.  If the inventory --db exists, each
+        Button's certificate is also checked in it: ACTIVE, attached to
+        the Button's Thing, and with a Policy.  Buttons are verified
+        concurrently, opening at most --rate connections per second.
+        Each Button is reported as it passes, with the time taken to
+        connect and to publish, or fails, with why, followed by a
+        summary.  Exits with status 1 if any Button failed.  See
+        verify.py.
+
+    batch - Runs the commands listed in FILE ('-' for stdin), one per
+        line, in this process, with one set of AWS clients, rather than
+        paying for starting riprock, and creating its clients, once per
+        command.  A line holds a command as it would be given to riprock
+        (e.g., 'create-button G030JF055364XVRB'), or a JSON array of its
+        words.  The result of each command is printed as a line of JSON.
+        With --jobs, that many commands are run at once, so they may
+        finish in any order.  Exits with status 1 if any command failed.
+        'subscribe', 'simulate', 'notifier-daemon', and 'batch' cannot be
+        run in a batch.  See batch.py.
+
+    Clicks are spooled on disk, in the directory given by the [spool]
+    section of riprock.conf, which also sets the most messages
+    (max_messages) and bytes (max_bytes) kept, what happens to a click
+    that does not fit (overflow: drop-oldest, drop-newest, block, or
+    error), and the most messages published per second (drain_rate).
+    'block' waits for room only under 'simulate', which drains the
+    spool in the background; 'click' fails at once, as with 'error'.
+    See spool.py.
+
 ToDo:
 
     - It would probably be handy to have a 'delete-button' that removed
@@ -99,16 +230,26 @@ import json
 import logging
 import os
 import pdb
+import random
 import re
 import sys
+import threading
+import time
 
 from pprint import pprint as pp
 
 import boto3
 import requests
 
+import apistats
 import subscriber
-from common import docopt_plus
+from batch import Batch, read_commands
+from bulk import BulkProvisioning
+from common import DocoptParser, docopt_plus, read_manifest
+from inventory import Inventory
+from rotation import Rotation
+from spool import Drainer, Spool
+from verify import FleetVerifier
 from iotbutton import AWSIoTButton
 
 try:
@@ -119,27 +260,95 @@ except:
 
 logger = None
 
-
-def main(loglevel=logging.WARN):
-
-    global logger
-
-    logger = logging.getLogger(name='riprock')
-    args = docopt_plus(__doc__, 'v 1.0')
-    config = ConfigParser.SafeConfigParser()
-    config.readfp(open('./riprock.conf'))
-
-    if args.args:
-        pp(args)
-        sys.exit(0)
+# Settings of the [spool] section of riprock.conf, and their defaults.
+SPOOL_DEFAULTS = dict(directory='./spool', max_messages='10000',
+                      max_bytes='10485760', overflow='drop-oldest',
+                      drain_rate='20')
+
+# Seconds between reports of the spool's stats by 'simulate'.
+REPORT_INTERVAL = 10
+
+# Seconds 'simulate' waits, after its last click, for the spool to empty;
+# what is left is published by the next 'click' or 'simulate'.
+FINAL_DRAIN_SECONDS = 30
+
+# Commands that run until stopped, or that run other commands, and so
+# cannot be run by 'batch'.
+UNBATCHABLE = ('subscribe', 'simulate', 'notifier-daemon', 'batch')
+
+# Spools opened, by directory, so that the commands of a batch share
+# them; two Spools of the same directory would number their messages
+# alike.
+_spools = {}
+
+
+def open_spool(config):
+    '''Returns the Spool configured in riprock.conf, and its drain
+    rate.
+
+    '''
+
+    settings = dict(SPOOL_DEFAULTS)
+    if config.has_section('spool'):
+        settings.update(config.items('spool'))
+    directory = os.path.expanduser(settings['directory'])
+    spool = _spools.get(directory)
+    if spool is None:
+        spool = Spool(directory,
+                      max_messages=int(settings['max_messages']),
+                      max_bytes=int(settings['max_bytes']),
+                      overflow=settings['overflow'])
+        _spools[directory] = spool
+    return spool, float(settings['drain_rate'])
+
+
+def format_stats(stats):
+    return ('depth %(depth)d (%(bytes)d bytes), %(spooled)d spooled, '
+            '%(dropped)d dropped, %(published)d published, '
+            '%(failures)d failed attempts, '
+            '%(drain_per_second).1f/s drained' % stats)
+
+
+def simulate(iotb, spool, drain_rate, serial_num, clicks, interval):
+    '''Publish clicks from the Button serial_num through spool.'''
+    from iotbutton import Publisher
+
+    button = iotb.for_serial_num(serial_num)
+    publisher = Publisher(button)
+    drainer = Drainer(spool, publisher, rate=drain_rate).start()
+    last_report = time.time()
+    try:
+        for i in range(clicks):
+            spool.put(button.topic, button.payload(
+                voltage='%dmV' % random.randint(1500, 2000),
+                click_type=random.choice(['SINGLE', 'DOUBLE', 'LONG'])))
+            time.sleep(interval)
+            if time.time() - last_report >= REPORT_INTERVAL:
+                print format_stats(drainer.stats())
+                last_report = time.time()
+        deadline = time.time() + FINAL_DRAIN_SECONDS
+        while len(spool) and time.time() < deadline:
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        drainer.stop()
+        publisher.close()
+        print format_stats(drainer.stats())
+
+
+def run_command(iotb, config, args):
+    '''Run the command args (as parsed from the usage above) with
+    iotb.  Returns (response, status): the response to be printed, if
+    any, and the exit status.
+
+    '''
 
     certs_dir = os.path.expanduser(config.get('main', 'certs_dir'))
-    root_ca_filename = config.get('main', 'root_ca')
     profile_name = config.get('main', 'aws_profile_name')
 
-    iotb = AWSIoTButton(certs_dir, root_ca_filename, profile_name)
-
     resp = None
+    status = 0
     if args.createtype:
         resp = iotb.create_thing_type()
     elif args.createpolicy:
@@ -156,23 +365,146 @@ def main(loglevel=logging.WARN):
         endpoint = iotb.endpoint
         print 'AWS IoT endpoint = %s' % endpoint
     elif args.oneshot:
-        resp = one_shot(args.SERIALNUM)
+        resp = iotb.one_shot(args.SERIALNUM)
     elif args.click:
         click_type = 'SINGLE' if args.single else (
                      'DOUBLE' if args.double else (
                      'LONG'   if args.long   else None))
         voltage = args.VOLTAGE or '4321mV'
-        iotb.click(args.SERIALNUM, click_type, voltage)
+        spool, drain_rate = open_spool(config)
+        spool_stats = iotb.click(args.SERIALNUM, click_type, voltage,
+                                 spool=spool, drain_rate=drain_rate)
+        print format_stats(spool_stats)
     elif args.createtopicrule:
         resp = iotb.create_topic_rule(args.SERIALNUM)
     elif args.subscribe:
         subscriber.subscribe_all(iotb, args.SERIALNUM)
+    elif args.notifierdaemon:
+        from notifierd import NotifierDaemon
+        daemon = NotifierDaemon(iotb.for_serial_num(args.SERIALNUM),
+                                config_path=args.notifierconfig or None,
+                                aws_profile_name=profile_name,
+                                workers=int(args.workers),
+                                deadline=float(args.deadline),
+                                reload_interval=float(args.reload),
+                                warm_interval=float(args.warm))
+        daemon.run()
+    elif args.rotatecerts:
+        state_path = args.state.replace('MANIFEST', args.MANIFEST)
+        rotation = Rotation(iotb, read_manifest(args.MANIFEST), state_path,
+                            overlap=float(args.overlap),
+                            concurrency=int(args.concurrency),
+                            rate=float(args.rate))
+        if rotation.run(wait=args.wait):
+            status = 1
+    elif args.provisionbulk:
+        provisioning = BulkProvisioning(iotb, args.bucket, args.rolearn)
+        if provisioning.run(read_manifest(args.MANIFEST), task_id=args.task):
+            status = 1
+    elif args.inventory:
+        fleet = Inventory(iotb, args.db, concurrency=int(args.concurrency),
+                          rate=float(args.rate),
+                          max_age=float(args.maxage))
+        if args.refresh:
+            resp = fleet.refresh(full=args.full)
+        elif args.list:
+            for button in fleet.buttons(args.serial, args.status):
+                print fleet.format_button(button)
+        elif args.orphans:
+            resp = fleet.orphans(certs_dir)
+    elif args.verifyfleet:
+        fleet = None
+        if os.path.exists(args.db):
+            fleet = Inventory(iotb, args.db)
+        else:
+            print 'No inventory %s; certificates are not checked in it' % (
+                args.db)
+        verifier = FleetVerifier(iotb, read_manifest(args.MANIFEST),
+                                 concurrency=int(args.concurrency),
+                                 rate=float(args.rate), inventory=fleet)
+        if verifier.run():
+            status = 1
+        if args.report:
+            verifier.save(args.report)
+    elif args.simulate:
+        spool, drain_rate = open_spool(config)
+        simulate(iotb, spool, drain_rate, args.SERIALNUM, int(args.clicks),
+                 float(args.interval))
+    return resp, status
+
+
+def run_batch(iotb, config, path, jobs):
+    '''Run the commands listed in the file path ('-' for stdin), with
+    at most jobs of them at once.  Returns the number that failed.
+
+    '''
+
+    # Clicks share the spool, and would publish its messages twice if
+    # drained at once.
+    click_lock = threading.Lock()
+    endpoint_lock = threading.Lock()
+
+    parser = DocoptParser(__doc__)
+
+    def run(argv):
+        args = parser.parse(argv)
+        if argv[0] in UNBATCHABLE or args.help or args.version or args.args:
+            msg = "'%s' cannot be run in a batch" % argv[0]
+            raise ValueError, msg
+        if args.click or args.describeendpoint:
+            # Discovered once, and shared by the copies made below.
+            with endpoint_lock:
+                iotb.endpoint
+        # Commands set the Button's serial number, so each has a copy of
+        # iotb, sharing its clients.
+        button = iotb.for_serial_num(args.SERIALNUM or None)
+        if args.click:
+            with click_lock:
+                return run_command(button, config, args)
+        return run_command(button, config, args)
+
+    stream = sys.stdin if path == '-' else open(path)
+    try:
+        return Batch(run, jobs=jobs).run(read_commands(stream))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def main(loglevel=logging.WARN):
 
+    global logger
+
+    logger = logging.getLogger(name='riprock')
+    args = docopt_plus(__doc__, 'v 1.0')
+    config = ConfigParser.SafeConfigParser()
+    config.readfp(open('./riprock.conf'))
+
+    if args.args:
+        pp(args)
+        sys.exit(0)
+
+    certs_dir = os.path.expanduser(config.get('main', 'certs_dir'))
+    root_ca_filename = config.get('main', 'root_ca')
+    profile_name = config.get('main', 'aws_profile_name')
+
+    stats = None
+    if args.stats or args.statsfile:
+        stats = apistats.collect(args.statsfile)
+
+    iotb = AWSIoTButton(certs_dir, root_ca_filename, profile_name,
+                        stats=stats)
+
+    if args.batch:
+        if run_batch(iotb, config, args.FILE, int(args.jobs)):
+            sys.exit(1)
+        sys.exit(0)
 
+    resp, status = run_command(iotb, config, args)
 
     if resp: pp(resp)
 
-    sys.exit(0)
+    sys.exit(status)
 
 
 
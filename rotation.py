@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+'''Rotates the certificates of a fleet of Buttons.
+
+Each Button listed in a manifest is taken through these phases:
+
+    issued    - A new certificate and key pair have been created, and
+                saved in certs_dir alongside the Button's current ones,
+                with the suffix '.new'.  The new certificate's ARN is
+                recorded as soon as it is created, so that if the run is
+                interrupted before its files are saved, the next run
+                saves them, or, if they were lost, deletes the
+                certificate rather than leaving it active.
+    attached  - The security Policy and the Button's Thing have been
+                attached to the new certificate.
+    pushed    - The new certificate and keys have replaced the current
+                ones in certs_dir, which are kept with the suffix '.old'.
+                This is where the Button picks up its credentials; the
+                old certificate stays active for the overlap window, so
+                the Button keeps working until it has reconnected with
+                the new one.
+    done      - After the overlap window, the old certificate has been
+                deactivated, detached, and deleted, and its files
+                removed.
+
+Buttons are rotated concurrently, with the AWS API calls made for all of
+them limited to a given rate.  The phase of each Button is recorded in a
+state file as soon as it is reached, so a rotation that is interrupted,
+or that fails for some Buttons, continues where it left off when run
+again; to rotate the same Buttons again later, start a new state file.
+A run that is not told to wait leaves the Buttons whose overlap
+window has not yet ended as pushed; running it again after the window
+retires their old certificates.  A run told to wait pushes every Button
+first, sleeps once until the last of their windows has ended, and then
+retires all their old certificates.
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+from concurrent import futures
+
+from common import RateLimiter
+
+
+PHASES = ('issued', 'attached', 'pushed', 'done')
+
+# Suffixes of a Button's certificate files waiting to replace the
+# current ones, and of those they replaced.
+NEW_SUFFIX = '.new'
+OLD_SUFFIX = '.old'
+
+# Deleting a certificate just detached from a Thing can fail until the
+# detachment has propagated; it is retried this many times, this many
+# seconds apart.
+DELETE_ATTEMPTS = 5
+DELETE_DELAY = 2
+
+
+def certificate_id(certificate_arn):
+    # ARNs look like 'arn:aws:iot:us-west-2:123456789012:cert/69b79...'.
+    return certificate_arn.rsplit('/', 1)[1]
+
+
+class Rotation(object):
+
+
+    def __init__(self, iotb, serial_nums, state_path, overlap=3600,
+                 concurrency=8, rate=10, stream=None):
+        '''
+        Args:
+            iotb (AWSIoTButton) - supplies the AWS IoT client, certs_dir,
+                and the name of the security Policy.
+
+            serial_nums (list of string) - the Buttons to rotate.
+
+            state_path (string) - pathname of the JSON file in which the
+                phase of each Button is kept.
+
+            overlap (float) - seconds for which the old certificate stays
+                active once the new one is pushed.
+
+            concurrency (int) - most Buttons worked on at once.
+
+            rate (float) - most AWS API calls made per second.
+
+        '''
+        self.iotb = iotb
+        self.serial_nums = serial_nums
+        self.state_path = state_path
+        self.overlap = overlap
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self.finished = 0
+
+
+    def _call(self, operation, **kwargs):
+        self.limiter.wait()
+        return getattr(self.iotb.client, operation)(**kwargs)
+
+
+    def _save(self):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+
+    def _update(self, serial_num, **changes):
+        with self.lock:
+            entry = self.state.setdefault(serial_num, {})
+            entry.pop('error', None)
+            entry.update(changes)
+            entry['updated'] = time.time()
+            self._save()
+            return dict(entry)
+
+
+    def issue(self, serial_num, button):
+        '''Create a new certificate, recording its ARN in the state
+        before saving it and its keys with the suffix '.new'.  Returns
+        its ARN.
+
+        '''
+
+        resp = self._call('create_keys_and_certificate', setAsActive=True)
+        self._update(serial_num, new_arn=resp['certificateArn'])
+        # The ARN is saved last, so that saved() finds it only once the
+        # other files are complete.
+        contents = [resp['certificatePem'],
+                    resp['keyPair']['PrivateKey'],
+                    resp['keyPair']['PublicKey'],
+                    resp['certificateArn']]
+        for path, content in zip(button.certificate_files, contents):
+            with open(path + NEW_SUFFIX, 'wb') as f:
+                f.write(content)
+        return resp['certificateArn']
+
+
+    def saved(self, button, certificate_arn):
+        '''Returns whether issue() saved all the files of the new
+        certificate certificate_arn.
+
+        '''
+
+        if not all(os.path.exists(path + NEW_SUFFIX)
+                   for path in button.certificate_files):
+            return False
+        with open(button.certificate_arn_pathname + NEW_SUFFIX) as f:
+            return f.read() == certificate_arn
+
+
+    def discard(self, certificate_arn):
+        '''Deactivate and delete a new certificate whose keys were lost
+        by an interrupted run.  Nothing has been attached to it.
+
+        '''
+
+        cert_id = certificate_id(certificate_arn)
+        try:
+            self._call('update_certificate', certificateId=cert_id,
+                       newStatus='INACTIVE')
+            self._call('delete_certificate', certificateId=cert_id)
+        except self.iotb.client.exceptions.ResourceNotFoundException:
+            # Already deleted, by an earlier run or by hand.
+            pass
+
+
+    def attach(self, button, certificate_arn):
+        self._call('attach_principal_policy',
+                   policyName=button.policy_name,
+                   principal=certificate_arn)
+        self._call('attach_thing_principal',
+                   thingName=button.thing_name,
+                   principal=certificate_arn)
+
+
+    def push(self, button):
+        '''Replace the Button's certificate files with the new ones,
+        keeping the current ones with the suffix '.old'.
+
+        '''
+
+        for path in button.certificate_files:
+            if os.path.exists(path + NEW_SUFFIX):
+                if os.path.exists(path):
+                    os.rename(path, path + OLD_SUFFIX)
+                os.rename(path + NEW_SUFFIX, path)
+
+
+    def retire(self, button, certificate_arn):
+        '''Deactivate, detach, and delete the old certificate, and
+        remove its files.
+
+        '''
+
+        cert_id = certificate_id(certificate_arn)
+        exceptions = self.iotb.client.exceptions
+        try:
+            self._call('update_certificate', certificateId=cert_id,
+                       newStatus='INACTIVE')
+            self._call('detach_principal_policy',
+                       policyName=button.policy_name,
+                       principal=certificate_arn)
+            self._call('detach_thing_principal',
+                       thingName=button.thing_name,
+                       principal=certificate_arn)
+            for attempt in range(DELETE_ATTEMPTS):
+                try:
+                    self._call('delete_certificate', certificateId=cert_id)
+                    break
+                except exceptions.DeleteConflictException:
+                    if attempt + 1 == DELETE_ATTEMPTS:
+                        raise
+                    time.sleep(DELETE_DELAY)
+        except exceptions.ResourceNotFoundException:
+            # Already deleted, by an earlier run or by hand.
+            pass
+        for path in button.certificate_files:
+            if os.path.exists(path + OLD_SUFFIX):
+                os.remove(path + OLD_SUFFIX)
+
+
+    def advance(self, serial_num):
+        '''Take the Button serial_num through as many phases as it can
+        go, and return its state.  A Button whose overlap window has not
+        ended is left as pushed.
+
+        '''
+
+        button = self.iotb.for_serial_num(serial_num)
+        with self.lock:
+            entry = dict(self.state.get(serial_num, {}))
+        phase = entry.get('phase')
+
+        if phase is None:
+            old_arn = None
+            if os.path.exists(button.certificate_arn_pathname):
+                old_arn = button.certificate_arn
+            new_arn = entry.get('new_arn')
+            if new_arn and not self.saved(button, new_arn):
+                self.discard(new_arn)
+                new_arn = None
+            if not new_arn:
+                new_arn = self.issue(serial_num, button)
+            entry = self._update(serial_num, phase='issued',
+                                 old_arn=old_arn, new_arn=new_arn,
+                                 started=time.time())
+        if entry['phase'] == 'issued':
+            self.attach(button, entry['new_arn'])
+            entry = self._update(serial_num, phase='attached')
+        if entry['phase'] == 'attached':
+            self.push(button)
+            entry = self._update(serial_num, phase='pushed',
+                                 pushed=time.time())
+        if entry['phase'] == 'pushed':
+            if time.time() < entry['pushed'] + self.overlap:
+                return entry
+            if entry['old_arn']:
+                self.retire(button, entry['old_arn'])
+            entry = self._update(serial_num, phase='done',
+                                 finished=time.time())
+        return entry
+
+
+    def _advance(self, serial_num, wait):
+        try:
+            entry = self.advance(serial_num)
+        except Exception as exc:
+            entry = self._update(serial_num, error='%s: %s' % (
+                type(exc).__name__, exc))
+        if wait and self.waiting(entry):
+            # Reported once it is retired, after the wait.
+            return entry
+        with self.lock:
+            self.finished += 1
+            print('[%d/%d] %s' % (self.finished, len(self.serial_nums),
+                                  self.describe(serial_num, entry)),
+                  file=self.stream)
+        return entry
+
+
+    def waiting(self, entry):
+        '''Whether the Button whose state is entry is pushed, awaiting
+        the end of its overlap window.
+
+        '''
+
+        return entry.get('phase') == 'pushed' and not entry.get('error')
+
+
+    def _pass(self, serial_nums, wait):
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            return list(executor.map(lambda s: self._advance(s, wait),
+                                     serial_nums))
+        finally:
+            executor.shutdown()
+
+
+    def describe(self, serial_num, entry):
+        text = '%s %s' % (serial_num, entry.get('phase') or 'not started')
+        if entry.get('error'):
+            text += ', failed: %s' % entry['error']
+        elif entry.get('phase') == 'pushed':
+            text += '; old certificate retires after %s' % time.strftime(
+                '%Y-%m-%d %H:%M:%S',
+                time.localtime(entry['pushed'] + self.overlap))
+        return text
+
+
+    def run(self, wait=False):
+        '''Advance every Button not yet done, and return the number
+        that failed.  If wait is true, every Button is first pushed,
+        then, once the last of their overlap windows has ended, all
+        their old certificates are retired.
+
+        '''
+
+        pending = [s for s in self.serial_nums
+                   if self.state.get(s, {}).get('phase') != 'done']
+        self.finished = len(self.serial_nums) - len(pending)
+        entries = dict(zip(pending, self._pass(pending, wait)))
+        waiting = [s for s in pending if self.waiting(entries[s])]
+        if wait and waiting:
+            retire_at = max(entries[s]['pushed'] for s in waiting)
+            retire_at += self.overlap
+            print('Waiting until %s to retire %d old certificates' % (
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(retire_at)),
+                len(waiting)), file=self.stream)
+            # Read the clock once: a negative sleep raises IOError.
+            delay = retire_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            entries.update(zip(waiting, self._pass(waiting, False)))
+        self.report()
+        return len([e for e in entries.values() if e.get('error')])
+
+
+    def report(self):
+        '''Print the number of Buttons in each phase.'''
+        counts = dict.fromkeys(('not started',) + PHASES + ('failed',), 0)
+        for serial_num in self.serial_nums:
+            entry = self.state.get(serial_num, {})
+            if entry.get('error'):
+                counts['failed'] += 1
+            counts[entry.get('phase') or 'not started'] += 1
+        print(', '.join('%d %s' % (counts[k], k)
+                        for k in ('not started',) + PHASES + ('failed',)),
+              file=self.stream)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+'''A bounded, disk-backed spool of MQTT messages waiting to be published.
+
+The AWS IoT SDK's offline publish queue is kept in memory, so it is lost
+when the simulator stops, and, configured with a size of -1, grows
+without limit while the broker is unreachable.  A Spool instead keeps
+each message in a file of its own in a directory, named by a sequence
+number, so messages survive restarts and are published in the order
+they were spooled.  It holds at most max_messages messages and
+max_bytes bytes of them; a message that does not fit is handled by the
+overflow policy:
+
+    drop-oldest - drop the oldest messages to make room (the default;
+                  a click simulator cares most about recent clicks)
+    drop-newest - drop the new message
+    block       - wait for the Drainer to make room (only meaningful
+                  with a Drainer running in the background, as
+                  'simulate' has; 'click' raises SpoolFull instead)
+    error       - raise SpoolFull
+
+A Drainer publishes spooled messages, oldest first, at no more than a
+given rate, so a backlog built up during an outage is sent as fast as
+that rate allows -- rather than at the SDK's two per second -- without
+flooding the broker.  A message is removed from the spool only once it
+has been published; if publishing fails, the Drainer backs off,
+doubling its delay up to a limit, and tries the same message again.
+
+Both keep counts -- queue depth and size, messages spooled, dropped,
+published, failed attempts, and the recent drain throughput -- which
+stats() returns.
+
+'''
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from common import RateLimiter, makedirs
+
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'block', 'error')
+
+# Suffix of the files holding spooled messages.
+SUFFIX = '.msg'
+
+# Seconds over which the drain throughput is measured.
+THROUGHPUT_WINDOW = 10
+
+
+class SpoolFull(Exception):
+    '''Raised by Spool.put() when the spool is full and its overflow
+    policy is 'error', or, for 'block', when waiting times out.
+
+    '''
+    pass
+
+
+class Spool(object):
+
+
+    def __init__(self, directory, max_messages=10000, max_bytes=10485760,
+                 overflow='drop-oldest'):
+        if overflow not in OVERFLOW_POLICIES:
+            msg = 'Unknown overflow policy %r; expected one of %s' % (
+                overflow, ', '.join(OVERFLOW_POLICIES))
+            raise ValueError, msg
+        self.directory = makedirs(directory, exists_ok=True)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.changed = threading.Condition()
+        self.enqueued = 0
+        self.dropped = 0
+
+        # (sequence number, size) of each spooled message, oldest first.
+        self.entries = collections.deque()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SUFFIX):
+                path = os.path.join(directory, name)
+                self.entries.append((int(name[:-len(SUFFIX)]),
+                                     os.path.getsize(path)))
+            elif name.endswith('.tmp'):
+                # Left by a put() interrupted before its rename.
+                os.remove(os.path.join(directory, name))
+        self.size = sum(size for _, size in self.entries)
+        self.next_seq = self.entries[-1][0] + 1 if self.entries else 0
+
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '%020d%s' % (seq, SUFFIX))
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def _full(self, size):
+        return (len(self.entries) >= self.max_messages or
+                self.size + size > self.max_bytes)
+
+
+    def put(self, topic, payload, timeout=None):
+        '''Spool a message.  Returns whether it was spooled, i.e., was
+        not dropped under the 'drop-newest' policy.
+
+        '''
+
+        data = json.dumps(dict(topic=topic, payload=payload,
+                               spooled=time.time()))
+        size = len(data)
+        with self.changed:
+            if self._full(size):
+                if self.overflow == 'drop-newest' or size > self.max_bytes:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == 'error':
+                    raise SpoolFull('Spool %s is full' % self.directory)
+                elif self.overflow == 'block':
+                    deadline = None if timeout is None else (
+                        time.time() + timeout)
+                    while self._full(size):
+                        remaining = None if deadline is None else (
+                            deadline - time.time())
+                        if remaining is not None and remaining <= 0:
+                            raise SpoolFull('Timed out waiting for room in '
+                                            'spool %s' % self.directory)
+                        self.changed.wait(remaining)
+                else:
+                    while self.entries and self._full(size):
+                        self._remove(self.entries[0][0])
+                        self.dropped += 1
+
+            seq = self.next_seq
+            self.next_seq += 1
+            path = self._path(seq)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+            self.entries.append((seq, size))
+            self.size += size
+            self.enqueued += 1
+            self.changed.notify_all()
+        return True
+
+
+    def peek(self):
+        '''Returns (sequence number, topic, payload) of the oldest
+        message, or None if the spool is empty.
+
+        '''
+
+        with self.changed:
+            if not self.entries:
+                return None
+            seq = self.entries[0][0]
+            with open(self._path(seq), 'rb') as f:
+                message = json.loads(f.read())
+        return seq, message['topic'], message['payload']
+
+
+    def _remove(self, seq):
+        for index, (s, size) in enumerate(self.entries):
+            if s == seq:
+                del self.entries[index]
+                self.size -= size
+                os.remove(self._path(seq))
+                return
+
+
+    def ack(self, seq):
+        '''Remove the message seq, once it has been published.'''
+        with self.changed:
+            self._remove(seq)
+            self.changed.notify_all()
+
+
+    def wait(self, timeout):
+        '''Wait until a message is spooled, or timeout seconds.'''
+        with self.changed:
+            if not self.entries:
+                self.changed.wait(timeout)
+
+
+class Drainer(object):
+
+
+    def __init__(self, spool, publish, rate=20, retry_delay=1,
+                 max_retry_delay=60):
+        '''
+        Args:
+            spool (Spool) - the messages to publish.
+
+            publish (function) - publish(topic, payload) publishes a
+                message, returning a false value or raising an exception
+                if it could not.
+
+            rate (float) - most messages published per second.
+
+            retry_delay, max_retry_delay (float) - seconds to wait after
+                the first of a run of failed attempts, and at most after
+                the later ones.
+
+        '''
+        self.spool = spool
+        self.publish = publish
+        self.limiter = RateLimiter(rate)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.delay = retry_delay
+        self.published = 0
+        self.failures = 0
+        self.recent = collections.deque()
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def drain_one(self):
+        '''Publish the oldest message.  Returns True if one was
+        published, False if it could not be, and None if the spool is
+        empty.
+
+        '''
+
+        message = self.spool.peek()
+        if message is None:
+            return None
+        seq, topic, payload = message
+        self.limiter.wait()
+        try:
+            ok = self.publish(topic, payload)
+        except Exception as exc:
+            logger.info('Publishing spooled message %d failed: %s', seq, exc)
+            ok = False
+        if not ok:
+            self.failures += 1
+            return False
+        self.spool.ack(seq)
+        self.published += 1
+        self.delay = self.retry_delay
+        now = time.time()
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - THROUGHPUT_WINDOW:
+            self.recent.popleft()
+        return True
+
+
+    def drain(self, timeout=None):
+        '''Publish spooled messages until the spool is empty, backing off
+        after failures.  Returns whether it was emptied, or gives up
+        once backing off would take it past timeout seconds (so with a
+        timeout of 0, at the first failure).
+
+        '''
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.stopping.is_set():
+            result = self.drain_one()
+            if result is None:
+                return True
+            if result is False:
+                if (deadline is not None and
+                    time.time() + self.delay > deadline):
+                    return False
+                self.stopping.wait(self.delay)
+                self.delay = min(self.delay * 2, self.max_retry_delay)
+        return False
+
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.drain()
+            self.spool.wait(1)
+
+
+    def start(self):
+        '''Drain the spool in a background thread until stop().'''
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+
+    def stats(self):
+        now = time.time()
+        recent = len([t for t in list(self.recent)
+                      if t >= now - THROUGHPUT_WINDOW])
+        return dict(depth=len(self.spool), bytes=self.spool.size,
+                    spooled=self.spool.enqueued, dropped=self.spool.dropped,
+                    published=self.published, failures=self.failures,
+                    drain_per_second=round(
+                        float(recent) / THROUGHPUT_WINDOW, 2))
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End:
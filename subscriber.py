@@ -11,11 +11,47 @@ import sys
 import paho.mqtt.client as paho
 
 
+# Port of the AWS IoT MQTT endpoint.
+AWS_IOT_PORT = 8883
+
+
 def conout(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
     sys.stderr.flush()
 
 
+def message_handler(stream):
+    '''Returns an on_message callback that writes each message received
+    to stream.
+
+    '''
+
+    def on_message(client, userdata, msg):
+        print(datetime.datetime.now().ctime(), file=stream)
+        print("topic: %s" % msg.topic, file=stream)
+        print("payload: %s\n" % str(msg.payload), file=stream)
+        stream.flush()
+
+    return on_message
+
+
+def mqtt_client(iotb, client_id):
+    '''Returns a paho MQTT client set up to connect to the AWS IoT
+    endpoint (at AWS_IOT_PORT) with the certificate of the Button
+    iotb.serial_num.
+
+    '''
+
+    mqttc = paho.Client(client_id=client_id)
+    mqttc.tls_set(ca_certs=iotb.rootCA_pathname,
+                  certfile=iotb.certificate,
+                  keyfile=iotb.private_key,
+                  cert_reqs=ssl.CERT_REQUIRED,
+                  tls_version=ssl.PROTOCOL_TLSv1_2,
+                  ciphers=None)
+    return mqttc
+
+
 def subscribe_all(iotb, serial_num):
 
 
@@ -26,12 +62,6 @@ def subscribe_all(iotb, serial_num):
         client.subscribe("#" , 1 )
 
 
-    def on_message(client, userdata, msg):
-        conout(datetime.datetime.now().ctime())
-        conout("topic: %s" % msg.topic)
-        conout("payload: %s\n" % str(msg.payload))
-
-
     def on_log(client, userdata, level, msg):
         message = '%s %s\n' % (msg.topic, str(msg.payload))
         conout(message)
@@ -39,20 +69,10 @@ def subscribe_all(iotb, serial_num):
     # Must set serial_num so that paths will be correct
     iotb.set_serial_num(serial_num)
 
-    mqttc = paho.Client(client_id="subscribeall")
+    mqttc = mqtt_client(iotb, "subscribeall")
     mqttc.on_connect = on_connect
-    mqttc.on_message = on_message
+    mqttc.on_message = message_handler(sys.stderr)
     #mqttc.on_log = on_log
 
-    awshost = iotb.endpoint
-    awsport = 8883
-
-    mqttc.tls_set(ca_certs=iotb.rootCA_pathname,
-                  certfile=iotb.certificate,
-                  keyfile=iotb.private_key,
-                  cert_reqs=ssl.CERT_REQUIRED,
-                  tls_version=ssl.PROTOCOL_TLSv1_2,
-                  ciphers=None)
-
-    mqttc.connect(awshost, awsport, keepalive=60)
+    mqttc.connect(iotb.endpoint, AWS_IOT_PORT, keepalive=60)
     mqttc.loop_forever()
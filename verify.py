@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+'''Verifies that a fleet of Buttons can reach AWS IoT, each with its own
+credentials, without pressing any of them.
+
+Each Button listed in a manifest is checked in these stages, and fails
+at the first that does not succeed:
+
+    files       - Its certificate and private key are in certs_dir.
+    attachment  - If an inventory (see inventory.py) is given, the
+                  certificate in certs_dir is in it, ACTIVE, attached to
+                  the Button's Thing, and has a Policy.
+    connect     - An MQTT connection to the AWS IoT endpoint, over TLS
+                  with the Button's certificate, is accepted.
+    publish     - A probe message, published with QoS 1, is acknowledged
+                  by the broker.
+
+The probe is published to the Button's topic plus PROBE_SUFFIX (e.g.,
+iotbutton/G030JF055364XVRB/probe), which the Button's Policy must allow
+as it does the Button's topic, but which neither the IoT rule invoking
+the notifier nor the notifier daemon subscribes to: a probe of the
+Button's own topic would notify its recipients of a click.
+
+Buttons are checked concurrently, each over a connection of its own,
+with a client ID of its own (AWS IoT drops a connection when another
+connects with the same ID), and connections are opened at a limited
+rate.  The time taken to connect, and to have the probe acknowledged,
+is measured for each Button.  The inventory is consulted up front,
+since an SQLite connection cannot be shared among threads.
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from concurrent import futures
+
+from apistats import percentile
+from common import RateLimiter
+
+
+STAGES = ('files', 'attachment', 'connect', 'publish')
+
+# Appended to a Button's topic to make the topic of its probe.
+PROBE_SUFFIX = '/probe'
+
+
+class FleetVerifier(object):
+
+
+    def __init__(self, iotb, serial_nums, concurrency=8, rate=10,
+                 inventory=None, stream=None):
+        '''
+        Args:
+            iotb (AWSIoTButton) - supplies certs_dir, the root CA, and the
+                AWS IoT endpoint.
+
+            serial_nums (list of string) - the Buttons to verify.
+
+            concurrency (int) - most Buttons verified at once.
+
+            rate (float) - most connections opened per second.
+
+            inventory (Inventory) - if given, each Button's certificate
+                is looked up in it.
+
+        '''
+        self.iotb = iotb
+        self.serial_nums = serial_nums
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.inventory = inventory
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.run_id = uuid.uuid4().hex[:12]
+        self.results = {}
+        self.problems = {}
+        self.finished = 0
+
+
+    def check_attachments(self):
+        '''Returns a dict of the problem, if any, with the attachments of
+        each Button's certificate, according to the inventory.
+
+        '''
+
+        from rotation import certificate_id
+
+        problems = {}
+        for serial_num in self.serial_nums:
+            button = self.iotb.for_serial_num(serial_num)
+            if not os.path.exists(button.certificate_arn_pathname):
+                problems[serial_num] = 'no %s' % os.path.basename(
+                    button.certificate_arn_pathname)
+                continue
+            cert_id = certificate_id(button.certificate_arn)
+            things = [b for b in self.inventory.buttons(serial_num)
+                      if b['serial'] == serial_num]
+            certs = [c for b in things for c in b['certificates']
+                     if c['id'] == cert_id]
+            if not things:
+                problems[serial_num] = ('Thing not in the inventory; '
+                                        'refresh it?')
+            elif not certs:
+                problems[serial_num] = ('certificate %s is not attached to '
+                                        'the Thing' % cert_id[:12])
+            elif certs[0]['status'] != 'ACTIVE':
+                problems[serial_num] = 'certificate %s is %s' % (
+                    cert_id[:12], certs[0]['status'])
+            elif not certs[0]['policies']:
+                problems[serial_num] = ('certificate %s has no Policy' %
+                                        cert_id[:12])
+        return problems
+
+
+    def verify(self, serial_num):
+        '''Verify the Button serial_num, and return a dict describing the
+        outcome: 'ok', and either the 'connect' and 'publish' times (in
+        milliseconds) or the 'stage' that failed and the 'error'.
+
+        '''
+
+        result = dict(serial=serial_num, ok=False)
+        button = self.iotb.for_serial_num(serial_num)
+        missing = [p for p in (self.iotb.rootCA_pathname, button.certificate,
+                               button.private_key)
+                   if not os.path.exists(p)]
+        if missing:
+            result.update(stage='files', error='missing %s' % ', '.join(
+                os.path.basename(p) for p in missing))
+            return result
+        if serial_num in self.problems:
+            result.update(stage='attachment',
+                          error=self.problems[serial_num])
+            return result
+
+        button.mqtt_client_id = 'riprock-verify-%s-%s' % (serial_num,
+                                                          self.run_id)
+        stage = 'connect'
+        client = None
+        try:
+            client = button._init_mqtt_client()
+            self.limiter.wait()
+            start = time.time()
+            client.connect()
+            result['connect'] = round((time.time() - start) * 1000, 1)
+
+            stage = 'publish'
+            payload = json.dumps(dict(probe=self.run_id,
+                                      serialNumber=serial_num,
+                                      sent=time.time()))
+            start = time.time()
+            if not client.publish(button.topic + PROBE_SUFFIX, payload, 1):
+                msg = 'probe not acknowledged'
+                raise RuntimeError, msg
+            result['publish'] = round((time.time() - start) * 1000, 1)
+            result['ok'] = True
+        except Exception as exc:
+            result.update(stage=stage, error='%s: %s' % (
+                type(exc).__name__, exc))
+        finally:
+            # Even after a failed connect, which the SDK may otherwise
+            # go on retrying.
+            if client is not None:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+        return result
+
+
+    def _verify(self, serial_num):
+        result = self.verify(serial_num)
+        with self.lock:
+            self.results[serial_num] = result
+            self.finished += 1
+            print('[%d/%d] %s' % (self.finished, len(self.serial_nums),
+                                  self.describe(result)),
+                  file=self.stream)
+        return result
+
+
+    def describe(self, result):
+        if result['ok']:
+            return '%-20s pass  connect %7.1fms  publish %7.1fms' % (
+                result['serial'], result['connect'], result['publish'])
+        return '%-20s FAIL  at %s: %s' % (result['serial'], result['stage'],
+                                          result['error'])
+
+
+    def run(self):
+        '''Verify every Button, print a report, and return the number
+        that failed.
+
+        '''
+
+        start = time.time()
+        if self.inventory:
+            self.problems = self.check_attachments()
+        # Looked up once, rather than by each Button's copy of iotb.
+        self.iotb.endpoint
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            results = list(executor.map(self._verify, self.serial_nums))
+        finally:
+            executor.shutdown()
+        self.report(time.time() - start)
+        return len([r for r in results if not r['ok']])
+
+
+    def report(self, seconds):
+        '''Print the number of Buttons that passed and failed, by the
+        stage at which they failed, and the distribution of latencies.
+
+        '''
+
+        results = [self.results[s] for s in self.serial_nums
+                   if s in self.results]
+        failed = dict.fromkeys(STAGES, 0)
+        for result in results:
+            if not result['ok']:
+                failed[result['stage']] += 1
+        print('%d Buttons verified in %.1fs: %d passed, %d failed (%s)' % (
+            len(results), seconds, len([r for r in results if r['ok']]),
+            sum(failed.values()), ', '.join('%s %d' % (stage, failed[stage])
+                                            for stage in STAGES)),
+              file=self.stream)
+        for name in ('connect', 'publish'):
+            samples = sorted(r[name] for r in results if name in r)
+            if samples:
+                print('%-8s p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  '
+                      'max %7.1fms' % (name, percentile(samples, 50),
+                                       percentile(samples, 90),
+                                       percentile(samples, 99),
+                                       max(samples)),
+                      file=self.stream)
+
+
+    def save(self, path):
+        '''Write the result of each Button to path, as JSON.'''
+        with open(path + '.tmp', 'w') as f:
+            json.dump([self.results[s] for s in self.serial_nums
+                       if s in self.results], f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+
+#;;; Local Variables:
+#;;; mode: python
+#;;; coding: utf-8
+#;;; eval: (auto-fill-mode)
+#;;; eval: (set-fill-column 78)
+#;;; eval: (fci-mode)
+#;;; End: